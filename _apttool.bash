@@ -14,7 +14,7 @@ _apttool()
 
     if ((COMP_CWORD)); then
         if [[ "$cur" == -* ]]; then
-            COMPREPLY=( $( compgen -fW '-? --examples -h --help -v --version -c= --containsfile= -C --nocolor -n --names -q --quiet -i --install -d --delete -p --purge -C --nocolor -q --quiet -e --executables -f --files -S --suggests -C --nocolor -q --quiet -s --short -P --dependencies -R --reversedeps -C --nocolor -I --INSTALLED -N --NOTINSTALLED -q --quiet -s --short -H --history -C --nocolor -q --quiet -l --locate -L --LOCATE -C --nocolor -q --quiet -s --short -u --update -C --nocolor -q --quiet -V --VERSION -C --nocolor -a --all -q --quiet -s --short -a --all -C --nocolor -I --INSTALLED -N --NOTINSTALLED -D --dev -n --names -q --quiet -r --reverse -s --short -x --ignorecase ' -- "$cur") )
+            COMPREPLY=( $( compgen -fW '-? --examples -h --help -v --version -c= --containsfile= --noindex --profile -C --nocolor -n --names -q --quiet -i --install -d --delete -p --purge -C --nocolor -q --quiet -e --executables -f --files --format= -S --suggests -C --nocolor -q --quiet -s --short -P --dependencies --recursive -R --reversedeps --depth= -C --nocolor -I --INSTALLED -N --NOTINSTALLED -q --quiet -s --short -H --history --since= --until= --package= --action= --transactions -C --nocolor -q --quiet -l --locate -L --LOCATE --bulk --missing -C --nocolor -q --quiet -s --short -u --update --serve --upgradable -C --nocolor -q --quiet -V --VERSION -C --nocolor -a --all -q --quiet -s --short --table -a --all -C --nocolor -I --INSTALLED -N --NOTINSTALLED -D --dev -n --names -q --quiet -r --reverse -s --short -x --ignorecase -j= --jobs= --rank -t= --top= ' -- "$cur") )
         else
             COMPREPLY=( $( apt-cache --no-generate pkgnames "$cur" 2> /dev/null ) )
         fi
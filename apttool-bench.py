@@ -0,0 +1,712 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" apttool-bench.py
+    Benchmarks for apttool's hot paths, using synthetic data so results can
+    be compared between machines.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import accumulate
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+try:
+    from colr import (
+        Colr as C,
+        docopt,
+    )
+except ImportError as excolr:
+    print('Missing important third-party library: Colr\n{}'.format(excolr))
+    sys.exit(1)
+
+# apttool.py lives next to this script.
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0])
+import apttool  # noqa
+
+__version__ = '0.0.1'
+
+NAME = 'AptTool Benchmarks'
+
+SCRIPT = os.path.split(sys.argv[0])[-1]
+
+# apttool commands to time for `startup`, and whether they may import apt.
+STARTUP_CMDS = (
+    (('--examples',), False),
+    (('-H', 'install', '5'), False),
+    (('-V', 'bash'), True),
+    (('--upgradable', '-s'), True),
+    (('-P', 'bash'), True),
+    (('bash', '-s'), True),
+    (('-c', 'bin/bash'), True),
+)
+# Third-party modules that apttool only imports when they are needed.
+STARTUP_LAZY_MODULES = ('apt', 'colr', 'fmtblock')
+
+USAGESTR = """{name} v. {version}
+
+    Usage:
+        {script} -h | -v
+        {script} history [-l num] [QUERY...]
+        {script} output [-r num]
+        {script} rank [-p num] [TERMS...]
+        {script} search [-c file] [PATTERN...]
+        {script} startup [-n num]
+
+    Options:
+        PATTERN               : Search patterns to time.
+                                Default: python, lib, ssl
+        QUERY                 : History queries to time.
+                                Default: installed, ^install, libssl
+        TERMS                 : --rank queries to time.
+                                Default: python, lib, ssl, 'dev library'
+        -c file,--corpus file : Package records to search (JSON lines).
+                                If the file doesn't exist, it is recorded
+                                from the apt cache first. Without this,
+                                the apt cache is searched directly.
+        -h,--help             : Show this help message and exit.
+        -l num,--lines num    : Number of lines in the synthetic dpkg.log.
+                                [default: 1000000]
+        -n num,--runs num     : Number of times to run each command.
+                                [default: 5]
+        -p num,--packages num : Number of synthetic packages to rank.
+                                [default: 60000]
+        -r num,--results num  : Number of synthetic search results.
+                                [default: 50000]
+        -v,--version          : Show version and exit.
+""".format(name=NAME, script=SCRIPT, version=__version__)
+
+
+def main(argd):
+    """ Main entry point, expects docopt arg dict as argd. """
+    if argd['history']:
+        return bench_history(
+            int(argd['--lines']),
+            argd['QUERY'] or ['installed', '^install', 'libssl'],
+        )
+    if argd['output']:
+        return bench_output(int(argd['--results']))
+    if argd['rank']:
+        return bench_rank(
+            int(argd['--packages']),
+            argd['TERMS'] or ['python', 'lib', 'ssl', 'dev library'],
+        )
+    if argd['search']:
+        return bench_search(
+            argd['--corpus'],
+            argd['PATTERN'] or ['python', 'lib', 'ssl'],
+        )
+    if argd['startup']:
+        return bench_startup(int(argd['--runs']))
+    return 1
+
+
+def bench_history(linecnt, queries):
+    """ Time dpkg.log parsing and -H queries over a synthetic log. """
+    with tempfile.TemporaryDirectory(prefix='apttool-bench.') as tmpdir:
+        logname = os.path.join(tmpdir, 'dpkg.log')
+        elapsed = timed(write_dpkg_log, logname, linecnt)
+        print_result(
+            'Wrote {} lines ({})'.format(
+                linecnt,
+                format_size(os.path.getsize(logname))
+            ),
+            elapsed,
+        )
+        with open(logname, 'r') as f:
+            lines = f.readlines()
+
+        timestrs = [' '.join(s.split(' ', 2)[:2]) for s in lines[:100000]]
+        print_result(
+            'datetime.strptime() x {}'.format(len(timestrs)),
+            timed(
+                lambda: [
+                    datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
+                    for s in timestrs
+                ]
+            ),
+        )
+        print_result(
+            'parse_history_time() x {}'.format(len(timestrs)),
+            timed(lambda: [apttool.parse_history_time(s) for s in timestrs]),
+        )
+        print_result(
+            'HistoryLine.from_dpkg_line() x {}'.format(len(lines)),
+            timed(
+                lambda: [apttool.HistoryLine.from_dpkg_line(s) for s in lines]
+            ),
+        )
+        print_result(
+            'iter_history() (all lines)',
+            timed(lambda: sum(1 for _ in apttool.iter_history(logname))),
+        )
+        for query in queries:
+            repat = re.compile(query)
+            print_result(
+                'Query {!r}, parse every line'.format(query),
+                timed(
+                    lambda: sum(
+                        1 for s in lines
+                        if history_matches(s, repat)
+                    )
+                ),
+            )
+            print_result(
+                'Query {!r}, iter_history(repat=...)'.format(query),
+                timed(
+                    lambda: sum(
+                        1 for hl in apttool.iter_history(logname, repat=repat)
+                        if hl.matches(repat)
+                    )
+                ),
+            )
+            print_result(
+                'Query {!r}, first 10 (like -H QUERY 10)'.format(query),
+                timed(lambda: first_matches(logname, repat, 10)),
+            )
+
+        print_result(
+            'iter_history_transactions() (all lines)',
+            timed(
+                lambda: sum(
+                    1 for _ in apttool.iter_history_transactions(
+                        logname,
+                        churn=Counter(),
+                        dailyupgrades=Counter(),
+                    )
+                )
+            ),
+        )
+
+        # The persistent HistoryIndex (-H --since/--until/...).
+        apttool.INDEX_DIR = tmpdir
+        print_result(
+            'HistoryIndex.load() (new index)',
+            timed(apttool.HistoryIndex.load, logname=logname),
+        )
+        with open(logname, 'a') as f:
+            f.writelines(lines[-1000:])
+        print_result(
+            'HistoryIndex.load() (1000 new lines)',
+            timed(apttool.HistoryIndex.load, logname=logname),
+        )
+        historyindex = apttool.HistoryIndex.load(logname=logname)
+        print_result(
+            'HistoryIndex.load() (no changes)',
+            timed(apttool.HistoryIndex.load, logname=logname),
+        )
+        lastday = apttool.parse_history_time(timestrs[-1][:10] + ' 00:00:00')
+        indexqueries = (
+            ('--package libssl3', {'package': 'libssl3'}),
+            ('--action upgrade', {'action': 'upgrade'}),
+            ('--since (last day)', {'since': lastday}),
+            (
+                '--package libssl3 --action installed',
+                {'package': 'libssl3', 'action': 'installed'},
+            ),
+        )
+        for label, kwargs in indexqueries:
+            print_result(
+                'Query {}, HistoryIndex'.format(label),
+                timed(lambda: sum(1 for _ in historyindex.query(**kwargs))),
+            )
+    return 0
+
+
+def bench_output(reccnt):
+    """ Time writing search results to a pipe with one print() per result
+        (the old AptToolFilter.on_match()), and through an OutputBuffer.
+        Also time pkg_format() with and without colors, and cached.
+    """
+    records = synthetic_records(reccnt)
+    lines = []
+    elapsed = timed(
+        lambda: lines.extend(
+            '\n{}'.format(apttool.pkg_format(pkgrec))
+            for pkgrec in records
+        )
+    )
+    print_result(
+        'Formatted {} results ({})'.format(
+            len(lines),
+            format_size(sum(len(s) + 1 for s in lines)),
+        ),
+        elapsed,
+    )
+
+    def write_print(f):
+        for line in lines:
+            print(line, file=f)
+
+    def write_buffered(f, bufsize=None):
+        output = apttool.OutputBuffer(file=f, bufsize=bufsize)
+        for line in lines:
+            output.write('{}\n'.format(line))
+        output.flush()
+
+    print_result(
+        'print() per result, piped',
+        timed_pipe(write_print),
+    )
+    print_result(
+        'print() per result, line-buffered (like a tty)',
+        timed_pipe(write_print, line_buffering=True),
+    )
+    print_result(
+        'OutputBuffer(), piped',
+        timed_pipe(write_buffered),
+    )
+    print_result(
+        'OutputBuffer(bufsize=0), line-buffered (like a tty)',
+        timed_pipe(write_buffered, line_buffering=True, bufsize=0),
+    )
+
+    # Whole searches, including matching and formatting.
+    class PrintFilter(apttool.AptToolFilter):
+        """ AptToolFilter with the old print() per result. """
+        def on_match(self, pkg):
+            print('\n{}'.format(apttool.pkg_format(pkg)), file=self.file)
+            return True
+
+    def search_print(f):
+        aptfilter = PrintFilter(re.compile('.'))
+        aptfilter.file = f
+        return sum(1 for pkgrec in records if aptfilter.apply(pkgrec))
+
+    def search_buffered(f):
+        aptfilter = apttool.AptToolFilter(
+            re.compile('.'),
+            output=apttool.OutputBuffer(file=f),
+        )
+        cnt = sum(1 for pkgrec in records if aptfilter.apply(pkgrec))
+        aptfilter.flush()
+        return cnt
+
+    print_result(
+        'Search (every result), print() per result, piped',
+        timed_pipe(search_print),
+    )
+    print_result(
+        'Search (every result), OutputBuffer(), piped',
+        timed_pipe(search_buffered),
+    )
+
+    # pkg_format() with colors (Colr), without colors (PlainColr), and
+    # formatting the same packages again (from the pkg_format() cache).
+    def format_all(pkgrecs):
+        for pkgrec in pkgrecs:
+            apttool.pkg_format(pkgrec)
+
+    # Colors are left enabled, for the rest of the benchmark output.
+    for label, colors in (('no colors', False), ('colors', True)):
+        if colors:
+            apttool.colr_enable()
+        else:
+            apttool.colr_disable()
+        apttool.pkg_memo_clear()
+        print_result(
+            'pkg_format() x {}, {}'.format(len(records), label),
+            timed(format_all, records),
+        )
+    cached = records[:apttool.PKG_FORMAT_CACHE_SIZE]
+    format_all(cached)
+    print_result(
+        'pkg_format() x {}, cached'.format(len(cached)),
+        timed(format_all, cached),
+    )
+    return 0
+
+
+def bench_rank(pkgcnt, queries):
+    """ Time building, saving, and loading a RankIndex for synthetic package
+        records, and answering --rank queries with it.
+    """
+    records = apttool.SearchIndex(
+        synthetic_rank_records(pkgcnt),
+        stamp=('apttool-bench',),
+    )
+    rankindex = None
+
+    def build():
+        nonlocal rankindex
+        rankindex = apttool.RankIndex.from_records(records)
+
+    print_result(
+        'RankIndex.from_records() x {}'.format(pkgcnt),
+        timed(build),
+    )
+    with tempfile.TemporaryDirectory(prefix='apttool-bench.') as tmpdir:
+        apttool.INDEX_DIR = tmpdir
+        elapsed = timed(rankindex.save)
+        filename = apttool.index_filename(apttool.RankIndex.index_name)
+        print_result(
+            'RankIndex.save() ({})'.format(
+                format_size(os.path.getsize(filename))
+            ),
+            elapsed,
+        )
+        print_result(
+            'RankIndex.load()',
+            timed(apttool.RankIndex.load, records),
+        )
+    for query in queries:
+        # search() returns (best_results, total).
+        result = []
+        elapsed = timed(
+            lambda: result.extend(rankindex.search([query], top=25))
+        )
+        print_result(
+            'Query {!r} ({} matches)'.format(query, result[1]),
+            elapsed,
+        )
+    return 0
+
+
+def bench_search(corpusfile, patterns):
+    """ Time AptToolFilter.matches() over a package record corpus, with
+        and without a QueryMatcher, for every -a/-x/-r combination.
+        The matches must be the same either way.
+    """
+    records = []
+    elapsed = timed(lambda: records.extend(corpus_load(corpusfile)))
+    print_result('Loaded {} package records'.format(len(records)), elapsed)
+    errs = 0
+    for all_patterns in (False, True):
+        query = apttool.query_build(patterns, all_patterns=all_patterns)
+        literals = apttool.query_literals(
+            patterns,
+            all_patterns=all_patterns,
+        )
+        if literals is None:
+            print(C('No plain text patterns for: {}'.format(query), 'red'))
+            continue
+        for case_insensitive in (False, True):
+            repat = re.compile(
+                query,
+                re.IGNORECASE if case_insensitive else 0,
+            )
+            for reverse in (False, True):
+                desc = ' '.join(
+                    flag
+                    for flag, used in (
+                        (repr(query), True),
+                        ('-a', all_patterns),
+                        ('-x', case_insensitive),
+                        ('-r', reverse),
+                    )
+                    if used
+                )
+                found = {}
+                for label, pattern in (
+                        ('regex', repat),
+                        ('QueryMatcher', apttool.QueryMatcher(
+                            repat,
+                            literals,
+                        ))):
+                    aptfilter = apttool.AptToolFilter(
+                        pattern,
+                        reverse=reverse,
+                    )
+                    matches = []
+                    print_result(
+                        '{}, {}'.format(desc, label),
+                        timed(
+                            lambda: matches.extend(
+                                pkgrec for pkgrec in records
+                                if aptfilter.matches(pkgrec)
+                            )
+                        ),
+                    )
+                    found[label] = matches
+                if found['regex'] != found['QueryMatcher']:
+                    print(C('Results are not the same!', 'red'))
+                    errs += 1
+    return errs
+
+
+def bench_startup(runcnt):
+    """ Time apttool's startup for a few commands: module imports, the
+        first byte of output, and the whole run.
+        Commands that shouldn't need apt are counted as errors if they
+        import it.
+    """
+    errs = 0
+    for args, uses_apt in STARTUP_CMDS:
+        cmdstr = ' '.join(args)
+        importsecs, modules = startup_imports(args)
+        firsts = []
+        totals = []
+        for _ in range(runcnt):
+            first, total = startup_times(args)
+            firsts.append(first)
+            totals.append(total)
+        print_result('{}: imports'.format(cmdstr), importsecs)
+        print_result('{}: first output (best)'.format(cmdstr), min(firsts))
+        print_result('{}: total (best)'.format(cmdstr), min(totals))
+        print('    Imported: {}'.format(', '.join(modules) or 'none'))
+        if ('apt' in modules) and not uses_apt:
+            print(C('    apt was imported, but is not needed!', 'red'))
+            errs += 1
+    return errs
+
+
+def corpus_load(filename=None):
+    """ Load PackageRecords from a corpus file, recording it from the apt
+        cache first if it doesn't exist.
+        Without a file name, records are built from the apt cache.
+    """
+    if filename and os.path.exists(filename):
+        with open(filename, 'r') as f:
+            return [apttool.PackageRecord(*json.loads(line)) for line in f]
+    apttool.cache_load()
+    records = apttool.SearchIndex.from_cache(apttool.cache_main)
+    if filename:
+        with open(filename, 'w') as f:
+            for pkgrec in records:
+                f.write(json.dumps(pkgrec))
+                f.write('\n')
+    return list(records)
+
+
+def first_matches(logname, repat, count):
+    """ Return the first `count` matching HistoryLines, like cmd_history. """
+    found = []
+    for historyline in apttool.iter_history(logname, repat=repat):
+        if historyline.matches(repat):
+            found.append(historyline)
+            if len(found) >= count:
+                break
+    return found
+
+
+def format_size(size):
+    """ Format a byte size for humans. """
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024
+    return '{:.1f}GB'.format(size)
+
+
+def history_matches(line, repat):
+    """ Parse a line without prefiltering, and test it against `repat`. """
+    historyline = apttool.HistoryLine.from_dpkg_line(line)
+    return (historyline is not None) and historyline.matches(repat)
+
+
+def print_result(label, seconds):
+    """ Print a single benchmark result. """
+    print('{:<60} {}'.format(
+        C(label, 'cyan'),
+        C('{:>9.3f}s'.format(seconds), 'blue', style='bright'),
+    ))
+
+
+def startup_cmd(args, *pyargs):
+    """ Return a command line to run apttool.py with `args`. """
+    return [sys.executable] + list(pyargs) + [apttool.__file__] + list(args)
+
+
+def startup_imports(args):
+    """ Run apttool with `python -X importtime`, and return a tuple of
+        (seconds, lazy_modules), where seconds is the total time spent on
+        top-level imports and lazy_modules are the STARTUP_LAZY_MODULES
+        that were imported.
+    """
+    proc = subprocess.run(
+        startup_cmd(args, '-X', 'importtime'),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    total = 0
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            _self, cumulative, name = line[12:].split('|')
+            cumulative = int(cumulative)
+        except ValueError:
+            # Header line.
+            continue
+        if not name.startswith('  '):
+            # Nested imports are already counted in the cumulative time.
+            total += cumulative
+        modules.add(name.strip().split('.')[0])
+    return (
+        total / 1000000,
+        [name for name in STARTUP_LAZY_MODULES if name in modules],
+    )
+
+
+def startup_times(args):
+    """ Run apttool with output going to a pipe, and return a tuple of
+        (first_output_seconds, total_seconds).
+    """
+    start = perf_counter()
+    proc = subprocess.Popen(
+        startup_cmd(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    proc.stdout.read(1)
+    first = perf_counter() - start
+    proc.stdout.read()
+    proc.wait()
+    return first, perf_counter() - start
+
+
+def synthetic_records(reccnt):
+    """ Return a list of PackageRecords that look like real search results.
+    """
+    desc = ' '.join((
+        'This is a synthetic package description, with about as many words',
+        'as a real one. It spans a few lines when it is formatted, and is',
+        'cut off when it is too long to fit in two lines of the terminal.',
+    ))
+    return [
+        apttool.PackageRecord(
+            'libfoo{}-dev'.format(i),
+            (i % 3) == 0,
+            '1.{}-{}'.format(i % 97, i % 5),
+            'Synthetic package {}'.format(i),
+            desc,
+        )
+        for i in range(reccnt)
+    ]
+
+
+def synthetic_rank_records(reccnt):
+    """ Return a list of PackageRecords with names and descriptions made
+        from a shared vocabulary, where some words are much more common
+        than others (like real descriptions).
+    """
+    rand = random.Random(reccnt)
+    common = [
+        'library', 'development', 'files', 'python', 'module', 'data',
+        'tool', 'ssl', 'support', 'documentation', 'server', 'client',
+    ]
+    syllables = ('ba', 'co', 'de', 'fi', 'gu', 'ka', 'lo', 'mi', 'ne', 'po',
+                 'ra', 'si', 'tu', 'vo', 'xe', 'zy')
+    words = common + [
+        ''.join(rand.choice(syllables) for _ in range(rand.randint(2, 4)))
+        for _ in range(20000)
+    ]
+    # Cumulative weights, so random.choices() doesn't add them up each time.
+    cumweights = list(accumulate(1 / (i + 1) for i in range(len(words))))
+    prefixes = ('', '', 'lib', 'python3-', 'golang-', 'node-', 'r-cran-')
+    suffixes = ('', '', '', '-dev', '-doc', '-common', '-data', '-utils')
+    records = []
+    for i in range(reccnt):
+        name = '{}{}{}{}'.format(
+            rand.choice(prefixes),
+            rand.choice(words[len(common):]),
+            rand.choice(('', '', str(i % 10))),
+            rand.choice(suffixes),
+        )
+        desctext = rand.choices(
+            words,
+            cum_weights=cumweights,
+            k=rand.randint(20, 80),
+        )
+        records.append(apttool.PackageRecord(
+            name,
+            (i % 5) == 0,
+            '1.{}-{}'.format(i % 97, i % 5),
+            ' '.join(
+                rand.choices(words, cum_weights=cumweights, k=5)
+            ).capitalize(),
+            ' '.join(desctext),
+        ))
+    return records
+
+
+def timed(func, *args, **kwargs):
+    """ Run a function and return the number of seconds it took. """
+    start = perf_counter()
+    func(*args, **kwargs)
+    return perf_counter() - start
+
+
+def timed_pipe(func, line_buffering=False, **kwargs):
+    """ Run a function with a text file that writes to a pipe, while another
+        thread reads everything from the pipe.
+        Returns the number of seconds it took.
+    """
+    readfd, writefd = os.pipe()
+
+    def drain():
+        while os.read(readfd, 1048576):
+            pass
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+    try:
+        with open(writefd, 'w', buffering=1 if line_buffering else -1) as f:
+            elapsed = timed(func, f, **kwargs)
+    finally:
+        reader.join()
+        os.close(readfd)
+    return elapsed
+
+
+def write_dpkg_log(filename, linecnt):
+    """ Write a synthetic dpkg.log, with the same kinds of lines (and about
+        the same mix of them) that a real one has.
+    """
+    pkgnames = ['libfoo{}'.format(i) for i in range(2000)]
+    pkgnames.extend(('libssl3', 'openssl', 'bash', 'python3', 'zlib1g'))
+    statuses = (
+        'half-installed',
+        'unpacked',
+        'half-configured',
+        'installed',
+    )
+    when = datetime(2015, 1, 1)
+    with open(filename, 'w') as f:
+        i = 0
+        while i < linecnt:
+            when += timedelta(seconds=7)
+            timestr = when.strftime('%Y-%m-%d %H:%M:%S')
+            pkgname = '{}:amd64'.format(pkgnames[i % len(pkgnames)])
+            version = '1.{}-{}'.format(i % 97, i % 5)
+            lines = [
+                '{} startup archives unpack'.format(timestr),
+                '{} {} {} {} {}'.format(
+                    timestr,
+                    'upgrade' if i % 3 else 'install',
+                    pkgname,
+                    '<none>' if i % 3 == 0 else '1.0-1',
+                    version,
+                ),
+            ]
+            lines.extend(
+                '{} status {} {} {}'.format(timestr, status, pkgname, version)
+                for status in statuses
+            )
+            lines.append('{} configure {} {} <none>'.format(
+                timestr,
+                pkgname,
+                version,
+            ))
+            for line in lines[:linecnt - i]:
+                f.write(line)
+                f.write('\n')
+            i += len(lines)
+
+
+if __name__ == '__main__':
+    try:
+        mainret = main(docopt(USAGESTR, version=__version__, script=SCRIPT))
+    except KeyboardInterrupt:
+        print('\nUser cancelled.\n', file=sys.stderr)
+        mainret = 2
+    sys.exit(mainret)
@@ -7,16 +7,25 @@
     Revisited: 4-7-2019
 """
 
-from collections import namedtuple, UserList
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque, namedtuple, OrderedDict, UserList
 from contextlib import suppress
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
+from functools import wraps
+from itertools import compress, repeat
+from io import StringIO
+import marshal
+import math
 import os
 import re
+import signal
 import stat
 import struct
 import sys
-from time import time
+from time import perf_counter, time
+from types import GeneratorType
 
 
 def import_err(name, exc, module=None):
@@ -57,38 +66,24 @@ def import_err(name, exc, module=None):
 
 
 try:
-    import apt                        # apt tools
-    import apt.progress.text          # apt tools
-except ImportError as ex:
-    import_err('apt', ex)
-try:
-    import apt_pkg                    # for IterCache()
-    from apt_pkg import gettext as _  # for IterCache()
-except ImportError as ex:
-    import_err('apt_pkg', ex)
-
-try:
-    from colr import (
-        auto_disable as colr_auto_disable,
-        Colr,
-        disable as colr_disable,
-        docopt,
-        strip_codes,
-        AnimatedProgress,
-        Frames,
-    )
-    # Aliased for easier typing and shorter lines.
-    C = Colr
-except ImportError as excolr:
-    import_err('Colr', excolr)
-
-try:
-    from fmtblock import FormatBlock
-except ImportError as exfmtblk:
-    import_err('FormatBlock', exfmtblk, module='formatblock')
+    from docopt import docopt as docopt_plain
+except ImportError as exdocopt:
+    import_err('docopt', exdocopt)
+
+# These are slow to import, and not every command needs them.
+# They are imported on first use, see apt_load(), colr_load(), and
+# formatblock_load().
+apt = None
+apt_pkg = None
+colr = None
+FormatBlock = None
 
 # ------------------------------- End Imports -------------------------------
 
+# Start of the 'module' phase when profiling, defining everything below
+# (see Profiler).
+MODULE_START = perf_counter()
+
 __version__ = '1.0.0'
 
 NAME = 'AptTool'
@@ -100,15 +95,29 @@ USAGESTR = """{name} v. {version}
 
     Usage:
         {script} -? | -h | -v
-        {script} -c file [-C] [-n] [-q]
-        {script} (-i | -d | -p) PACKAGES... [-C] [-q]
-        {script} (-e | -f | -S) PACKAGES... [-C] [-q] [-s]
-        {script} (-P | -R) PACKAGES... [-C] [-I | -N] [-q] [-s]
-        {script} -H [QUERY] [COUNT] [-C] [-q]
-        {script} (-l | -L) PACKAGES... [-C] [-q] [-s]
-        {script} -u [-C] [-q]
-        {script} -V PACKAGES... [-C] [-a] [-q] [-s]
+        {script} -c file [-C] [-n] [-q] [--format fmt] [--noindex] [-j num]
+                         [--profile]
+        {script} (-i | -d | -p) PACKAGES... [-C] [-q] [--profile]
+        {script} (-e | -f | -S) PACKAGES... [-C] [-q] [-s] [--profile]
+        {script} -P PACKAGES... [-C] [-I | -N] [-q] [-s] [--format fmt]
+                                [--recursive] [--profile]
+        {script} -R PACKAGES... [-C] [-I | -N] [-q] [-s] [--depth N]
+                                [--format fmt] [--profile]
+        {script} -H [QUERY] [COUNT] [-C] [-q] [--since time] [--until time]
+                    [--package name] [--action name | --transactions]
+                    [--format fmt] [--profile]
+        {script} (-l [--missing] | -L) PACKAGES... [-C] [-q] [-s] [--bulk]
+                                                   [--format fmt] [--profile]
+        {script} -u [-C] [-q] [--profile]
+        {script} --upgradable [-C] [-I | -N] [-q] [-s] [--format fmt]
+                              [--profile]
+        {script} --serve [-q]
+        {script} -V PACKAGES... [-C] [-a] [-q] [-s] [--table] [--format fmt]
+                                [--profile]
         {script} PATTERNS... [-a] [-C] [-I | -N] [-D] [-n] [-q] [-r] [-s] [-x]
+                             [-j num] [--format fmt] [--profile]
+        {script} --rank PATTERNS... [-C] [-I | -N] [-q] [-s] [-t num]
+                                    [--format fmt] [--profile]
 
     Options:
         COUNT                        : Number of history lines to return.
@@ -129,21 +138,48 @@ USAGESTR = """{name} v. {version}
                                        they must all be found in the exact
                                        argument order.
                                        Like doing (arg1)(.+)?(arg2).
+        --action name                : When showing history, only show
+                                       entries for an action (install,
+                                       upgrade, remove, purge, configure,
+                                       trigproc), or a status (installed,
+                                       unpacked, etc.).
         -c file,--containsfile file  : Search all installed packages for an
                                        installed file using regex or text.
+        --bulk                       : When locating, only check package
+                                       names, and print the names instead of
+                                       package info. Names are checked
+                                       against a set of all package names
+                                       (including name:arch), as they are
+                                       read, for long lists of names.
         -C,--nocolor                 : Disable colors always.
         -d,--delete                  : Uninstall/delete/remove a package.
         -D,--dev                     : Search for development packages.
+        --depth N                    : When showing reverse dependencies,
+                                       also show dependents of dependents,
+                                       up to N levels deep.
+                                       [default: 1]
         -e,--executables             : Show installed executables for a
                                        package.
                                        It just shows files installed to
                                        /bin directories.
         -f,--files                   : Show installed files for package.
+        --format fmt                 : Print machine-readable records instead
+                                       of formatted results, one record per
+                                       result. Status messages are not
+                                       printed.
+                                       Formats: jsonl, nul, tsv
         -?,--examples                : Show specific usage examples and exit.
         -h,--help                    : Show this help message and exit.
         -H,--history                 : Show package history.
                                        (installs, uninstalls, etc.)
         -i,--install                 : Install a package.
+                                       Multiple packages are installed with a
+                                       single download and dpkg run.
+        -j num,--jobs num            : Number of processes to use when
+                                       searching, or when reading file lists
+                                       with --noindex. Use 0 for one process
+                                       per CPU.
+                                       [default: 1]
         -I,--INSTALLED               : When searching for a package, only
                                        include installed packages.
         -l,--locate                  : Determine whether or not a package
@@ -153,18 +189,40 @@ USAGESTR = """{name} v. {version}
                                        needed. Multiple names can be passed.
         -L,--LOCATE                  : Same as --locate, but only shows
                                        existing packages that are found.
+        --missing                    : When locating, only show packages
+                                       that are not found.
         -n,--names                   : When searching for packages, only
                                        search names, not descriptions.
                                        When searching with -c, don't use the
                                        full file path, only the file name.
         -N,--NOTINSTALLED            : When searching for a package, only
                                        include non-installed packages.
+        --noindex                    : When searching with -c, read dpkg's
+                                       file lists directly instead of using
+                                       the saved file index, and don't load
+                                       the apt cache.
+        --package name               : When showing history, only show
+                                       entries for a package. Use name:arch
+                                       for a single architecture.
         -p,--purge                   : Purge the package completely,
                                        remove all configuration.
         -P,--dependencies            : List all dependencies for a package.
+        --profile                    : Time each phase of the command, count
+                                       calls to hot functions, and print a
+                                       JSON report to stderr.
+                                       APTTOOL_TRACE=file writes it to a
+                                       file instead (APTTOOL_TRACE=1 works
+                                       like --profile). APTTOOL_PSTATS=file
+                                       also saves cProfile stats.
         -q,--quiet                   : Don't print extra status messages.
         -r,--reverse                 : When searching, return packages that
                                        DON'T match.
+        --rank                       : Search names and descriptions for
+                                       words, and show the best matches
+                                       first. Every word must be found.
+        --recursive                  : With -P, list every package that is
+                                       needed, directly or through other
+                                       dependencies, with totals.
         -R,--reversedeps             : Show reverse dependencies.
         -s,--short                   : Use shorter output.
                                        When searching, don't print the
@@ -172,8 +230,45 @@ USAGESTR = """{name} v. {version}
                                        When locating, don't show the install
                                        state.
         -S,--suggests                : Show package suggestions.
+        --since time                 : When showing history, only show
+                                       entries at or after a time, like:
+                                       2024-01-31 or '2024-01-31 13:00'
+        --table                      : When viewing package versions, show
+                                       a compact table for all packages, with
+                                       installed, candidate, latest, and
+                                       backports versions, and whether an
+                                       upgrade is available.
+                                       With -a, show a row for every
+                                       available version.
+        --transactions               : When showing history, group entries
+                                       into transactions (dpkg runs that
+                                       are less than a minute apart), and
+                                       show how many packages each one
+                                       installed, upgraded, and removed.
+                                       Totals, the most changed packages,
+                                       and upgrades per day are also shown.
+                                       QUERY, COUNT, and --package select
+                                       the transactions to show.
+        -t num,--top num             : Number of results to show when
+                                       ranking search results.
+                                       [default: 25]
+        --serve                      : Keep the apt cache loaded, and answer
+                                       searches and other cache queries for
+                                       other apttool commands.
+                                       It is reloaded when apt/dpkg state
+                                       files change.
+        --until time                 : When showing history, only show
+                                       entries at or before a time.
+                                       A date includes the whole day.
         -u,--update                  : Update the cache.
                                        ..Just like `apt-get update`.
+        --upgradable                 : List installed packages that have a
+                                       newer version available, with the
+                                       origin of the new version.
+                                       With -I, only list packages that are
+                                       fully installed. With -N, only list
+                                       packages that dpkg has not finished
+                                       installing (unpacked, etc.).
         -v,--version                 : Show version and exit.
         -V,--VERSION                 : Show a package's installed or available
                                        versions.
@@ -190,8 +285,30 @@ class NothingSingleton(object):
 Nothing = NothingSingleton()
 
 # GLOBALS ------------------------------------------------
+# placeholder for backports package file ids (see backport_files_load()).
+backport_files_main = None
 # placeholder for global cache
 cache_main = None
+# placeholder for the dependency graph (see depgraph_load()).
+depgraph_main = None
+# placeholder for package names (see pkg_names_load()).
+pkg_names_main = None
+# placeholder for the reverse dependency graph (see rdepends_load()).
+rdepends_main = None
+# placeholder for the ranked search index (see rank_load()).
+rank_main = None
+# (SearchIndex, AptToolFilter) snapshot for search worker processes.
+search_snapshot = None
+# Formatted packages, least recently used first (see pkg_format()).
+pkg_format_cache = OrderedDict()
+# Memoized package info for the current cache load, by Package.id.
+# See pkg_memo() and pkg_memo_clear().
+pkg_memos = {
+    'description': {},
+    'installed': {},
+    'summary': {},
+    'version': {},
+}
 
 # Tuple for dependency_info() returns.
 DependencyInfo = namedtuple(
@@ -199,6 +316,86 @@ DependencyInfo = namedtuple(
     ('package', 'version', 'relation')
 )
 
+# Tuple for SearchIndex entries, used in place of a Package when searching.
+PackageRecord = namedtuple(
+    'PackageRecord',
+    ('name', 'installed', 'version', 'summary', 'description')
+)
+
+# Tuple for query_literals() returns.
+QueryLiterals = namedtuple(
+    'QueryLiterals',
+    ('literals', 'all_required')
+)
+
+# Directory for persistent indexes (rebuilt when apt/dpkg state changes).
+INDEX_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', None) or os.path.expanduser('~/.cache'),
+    'apttool',
+)
+# Increment this when the layout of any persistent index changes.
+INDEX_VERSION = 6
+# Tag for arrays in persistent indexes, which marshal can't save as-is
+# (see index_pack()).
+INDEX_ARRAY_TAG = '__array__'
+
+# Where dpkg keeps the *.list files for installed packages.
+DPKG_INFO_DIR = '/var/lib/dpkg/info'
+# dpkg's database of package states/versions.
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# dpkg's log file, rotated logs are named dpkg.log.1, dpkg.log.2.gz, etc.
+DPKG_LOG = '/var/log/dpkg.log'
+# Seconds between dpkg.log entries that start a new transaction
+# (see iter_history_transactions()).
+HISTORY_TRANSACTION_GAP = 60
+
+# Tokens for ranked searches (--rank), from lowercase names/descriptions.
+RANK_TOKEN_PAT = re.compile(r'[a-z0-9][a-z0-9+]*')
+
+# Where apt keeps the downloaded package lists.
+APT_LISTS_DIR = '/var/lib/apt/lists'
+
+# Files/directories that change when the package cache or install states do.
+APT_STATE_FILES = (
+    '/var/cache/apt/pkgcache.bin',
+    APT_LISTS_DIR,
+    DPKG_STATUS,
+)
+
+# Unix socket for the apttool daemon (see cmd_serve()).
+DAEMON_SOCKET = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR', None) or INDEX_DIR,
+    'apttool.sock',
+)
+# Seconds between apt/dpkg state checks while the daemon is idle.
+DAEMON_POLL = 2
+# Options that the daemon can answer, (read-only cache queries).
+# Searches (PATTERNS) are also answered by the daemon.
+DAEMON_OPTS = (
+    '--containsfile',
+    '--dependencies',
+    '--executables',
+    '--files',
+    '--locate',
+    '--LOCATE',
+    '--reversedeps',
+    '--suggests',
+    '--upgradable',
+    '--VERSION',
+)
+
+# Characters of output to buffer before writing, when stdout is not a tty.
+OUTPUT_BUFSIZE = 65536
+# Maximum number of seconds to hold buffered output.
+OUTPUT_INTERVAL = 0.5
+# Number of packages to search between checks for buffered output that has
+# been held too long (see AptToolFilter.apply()).
+OUTPUT_POLL_COUNT = 1000
+
+# Maximum number of formatted packages to keep (see pkg_format()).
+PKG_FORMAT_CACHE_SIZE = 4096
+
 # Set default terminal width/height (set with get_terminal_size() later).
 TERM_WIDTH, TERM_HEIGHT = 80, 120
 
@@ -206,19 +403,66 @@ TERM_WIDTH, TERM_HEIGHT = 80, 120
 # MAIN ---------------------------------------------------
 def main(argd):
     """ Main entry point for apttool """
-    global cache_main, oprogress, fprogress, print_status, print_status_err
+    global cache_main, print_status, print_status_err
     if argd['--nocolor']:
         colr_disable()
     if argd['--quiet']:
         print_status = print_status_err = noop
+    elif argd['--format']:
+        # Status messages would be mixed in with the records.
+        print_status = noop
     # Non-cache related args.
     if argd['--examples']:
         print_example_usage()
         return 0
+    if argd['--serve']:
+        return cmd_serve()
+    if argd['--format'] and (argd['--format'] not in RecordWriter.formats):
+        print_err(
+            '\nInvalid format: {}\nExpecting one of: {}'.format(
+                argd['--format'],
+                ', '.join(RecordWriter.formats),
+            )
+        )
+        return 1
+
+    jobs = argd['--jobs']
+    try:
+        jobs = int(jobs)
+        if jobs < 0:
+            raise ValueError('Must be 0 or greater!')
+    except (TypeError, ValueError) as exint:
+        print_err(
+            '\nInvalid number for jobs: {}\n{}'.format(jobs, exint)
+        )
+        return 1
+    jobs = jobs or os.cpu_count() or 1
 
     # Search.
     if argd['PATTERNS']:
+        if argd['--rank']:
+            top = argd['--top']
+            try:
+                top = int(top)
+                if top < 1:
+                    raise ValueError('Must be greater than 0!')
+            except (TypeError, ValueError) as exint:
+                print_err(
+                    '\nInvalid number for top: {}\n{}'.format(top, exint)
+                )
+                return 1
+            return cmd_rank(
+                argd['PATTERNS'],
+                install_state=InstallStateEnum.from_argd(argd),
+                top=top,
+                print_no_desc=argd['--short'],
+                fmt=argd['--format'],
+            )
         query = query_build(argd['PATTERNS'], all_patterns=argd['--all'])
+        literals = query_literals(
+            argd['PATTERNS'],
+            all_patterns=argd['--all'],
+        )
         return cmd_search(
             query,
             use_desc=not argd['--names'],
@@ -226,7 +470,10 @@ def main(argd):
             install_state=InstallStateEnum.from_argd(argd),
             case_insensitive=argd['--ignorecase'],
             dev_only=argd['--dev'],
-            reverse=argd['--reverse']
+            reverse=argd['--reverse'],
+            jobs=jobs,
+            fmt=argd['--format'],
+            literals=literals,
         )
 
     if argd['--history']:
@@ -243,7 +490,64 @@ def main(argd):
                 )
                 return 1
 
-        return cmd_history(argd['QUERY'], count=cnt)
+        times = {}
+        for opt in ('--since', '--until'):
+            if not argd[opt]:
+                continue
+            try:
+                times[opt] = parse_time_arg(
+                    argd[opt],
+                    end=(opt == '--until'),
+                )
+            except ValueError as extime:
+                print_err('\nInvalid time for {}: {}\n{}'.format(
+                    opt,
+                    argd[opt],
+                    extime,
+                ))
+                return 1
+
+        if argd['--transactions']:
+            return cmd_history_transactions(
+                argd['QUERY'],
+                count=cnt,
+                fmt=argd['--format'],
+                since=times.get('--since', None),
+                until=times.get('--until', None),
+                package=argd['--package'],
+            )
+        return cmd_history(
+            argd['QUERY'],
+            count=cnt,
+            fmt=argd['--format'],
+            since=times.get('--since', None),
+            until=times.get('--until', None),
+            package=argd['--package'],
+            action=argd['--action'],
+        )
+
+    if argd['--containsfile'] and argd['--noindex']:
+        # Installed files/versions are read straight from dpkg's files.
+        return cmd_contains_file(
+            argd['--containsfile'],
+            shortnamesonly=argd['--names'],
+            fmt=argd['--format'],
+            noindex=True,
+            jobs=jobs,
+        )
+
+    if argd['--reversedeps']:
+        depth = argd['--depth']
+        try:
+            depth = int(depth)
+            if depth < 1:
+                raise ValueError('Must be greater than 0!')
+        except (TypeError, ValueError) as exint:
+            print_err(
+                '\nInvalid number for depth: {}\n{}'.format(depth, exint)
+            )
+            return 1
+        argd['--depth'] = depth
 
     # -----v-- Actions that may benefit from cache pre-loading --v------
     return run_preload_cmd(argd)
@@ -257,6 +561,38 @@ def noop(*args, **kwargs):
     return None
 
 
+def apt_load():
+    """ Import python-apt's `apt` and `apt_pkg` modules, if they haven't been
+        imported yet, and apply the apt.Cache.get() monkey patch.
+        Returns the `apt` module.
+    """
+    global apt, apt_pkg
+    if apt is None:
+        try:
+            import apt
+            import apt.progress.text
+            import apt_pkg
+        except ImportError as ex:
+            import_err('apt', ex)
+        apt.Cache.get = cache_get
+    return apt
+
+
+def backport_files_load():
+    """ Load the ids of package files (Packages indexes) that come from a
+        backports archive, setting global `backport_files_main`.
+        Returns `backport_files_main`.
+    """
+    global backport_files_main
+    if backport_files_main is None:
+        backport_files_main = {
+            pkgfile.id
+            for pkgfile in cache_main._cache.file_list
+            if (pkgfile.archive or '').endswith('backports')
+        }
+    return backport_files_main
+
+
 def cache_get(self, item, default=Nothing):
     """ Supplies Cache.get()
         To monkeypatch apt.Cache to act like a dict with .get()
@@ -278,11 +614,47 @@ def cache_load(forced=False):
     """
     global cache_main
     if forced or (cache_main is None):
-        cache_main = apt.Cache(memonly=True)
+        cache_main = apt_load().Cache(memonly=True)
+        cache_reset()
     return cache_main
 
 
-def cmd_contains_file(name, shortnamesonly=False):
+def cache_reset():
+    """ Forget everything that was built from the old `cache_main`, after
+        it is loaded again or reopened.
+    """
+    global backport_files_main, depgraph_main, pkg_names_main
+    global rdepends_main
+    backport_files_main = None
+    depgraph_main = None
+    pkg_names_main = None
+    rdepends_main = None
+    pkg_memo_clear()
+
+
+def call_with_spinner(func, *args, **kwargs):
+    """ Call a function while showing the 'Loading APT Cache...' spinner,
+        if stdout is a tty.
+        Returns the function's result.
+    """
+    if not sys.stdout.isatty():
+        # No animated spinner, stdout is not a tty.
+        return func(*args, **kwargs)
+    colr_load()
+    spinner = colr.AnimatedProgress(
+        'Loading APT Cache...',
+        fmt=' {frame} {elapsed:<2.0f}s {text}',
+        frames=colr.Frames.dots_orbit.as_gradient(
+            name='blue',
+            style='bright',
+        ),
+    )
+    with spinner:
+        return func(*args, **kwargs)
+
+
+def cmd_contains_file(
+        name, shortnamesonly=False, fmt=None, noindex=False, jobs=1):
     """ Search all installed files for a filename.
         Print packages containing matches.
         Arguments:
@@ -291,6 +663,14 @@ def cmd_contains_file(name, shortnamesonly=False):
         Keyword Arguments:
             shortnamesonly  : don't include the full path in search,
                               just the short file name.
+            fmt             : RecordWriter format, to print one record per
+                              matching file instead of formatted results.
+            noindex         : Scan dpkg's *.list files instead of using the
+                              FileIndex, and get install states/versions
+                              from dpkg's status file instead of the apt
+                              cache.
+            jobs            : Number of processes to scan list files with,
+                              when `noindex` is used.
     """
 
     try:
@@ -304,44 +684,46 @@ def cmd_contains_file(name, shortnamesonly=False):
         value=repat.pattern,
     )
 
-    # Setup filename methods (long or short, removes an 'if' from the loop.)
-    def getfilenameshort(s):
-        return os.path.split(s)[-1]
-    # Pick filename retrieval function..
-    filenamefunc = getfilenameshort if shortnamesonly else str
-
-    # Iterate all packages...
+    # Iterate all packages with matching files...
     totalpkgs = 0
     totalfiles = 0
-
-    for pkgname in cache_main.keys():
-        pkg = cache_main[pkgname]
-        matchingfiles = []
-        if not pkg_install_state(pkg):
+    matchingpkgs = []
+    if noindex:
+        versions = dpkg_installed_versions()
+        for listname, matchingfiles in list_files_scan(
+                repat, shortnamesonly=shortnamesonly, jobs=jobs):
+            pkgname = strip_arch(listname)
+            pkgver = versions.get(listname, versions.get(pkgname, None))
+            if pkgver is None:
+                continue
+            pkg = PackageRecord(pkgname, True, pkgver, '', '')
+            matchingpkgs.append((pkg, matchingfiles))
+    else:
+        fileindex = FileIndex.load()
+        for listname, matchingfiles in fileindex.search(
+                repat, shortnamesonly):
+            pkg = cache_main.get(strip_arch(listname), None)
+            if (pkg is None) or (not pkg_install_state(pkg)):
+                continue
+            # The files came from the installed version, not the latest one
+            # (the same version --noindex gets from dpkg).
+            pkg = PackageRecord(pkg.name, True, pkg.installed.version, '', '')
+            matchingpkgs.append((pkg, matchingfiles))
+
+    # Report any matches, in the same order as the cache.
+    writer = RecordWriter(fmt, ('name', 'version', 'file')) if fmt else None
+    for pkg, matchingfiles in sorted(matchingpkgs, key=lambda p: p[0].name):
+        totalpkgs += 1
+        totalfiles += len(matchingfiles)
+        if writer is not None:
+            pkgver = get_latest_ver(pkg)
+            for filename in matchingfiles:
+                writer.write(pkg.name, pkgver, filename)
             continue
-        if not hasattr(pkg, 'installed_files'):
-            print_err(
-                '\n'.join((
-                    '\nUnable to retrieve installed files for {},',
-                    'apt/apt_pkg may be out of date!'
-                )).format(pkgname)
-            )
-            return 1
-
-        for installedfile in (pkg.installed_files or []):
-            shortname = filenamefunc(installedfile)
-            rematch = repat.search(shortname)
-            if rematch:
-                # Save match for report,
-                # (report when we're finished with this package.)
-                matchingfiles.append(installedfile)
-
-        # Report any matches.
-        if matchingfiles:
-            totalpkgs += 1
-            totalfiles += len(matchingfiles)
-            print(pkg_format(pkg, no_desc=True, no_marker=True))
-            print('    {}'.format('\n    '.join(matchingfiles)))
+        print(pkg_format(pkg, no_desc=True, no_marker=True))
+        print('    {}'.format('\n    '.join(matchingfiles)))
+    if writer is not None:
+        writer.flush()
 
     pluralfiles = 'file' if totalfiles == 1 else 'files'
     pluralpkgs = 'package.' if totalpkgs == 1 else 'packages.'
@@ -356,7 +738,7 @@ def cmd_contains_file(name, shortnamesonly=False):
     return 0
 
 
-def cmd_dependencies(pkgname, installstate=None, short=False):
+def cmd_dependencies(pkgname, installstate=None, short=False, fmt=None):
     """ Print all dependencies for a package.
         Optionally, filter by installed or uninstalled.
         Arguments:
@@ -364,6 +746,8 @@ def cmd_dependencies(pkgname, installstate=None, short=False):
             installstate  : InstallStateEnum, to filter dependency list.
                             Default: InstallStateEnum.every
             short         : Use shorter output.
+            fmt           : RecordWriter format, to print records instead
+                            of formatted results.
     """
     status = noop if short else print_status
     installstate = installstate or InstallStateEnum.every
@@ -373,6 +757,19 @@ def cmd_dependencies(pkgname, installstate=None, short=False):
         print_err('\nCan\'t find a package by that name: {}'.format(pkgname))
         return 1
 
+    writer = None
+    if fmt:
+        writer = RecordWriter(
+            fmt,
+            (
+                'package',
+                'package_version',
+                'name',
+                'relation',
+                'version',
+                'installed',
+            ),
+        )
     totalstate = 0
     total = 0
     for pkgver in package.versions:
@@ -385,6 +782,20 @@ def cmd_dependencies(pkgname, installstate=None, short=False):
             total += 1
             for dep in installstate.filter_pkgs(deplst):
                 depinfo = dependency_info(dep, default=dep.name)
+                totalstate += 1
+                if writer is not None:
+                    writer.write(
+                        package.name,
+                        pkgver.version,
+                        dep.name,
+                        depinfo.relation,
+                        depinfo.version,
+                        (
+                            None if isinstance(depinfo.package, str)
+                            else pkg_install_state(depinfo.package)
+                        ),
+                    )
+                    continue
                 print(
                     pkg_format(
                         depinfo.package,
@@ -394,7 +805,8 @@ def cmd_dependencies(pkgname, installstate=None, short=False):
                         use_relation=depinfo.relation,
                     )
                 )
-                totalstate += 1
+    if writer is not None:
+        writer.flush()
 
     if installstate == InstallStateEnum.every:
         status('\nTotal: {}'.format(total))
@@ -404,9 +816,110 @@ def cmd_dependencies(pkgname, installstate=None, short=False):
     return 0 if totalstate > 0 else 1
 
 
-def cmd_history(filtertext=None, count=None):
+def cmd_dependency_closure(
+        pkgnames, installstate=None, short=False, fmt=None):
+    """ Print every package that one or more packages need, directly or
+        through other dependencies (-P --recursive), with totals for all of
+        them together.
+        Arguments:
+            pkgnames      : List of package names.
+            installstate  : InstallStateEnum, to filter the printed list.
+                            Totals always include every package.
+                            Default: InstallStateEnum.every
+            short         : Use shorter output.
+            fmt           : RecordWriter format, to print records instead
+                            of formatted results.
+    """
+    status = noop if short else print_status
+    installstate = installstate or InstallStateEnum.every
+    graph = depgraph_load()
+    errs = 0
+    rootids = []
+    for pkgname in pkgnames:
+        pkgid = graph.ids.get(pkgname, None)
+        if pkgid is None:
+            print_err(
+                '\nCan\'t find a package by that name: {}'.format(pkgname)
+            )
+            errs += 1
+            continue
+        rootids.append(pkgid)
+    if not rootids:
+        return errs
+
+    status('\n{} recursive dependencies for {}'.format(
+        str(installstate).title(),
+        ', '.join(graph.names[i] for i in rootids),
+    ))
+    closure, cycles = graph.closure(rootids)
+    output = OutputBuffer()
+    writer = None
+    if fmt:
+        writer = RecordWriter(
+            fmt,
+            ('name', 'depth', 'parent', 'installed', 'version', 'size'),
+            output=output,
+        )
+    installedcnt = 0
+    downloadsize = 0
+    for pkgid, depth, parentid in closure:
+        if graph.installed[pkgid]:
+            installedcnt += 1
+        else:
+            downloadsize += graph.sizes[pkgid]
+        pkg = cache_main.get(graph.names[pkgid], None)
+        if (pkg is None) or (not installstate.matches_pkg(pkg)):
+            continue
+        if writer is None:
+            output.write('{}\n'.format(
+                pkg_format(pkg, no_ver=short, no_desc=short)
+            ))
+        else:
+            writer.write(
+                pkg.name,
+                depth,
+                graph.names[parentid],
+                pkg_install_state(pkg),
+                get_latest_ver(pkg),
+                graph.sizes[pkgid],
+            )
+    output.flush()
+
+    status(
+        '\nTotal: {}, Installed: {}, Not installed: {} {}'.format(
+            len(closure),
+            installedcnt,
+            len(closure) - installedcnt,
+            SimpleFetchProgress.format_filesize(downloadsize),
+        )
+    )
+    unresolved = sorted({
+        depname
+        for pkgid, _depth, _parentid in closure
+        for depname in graph.missing.get(pkgid, ())
+    })
+    if unresolved:
+        status('Unresolved: {}'.format(', '.join(unresolved)))
+    if cycles:
+        status('Dependency cycles: {}'.format(len(cycles)))
+        for cycle in cycles[:10]:
+            status('    {}'.format(
+                ' -> '.join(graph.names[i] for i in cycle)
+            ))
+        if len(cycles) > 10:
+            status('    ...and {} more.'.format(len(cycles) - 10))
+    return errs
+
+
+def cmd_history(
+        filtertext=None, count=None, fmt=None, since=None, until=None,
+        package=None, action=None):
     """ Search dpkg log for lines containing text, print the formatted lines.
         If filtertext is None, all lines are formatted and printed.
+        If fmt is set, RecordWriter records are printed instead.
+        If since, until, package, or action are set, the lines come from
+        the HistoryIndex instead of reading every line
+        (see HistoryIndex.positions()).
     """
     repat = None
     if filtertext is not None:
@@ -424,14 +937,50 @@ def cmd_history(filtertext=None, count=None):
             # Count is never exceeded
             return False
 
+    writer = None
+    if fmt:
+        writer = RecordWriter(
+            fmt,
+            (
+                'time',
+                'statustype',
+                'action',
+                'name',
+                'arch',
+                'version',
+                'previous_version',
+            ),
+        )
     total = 0
     try:
-        for historyline in iter_history():
+        if any((since, until, package, action)):
+            historylines = HistoryIndex.load().query(
+                since=since,
+                until=until,
+                package=package,
+                action=action,
+            )
+        else:
+            historylines = iter_history(repat=repat)
+        for historyline in historylines:
             if historyline.matches(repat):
                 total += 1
-                print(str(historyline))
+                if writer is None:
+                    print(str(historyline))
+                else:
+                    writer.write(
+                        str(historyline.time),
+                        historyline.statustype,
+                        historyline.action,
+                        historyline.name,
+                        historyline.arch,
+                        historyline.version,
+                        historyline.previous_version,
+                    )
             if cnt_exceeded(total):
                 break
+        if writer is not None:
+            writer.flush()
         entryplural = 'entry' if total == 1 else 'entries'
         print_status('\nFound {} {}.'.format(total, entryplural))
 
@@ -445,59 +994,174 @@ def cmd_history(filtertext=None, count=None):
     return True
 
 
-def cmd_install(pkgname, doupdate=False):
-    """ Install a package. """
-    print_status('\nLooking for \'{}\' to install...'.format(pkgname))
+def cmd_history_transactions(
+        filtertext=None, count=None, fmt=None, since=None, until=None,
+        package=None):
+    """ Print dpkg history grouped into transactions, latest first, with
+        totals, the most changed packages, and upgrades per day
+        (-H --transactions). The logs are only read once.
+        Returns 0 for success, 1 for error.
+        Arguments:
+            filtertext  : Regex pattern, to only show transactions with a
+                          matching package name.
+            count       : Number of transactions to show.
+            fmt         : RecordWriter format, to print records instead of
+                          formatted transactions. Totals are not printed.
+            since       : Oldest time (datetime) to include.
+            until       : Newest time (datetime) to include.
+            package     : Only show transactions that changed this package
+                          (name, or name:arch). When `filtertext` is
+                          also used, both must match.
+    """
+    repat = None
+    if filtertext is not None:
+        try:
+            repat = re.compile(filtertext)
+        except re.error as exre:
+            print_err('Invalid filter text: {}\n{}'.format(filtertext, exre))
+            return 1
+
+    # Only the transactions that are printed are kept.
+    shown = deque(maxlen=count or None)
+    totals = Counter()
+    churn = Counter()
+    dailyupgrades = Counter()
+    try:
+        for transaction in iter_history_transactions(
+                since=since,
+                until=until,
+                churn=churn,
+                dailyupgrades=dailyupgrades,
+                repat=repat,
+                package=package):
+            totals['transactions'] += 1
+            for change in ('installed', 'upgraded', 'removed'):
+                totals[change] += getattr(transaction, change)
+            if transaction.matched:
+                shown.append(transaction)
+    except (EnvironmentError, FileNotFoundError) as excancel:
+        print_err('\nUnable to retrieve history:\n    {}'.format(excancel))
+        return 1
+
+    if fmt:
+        writer = RecordWriter(
+            fmt,
+            (
+                'start',
+                'end',
+                'seconds',
+                'runs',
+                'installed',
+                'upgraded',
+                'removed',
+            ),
+        )
+        for transaction in reversed(shown):
+            writer.write(
+                str(transaction.start),
+                str(transaction.end),
+                int(transaction.duration.total_seconds()),
+                transaction.runs,
+                transaction.installed,
+                transaction.upgraded,
+                transaction.removed,
+            )
+        writer.flush()
+        return 0
+
+    for transaction in reversed(shown):
+        print(str(transaction))
+    plural = 'transaction' if len(shown) == 1 else 'transactions'
+    print_status('\nFound {} {}.'.format(len(shown), plural))
+    if not totals['transactions']:
+        return 0
+    print('\nTotal: {}, Installed: {}, Upgraded: {}, Removed: {}'.format(
+        totals['transactions'],
+        totals['installed'],
+        totals['upgraded'],
+        totals['removed'],
+    ))
+    if churn:
+        print('\nMost changed packages:')
+        namewidth = max(len(name) for name, _ in churn.most_common(10))
+        for name, changecnt in churn.most_common(10):
+            print('    {} {}'.format(name.ljust(namewidth), changecnt))
+    if dailyupgrades:
+        busiestday, busiestcnt = max(
+            dailyupgrades.items(),
+            key=lambda item: (item[1], item[0]),
+        )
+        print(
+            '\nUpgrades per day: {:.1f} ({} {}, most on {}: {})'.format(
+                sum(dailyupgrades.values()) / len(dailyupgrades),
+                len(dailyupgrades),
+                'day' if len(dailyupgrades) == 1 else 'days',
+                busiestday,
+                busiestcnt,
+            )
+        )
+    return 0
+
+
+def cmd_install(pkgnames, doupdate=False):
+    """ Install one or more packages.
+        Every package is marked first, and then all of them are installed
+        with a single commit (one download, one dpkg run).
+        Returns the number of packages that failed, as an exit status.
+        Arguments:
+            pkgnames  : Iterable of package names to install.
+            doupdate  : Update the cache first.
+    """
     if doupdate:
         updateret = cmd_update()
         if not updateret:
             print_err('\nCan\'t update cache!')
 
-    if pkgname in cache_main.keys():
-        package = cache_main[pkgname]
-        if pkg_install_state(package):
-            print_err(
-                '\nThis package is already installed: {}'.format(package.name)
-            )
-            return 1
+    requested = []
+    failures = {}
+    marked = []
+    with cache_main.actiongroup():
+        for pkgname in pkgnames:
+            requested.append(pkgname)
+            print_status('\nLooking for \'{}\' to install...'.format(pkgname))
+            package = cache_main.get(pkgname, None)
+            if package is None:
+                print_missing_pkg(pkgname)
+                failures[pkgname] = 'not found'
+                continue
+            if pkg_install_state(package):
+                print_err(
+                    '\nThis package is already installed: {}'.format(
+                        package.name
+                    )
+                )
+                failures[pkgname] = 'already installed'
+                continue
 
-        print_status('Installing package: {}'.format(package.name))
-        # Mark for install.
-        if not hasattr(package, 'mark_install'):
-            print_err(
-                '\napt_pkg doesn\'t have \'mark_install\' attribute, '
-                'apt/apt_pkg module may be out of date.\n'
-                'Stopping.')
-            return 1
-        cache_main[pkgname].mark_install()
-        # Install the package
-        try:
-            cache_main.commit(
-                fetch_progress=SimpleFetchProgress(),
-                install_progress=SimpleInstallProgress(
-                    pkgname=pkgname))
-        except apt.cache.LockFailedException as exlock:
-            print_err(
-                '\n'.join((
-                    '\nCan\'t install package!',
-                    'Make sure you have proper permissions. (are you root?)',
-                    '\nError Message:\n{}'
-                )).format(exlock))
-            return 1
-        except SystemError as exsys:
-            # dpkg is already being used by something else.
+            print_status('Installing package: {}'.format(package.name))
+            # Mark for install.
+            if not hasattr(package, 'mark_install'):
+                print_err(
+                    '\napt_pkg doesn\'t have \'mark_install\' attribute, '
+                    'apt/apt_pkg module may be out of date.\n'
+                    'Stopping.')
+                failures[pkgname] = 'apt/apt_pkg out of date'
+                continue
+            package.mark_install()
+            marked.append(pkgname)
+
+    # The resolver may have dropped marks when the actiongroup closed.
+    for pkgname in marked[:]:
+        if not cache_main[pkgname].marked_install:
             print_err(
-                '\n'.join((
-                    '\nCan\'t install package!',
-                    'Make sure all other package managers are closed.',
-                    '\nError Message:\n{}'
-                )).format(exsys))
-            return 1
+                '\nThis package can\'t be installed: {}'.format(pkgname)
+            )
+            failures[pkgname] = 'not marked for install'
+            marked.remove(pkgname)
 
-    else:
-        print_err('\nCan\'t find a package by that name: {}'.format(pkgname))
-        return 1
-    return 0
+    commit_packages(marked, failures, opstatus='Installing')
+    print_commit_report(requested, failures, 'install')
+    return len(failures)
 
 
 def cmd_installed_files(pkgname, execs_only=False, short=False):
@@ -552,15 +1216,41 @@ def cmd_installed_files(pkgname, execs_only=False, short=False):
     return 1
 
 
-def cmd_locate(pkgnames, only_existing=False, short=False):
+def cmd_locate(
+        pkgnames, only_existing=False, only_missing=False, short=False,
+        fmt=None, bulk=False):
     """ Locate one or more packages.
         Arguments:
             pkgnames       : A list of package names, or file names to read
                              from. If '-' is encountered in the list then
                              stdin is used. stdin can only be used once.
             only_existing  : Only show existing packages.
+            only_missing   : Only show missing packages.
             short          : When truthy, do not print the install state.
+            fmt            : RecordWriter format, to print records instead
+                             of formatted results.
+            bulk           : Only check names, see cmd_locate_bulk().
     """
+    if bulk:
+        return cmd_locate_bulk(
+            pkgnames,
+            only_existing=only_existing,
+            only_missing=only_missing,
+            fmt=fmt,
+        )
+    writer = None
+    if fmt:
+        writer = RecordWriter(
+            fmt,
+            (
+                'name',
+                'found',
+                'installed',
+                'version',
+                'summary',
+                'description',
+            ),
+        )
     existing = 0
     checked = 0
     for pname in pkgnames:
@@ -569,26 +1259,142 @@ def cmd_locate(pkgnames, only_existing=False, short=False):
         pkg = cache_main.get(pname, pname)
         if pkg != pname:
             existing += 1
+            if only_missing:
+                checked += 1
+                continue
         elif only_existing:
             continue
+        checked += 1
+        if writer is not None:
+            if pkg == pname:
+                writer.write(pname, False, None, None, None, None)
+            else:
+                writer.write(
+                    pkg.name,
+                    True,
+                    pkg_install_state(pkg),
+                    get_latest_ver(pkg),
+                    get_pkg_summary(pkg),
+                    get_pkg_description(pkg),
+                )
+            continue
         print(pkg_format(
             pkg,
             color_missing=True,
             no_marker=short,
             no_desc=short
         ))
+    if writer is not None:
+        writer.flush()
+
+    plural = 'package' if existing == 1 else 'packages'
+    print_status('\nFound {} of {} {}.'.format(existing, checked, plural))
+    return 0 if (checked > 0) and (existing == checked) else 1
 
+
+def cmd_locate_bulk(
+        pkgnames, only_existing=False, only_missing=False, fmt=None):
+    """ Locate a long list of package names, printing names only.
+        Names are checked against a PackageNameSet and printed as they are
+        read, so memory use doesn't grow with the number of names.
+        Arguments:
+            pkgnames       : Iterable of package names.
+            only_existing  : Only show existing packages.
+            only_missing   : Only show missing packages.
+            fmt            : RecordWriter format, to print records instead
+                             of names.
+    """
+    names = pkg_names_load()
+    output = OutputBuffer()
+    writer = None
+    if fmt:
+        writer = RecordWriter(fmt, ('name', 'found'), output=output)
+    color = PlainColr if colr_disabled() else None
+    existing = 0
+    checked = 0
+    for pname in pkgnames:
+        pname = pname.lower().strip()
+        found = pname in names
         checked += 1
+        if found:
+            existing += 1
+            if only_missing:
+                continue
+        elif only_existing:
+            continue
+        if writer is not None:
+            writer.write(pname, found)
+            continue
+        output.write(pkg_format_name(pname, missing=not found, color=color))
+        output.write('\n')
+    output.flush()
 
+    if only_existing:
+        # Missing names were never printed, like cmd_locate().
+        checked = existing
     plural = 'package' if existing == 1 else 'packages'
     print_status('\nFound {} of {} {}.'.format(existing, checked, plural))
     return 0 if (checked > 0) and (existing == checked) else 1
 
 
-def cmd_remove(pkgname, purge=False):
-    """ Remove or Purge a package by name """
+def cmd_rank(
+        terms, install_state=None, top=25, print_no_desc=False, fmt=None):
+    """ Print the best matching packages for search terms, using the
+        RankIndex. Every term must be found in a package's name or
+        description, and name hits are ranked higher.
+        Arguments:
+            terms          : List of search terms.
+            install_state  : InstallStateEnum to filter packages.
+                             Default: InstallStateEnum.every
+            top            : Maximum number of results to print.
+                             Default: 25
+            print_no_desc  : If True, don't print descriptions of packages.
+            fmt            : RecordWriter format, to print records instead
+                             of formatted results.
+    """
+    install_state = install_state or InstallStateEnum.every
+    rankindex = rank_load()
+    print_status(C('').join(
+        C('Ranking ', 'blue'),
+        C(install_state),
+        ' {}'.format(C(' '.join(terms), 'cyan')),
+    ))
+    results, total = rankindex.search(
+        terms,
+        install_state=install_state,
+        top=top,
+    )
+    output = OutputBuffer()
+    writer = None
+    if fmt:
+        writer = RecordWriter(
+            fmt,
+            PackageRecord._fields + ('score',),
+            output=output,
+        )
+    for score, pkgrec in results:
+        if writer is None:
+            output.write('\n{}\n'.format(
+                pkg_format(pkgrec, no_desc=print_no_desc)
+            ))
+        else:
+            writer.write(*pkgrec, round(score, 3))
+    output.flush()
+
+    print_status('\nShowing {} of {} {}.'.format(
+        len(results),
+        total,
+        'result' if total == 1 else 'results',
+    ))
+    return 0
+
 
-    print_status('\nLooking for \'{}\' to remove...'.format(pkgname))
+def cmd_remove(pkgnames, purge=False):
+    """ Remove or Purge one or more packages by name.
+        Every package is marked first, and then all of them are removed
+        with a single commit (one dpkg run).
+        Returns the number of packages that failed, as an exit status.
+    """
     if purge:
         opaction = 'purge'
         opstatus = 'Purging'
@@ -596,59 +1402,58 @@ def cmd_remove(pkgname, purge=False):
         opaction = 'remove'
         opstatus = 'Removing'
 
-    try:
-        package = cache_main[pkgname]
-    except KeyError:
-        print_missing_pkg(pkgname)
-        return 1
+    requested = []
+    failures = {}
+    marked = []
+    with cache_main.actiongroup():
+        for pkgname in pkgnames:
+            requested.append(pkgname)
+            print_status('\nLooking for \'{}\' to remove...'.format(pkgname))
+            package = cache_main.get(pkgname, None)
+            if package is None:
+                print_missing_pkg(pkgname)
+                failures[pkgname] = 'not found'
+                continue
 
-    if not pkg_install_state(package):
-        print_err('\nThis package is not installed: {}'.format(package.name))
-        return 1
+            if not pkg_install_state(package):
+                print_err(
+                    '\nThis package is not installed: {}'.format(package.name)
+                )
+                failures[pkgname] = 'not installed'
+                continue
 
-    print_status('Removing package: {}'.format(package.name))
-    # Mark for delete.
-    if not hasattr(package, 'mark_delete'):
-        print_err(
-            '\n'.join((
-                '\napt_pkg doesn\'t have \'mark_delete\' attribute,',
-                'apt/apt_pkg module may be out of date.',
-                '\nStopping.'
-            ))
-        )
-        return 1
+            print_status('Removing package: {}'.format(package.name))
+            # Mark for delete.
+            if not hasattr(package, 'mark_delete'):
+                print_err(
+                    '\n'.join((
+                        '\napt_pkg doesn\'t have \'mark_delete\' attribute,',
+                        'apt/apt_pkg module may be out of date.',
+                        '\nStopping.'
+                    ))
+                )
+                failures[pkgname] = 'apt/apt_pkg out of date'
+                continue
 
-    package.mark_delete(purge=purge)
-    # Remove the package
-    try:
-        cache_main.commit(
-            fetch_progress=SimpleFetchProgress(),
-            install_progress=SimpleInstallProgress(
-                pkgname=pkgname,
-                msg=opstatus))
-        return 0
-    except apt.cache.LockFailedException as exlock:
-        print_err(
-            '\n'.join((
-                '\nCan\'t {} package, ',
-                'Make sure you have proper permissions. (are you root?)',
-                '\nError Message:\n{}',
-            )).format(opaction, exlock)
-        )
-        return 1
-    except SystemError as exsys:
-        # dpkg is already being used by something else.
-        print_err(
-            '\n'.join((
-                'Can\'t {} package, ',
-                'Make sure all other package managers are closed.',
-                '\nError Message:\n{}',
-            )).format(opaction, exsys)
-        )
-        return 1
+            package.mark_delete(purge=purge)
+            marked.append(pkgname)
+
+    # The resolver may have dropped marks when the actiongroup closed.
+    for pkgname in marked[:]:
+        if not cache_main[pkgname].marked_delete:
+            print_err(
+                '\nThis package can\'t be removed: {}'.format(pkgname)
+            )
+            failures[pkgname] = 'not marked for {}'.format(opaction)
+            marked.remove(pkgname)
+
+    commit_packages(marked, failures, opaction=opaction, opstatus=opstatus)
+    print_commit_report(requested, failures, opaction)
+    return len(failures)
 
 
-def cmd_reverse_dependencies(pkgname, installstate=None, short=False):
+def cmd_reverse_dependencies(
+        pkgname, installstate=None, short=False, depth=1, fmt=None):
     """ Print all reverse dependencies for a package.
         Optionally, filter by installed or uninstalled.
         Arguments:
@@ -656,6 +1461,12 @@ def cmd_reverse_dependencies(pkgname, installstate=None, short=False):
             installstate  : InstallStateEnum, to filter dependency list.
                             Default: InstallStateEnum.every
             short         : Use shorter output.
+            depth         : Levels of dependents to show. When greater than
+                            1, dependents of dependents are also shown
+                            (each package only once).
+                            Default: 1
+            fmt           : RecordWriter format, to print records instead
+                            of formatted results.
     """
     status = noop if short else print_status
     installstate = installstate or InstallStateEnum.every
@@ -668,15 +1479,57 @@ def cmd_reverse_dependencies(pkgname, installstate=None, short=False):
     status('\nSearching for {} dependents on {}...'.format(
         installstate,
         package.name))
+    graph = rdepends_load()
+    writer = None
+    if fmt:
+        writer = RecordWriter(
+            fmt,
+            (
+                'package',
+                'depth',
+                'name',
+                'installed',
+                'version',
+                'summary',
+                'description',
+            ),
+        )
     totalstate = 0
-    total = 0
-    for pkg in installstate.filter_pkgs(cache_main):
-        for pkgver in pkg.versions:
-            for deplst in pkgver.dependencies:
-                total += 1
-                for dep in filter(lambda d: d.name == package.name, deplst):
-                    print(pkg_format(pkg, no_ver=short, no_desc=short))
-                    totalstate += 1
+    total = graph.total(installstate)
+    seen = {package.name}
+    level = [package.name]
+    for leveldepth in range(1, depth + 1):
+        if depth > 1:
+            status('\nDepth {}:'.format(leveldepth))
+        nextlevel = []
+        for name in level:
+            for depname in graph.dependents(name):
+                if depth > 1:
+                    if depname in seen:
+                        continue
+                    seen.add(depname)
+                    nextlevel.append(depname)
+                pkg = cache_main.get(depname, None)
+                if (pkg is None) or (not installstate.matches_pkg(pkg)):
+                    continue
+                totalstate += 1
+                if writer is not None:
+                    writer.write(
+                        package.name,
+                        leveldepth,
+                        pkg.name,
+                        pkg_install_state(pkg),
+                        get_latest_ver(pkg),
+                        get_pkg_summary(pkg),
+                        get_pkg_description(pkg),
+                    )
+                    continue
+                print(pkg_format(pkg, no_ver=short, no_desc=short))
+        if not nextlevel:
+            break
+        level = nextlevel
+    if writer is not None:
+        writer.flush()
 
     if installstate == InstallStateEnum.every:
         status('\nTotal: {}'.format(total))
@@ -689,7 +1542,7 @@ def cmd_reverse_dependencies(pkgname, installstate=None, short=False):
 def cmd_search(
         query, use_desc=True, print_no_desc=False, print_no_ver=False,
         install_state=None, case_insensitive=False, dev_only=False,
-        reverse=False):
+        reverse=False, jobs=1, fmt=None, literals=None):
     """ print results while searching the cache...
         Arguments:
             query             : Seach term for package name/desc.
@@ -705,6 +1558,15 @@ def cmd_search(
             dev_only          : Whether to search only dev packages.
             reverse           : Reverses the match, to show packages that
                                 DON'T match the pattern.
+            jobs              : Number of processes to search with.
+                                When greater than 1, a SearchIndex snapshot
+                                is searched in parallel.
+                                Default: 1
+            fmt               : RecordWriter format, to print records
+                                instead of formatted results.
+            literals          : QueryLiterals for the query (see
+                                query_literals()), to test before running
+                                the regex.
     """
     try:
         re_pat = re.compile(
@@ -712,17 +1574,8 @@ def cmd_search(
             re.IGNORECASE if case_insensitive else 0)
     except re.error as ex:
         raise BadSearchQuery(query, ex)
-    if sys.stdout.isatty():
-        spinner = AnimatedProgress(
-            'Loading APT Cache...',
-            fmt=' {frame} {elapsed:<2.0f}s {text}',
-            frames=Frames.dots_orbit.as_gradient(name='blue', style='bright'),
-        )
-        with spinner:
-            cache = apt.cache.FilteredCache(progress=oprogress)
-    else:
-        # No animated spinner, stdout is not a tty.
-        cache = apt.cache.FilteredCache(progress=oprogress)
+    if literals is not None:
+        re_pat = QueryMatcher(re_pat, literals)
     msg = C('').join(
         C('Searching ', 'blue'),
         C(install_state),
@@ -735,8 +1588,8 @@ def cmd_search(
             else ''
         ),
     )
-    print_status(msg)
-    cache.set_filter(AptToolFilter(
+    output = OutputBuffer()
+    aptfilter = AptToolFilter(
         re_pat,
         _name_pat=re.compile(r'(.+dev)') if dev_only else None,
         use_desc=use_desc,
@@ -744,9 +1597,38 @@ def cmd_search(
         reverse=reverse,
         print_no_desc=print_no_desc,
         print_no_ver=print_no_ver,
-    ))
+        output=output,
+        writer=(
+            RecordWriter(
+                fmt,
+                ('name', 'installed', 'version', 'summary', 'description'),
+                output=output,
+            )
+            if fmt else None
+        ),
+    )
+
+    index = SearchIndex.load()
+    if (index is None) and ((jobs > 1) or (cache_main is not None)):
+        # Parallel searches need a snapshot. When the cache is already
+        # loaded (the daemon), it is used instead of opening another one.
+        cache = cache_main
+        if cache is None:
+            cache = call_with_spinner(apt_load().Cache, progress=oprogress)
+            pkg_memo_clear()
+        index = SearchIndex.from_cache(cache)
+        index.save()
+    if index is None:
+        # No usable index, search the apt cache and build one for next time.
+        result_cnt = search_cache(aptfilter, msg)
+    elif jobs > 1:
+        print_status(msg)
+        result_cnt = search_index_parallel(index, aptfilter, jobs)
+    else:
+        print_status(msg)
+        result_cnt = sum(1 for pkgrec in index if aptfilter.apply(pkgrec))
+    aptfilter.flush()
 
-    result_cnt = len(cache)
     print_status('\nFinished searching, found {} {}.'.format(
         str(result_cnt),
         'result' if result_cnt == 1 else 'results'
@@ -754,6 +1636,64 @@ def cmd_search(
     return 0
 
 
+def cmd_serve():
+    """ Run the apttool daemon, answering cache queries from other apttool
+        processes over a Unix socket (DAEMON_SOCKET) until cancelled.
+        The cache is reloaded when the apt/dpkg state files change.
+    """
+    import socket
+    if daemon_connect() is not None:
+        print_err('\nThe daemon is already running: {}'.format(DAEMON_SOCKET))
+        return 1
+    call_with_spinner(cache_load)
+    stamp = file_stamp(APT_STATE_FILES)
+    with suppress(FileNotFoundError):
+        # Stale socket from a daemon that was killed.
+        os.remove(DAEMON_SOCKET)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.makedirs(os.path.split(DAEMON_SOCKET)[0], exist_ok=True)
+        sock.bind(DAEMON_SOCKET)
+        os.chmod(DAEMON_SOCKET, stat.S_IRUSR | stat.S_IWUSR)
+        sock.listen(8)
+    except EnvironmentError as ex:
+        sock.close()
+        print_err('\nUnable to listen on: {}\n{}'.format(DAEMON_SOCKET, ex))
+        return 1
+    # Make sure the socket is removed when killed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sock.settimeout(DAEMON_POLL)
+    print_status(
+        'Loaded {} packages, serving'.format(len(cache_main)),
+        value=DAEMON_SOCKET,
+    )
+    try:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                conn = None
+            # Checked after accept(), so a request never sees an old cache.
+            newstamp = file_stamp(APT_STATE_FILES)
+            if newstamp != stamp:
+                print_status('Reloading apt cache, apt/dpkg state changed.')
+                cache_load(forced=True)
+                stamp = newstamp
+            if conn is None:
+                continue
+            with conn:
+                try:
+                    daemon_handle(conn)
+                except EnvironmentError:
+                    # The client went away while output was being sent.
+                    continue
+    finally:
+        sock.close()
+        with suppress(FileNotFoundError):
+            os.remove(DAEMON_SOCKET)
+    return 0
+
+
 def cmd_suggests(pkgname, short=False, indent=0):
     """ Print suggested packages for a single Package.
         Return an exit status code.
@@ -819,16 +1759,41 @@ def cmd_suggests(pkgname, short=False, indent=0):
 
 def cmd_update(load_cache=False):
     """ update the cache,
-        init or re-initialize the cache if load_cache is True
+        init or re-initialize the cache if load_cache is True.
+        The cache is only reopened when package lists changed, and the
+        SearchIndex only re-reads descriptions for packages from the
+        repositories that changed.
     """
     global cache_main
     if load_cache:
         cache_load()
 
     try:
-        cache_main.update(SimpleFetchProgress(msg='Updating...'))
+        listsstamp = file_stamp((APT_LISTS_DIR,))
+        fetchprogress = SimpleFetchProgress(msg='Updating...')
+        cache_main.update(fetchprogress)
+        changedlists = len(fetchprogress.fetched)
+        print_status('Package lists: {} changed, {} unchanged.'.format(
+            changedlists,
+            fetchprogress.hits,
+        ))
+        if (not changedlists) and (file_stamp((APT_LISTS_DIR,)) == listsstamp):
+            print_status('Nothing changed, skipped reloading the cache.')
+            return True
         cache_main.open(progress=SimpleOpProgress(msg='Opening cache...'))
+        cache_reset()
         print_status('Loaded ' + str(len(cache_main.keys())) + ' packages.')
+        searchindex, reused = SearchIndex.from_cache_refresh(
+            cache_main,
+            fetchprogress.changed_repos(),
+        )
+        searchindex.save()
+        print_status(
+            'Search index: re-read {} packages, reused {}.'.format(
+                len(searchindex) - reused,
+                reused,
+            )
+        )
     except KeyboardInterrupt:
         print_err('\nUser cancelled.\n')
     except apt.cache.FetchFailedException as exfail:
@@ -838,6 +1803,83 @@ def cmd_update(load_cache=False):
     return True
 
 
+def cmd_upgradable(installstate=None, short=False, fmt=None):
+    """ Print installed packages that have a newer candidate version
+        (--upgradable). The cache is scanned once with apt_pkg, and the
+        installed/candidate versions are compared with
+        apt_pkg.version_compare().
+        Arguments:
+            installstate  : InstallStateEnum, using dpkg's state.
+                            `installed` only shows fully installed
+                            packages, and `uninstalled` only shows packages
+                            that are unpacked, half-configured, etc.
+                            Default: InstallStateEnum.every
+            short         : Only print package names.
+            fmt           : RecordWriter format, to print records instead
+                            of a table.
+    """
+    status = noop if short else print_status
+    installstate = installstate or InstallStateEnum.every
+    depcache = cache_main._depcache
+    version_compare = apt_pkg.version_compare
+    fullinstalled = apt_pkg.CURSTATE_INSTALLED
+    rows = []
+    downloadsize = 0
+    for pkg in cache_main._cache.packages:
+        current = pkg.current_ver
+        if current is None:
+            continue
+        if installstate != InstallStateEnum.every:
+            isfull = pkg.current_state == fullinstalled
+            if isfull != (installstate == InstallStateEnum.installed):
+                continue
+        candidate = depcache.get_candidate_ver(pkg)
+        if candidate is None:
+            continue
+        if version_compare(candidate.ver_str, current.ver_str) <= 0:
+            continue
+        pkgfile = candidate.file_list[0][0]
+        rows.append((
+            pkg.get_fullname(True),
+            current.ver_str,
+            candidate.ver_str,
+            '/'.join(
+                s for s in (pkgfile.origin, pkgfile.archive) if s
+            ) or None,
+            version_has_backport(candidate),
+        ))
+        downloadsize += candidate.size
+    rows.sort()
+
+    output = OutputBuffer()
+    if fmt:
+        writer = RecordWriter(
+            fmt,
+            ('name', 'installed', 'candidate', 'origin', 'backports'),
+            output=output,
+        )
+        for row in rows:
+            writer.write(*row)
+    elif short:
+        color = PlainColr if colr_disabled() else None
+        for row in rows:
+            output.write('{}\n'.format(pkg_format_name(row[0], color=color)))
+    else:
+        write_table(
+            output,
+            ('name', 'installed', 'candidate', 'origin', 'backports'),
+            rows,
+            ('green', 'yellow', 'blue', 'cyan'),
+        )
+    output.flush()
+
+    status('\nUpgradable: {} {}'.format(
+        len(rows),
+        SimpleFetchProgress.format_filesize(downloadsize),
+    ))
+    return 0
+
+
 def cmd_version(pkgname, allversions=False, div=False, short=False):
     """ Retrieve and print the current version info for a package.
         Returns 0 for success, 1 for error.
@@ -870,30 +1912,155 @@ def cmd_version(pkgname, allversions=False, div=False, short=False):
     return 0
 
 
+def cmd_version_table(pkgnames, allversions=False, short=False, fmt=None):
+    """ Print a compact version table for many packages at once
+        (-V --table). All names are resolved in one pass, and backports are
+        checked once per package file (see backport_files_load()) instead
+        of once per version.
+        Returns the number of missing packages as an exit status.
+        Arguments:
+            pkgnames     : Package names, file names, or '-' for stdin
+                           (see parse_packages_arg()).
+            allversions  : Show a row for every available version, with
+                           installed/candidate/latest/backports marks.
+            short        : Don't print the header row or totals.
+            fmt          : RecordWriter format, to print records instead
+                           of a table.
+    """
+    status = noop if short else print_status
+    missing = []
+    rows = []
+    upgradable = 0
+    for pkgname in parse_packages_arg(pkgnames):
+        pkg = cache_main.get(pkgname, None)
+        if (pkg is None) or (not pkg.versions):
+            missing.append(pkgname)
+            continue
+        installed = pkg.installed
+        candidate = pkg.candidate
+        latest = pkg.versions[0]
+        if allversions:
+            for ver in pkg.versions:
+                rows.append((
+                    pkg.name,
+                    ver.version,
+                    ver == installed,
+                    ver == candidate,
+                    ver == latest,
+                    version_has_backport(ver),
+                ))
+            continue
+        backport = None
+        for ver in pkg.versions:
+            if version_has_backport(ver):
+                backport = ver.version
+                break
+        if pkg.is_upgradable:
+            upgradable += 1
+        rows.append((
+            pkg.name,
+            installed.version if installed else None,
+            candidate.version if candidate else None,
+            latest.version,
+            backport,
+            pkg.is_upgradable,
+        ))
+
+    if allversions:
+        fields = (
+            'name', 'version', 'installed', 'candidate', 'latest', 'backports'
+        )
+        colors = ('blue', 'green', 'yellow', 'blue', 'cyan')
+    else:
+        fields = (
+            'name', 'installed', 'candidate', 'latest', 'backports',
+            'upgradable',
+        )
+        colors = ('green', 'yellow', 'blue', 'cyan', 'yellow')
+    output = OutputBuffer()
+    if fmt:
+        writer = RecordWriter(fmt, fields, output=output)
+        for row in rows:
+            writer.write(*row)
+    else:
+        write_table(output, fields, rows, colors, header=not short)
+    output.flush()
+
+    if rows and not allversions:
+        status('\nPackages: {}, Upgradable: {}'.format(len(rows), upgradable))
+    for pkgname in missing:
+        print_missing_pkg(pkgname)
+    return len(missing)
+
+
 def cmdmap_build(argd):
     """ Return a map of {cmdline_option: function_info}. """
-    funcmap = {
-        '--containsfile': {
-            'func': cmd_contains_file,
-            'args': (argd['--containsfile'],),
-            'kwargs': {'shortnamesonly': argd['--names']}
-        },
-        '--dependencies': {
+    # Options that are handled by another function when other options
+    # are used:
+    if argd['--recursive']:
+        dependencies = {
+            'func': cmd_dependency_closure,
+            'args': (
+                list(parse_packages_arg(argd['PACKAGES'])),
+            ),
+            'kwargs': {
+                'fmt': argd['--format'],
+                'installstate': InstallStateEnum.from_argd(argd),
+                'short': argd['--short']
+            }
+        }
+    else:
+        dependencies = {
             'func': multi_pkg_func,
             'args': (
                 cmd_dependencies,
                 argd['PACKAGES']
             ),
             'kwargs': {
+                'fmt': argd['--format'],
                 'installstate': InstallStateEnum.from_argd(argd),
                 'short': argd['--short']
             }
+        }
+    if argd['--table'] or argd['--format']:
+        version = {
+            'func': cmd_version_table,
+            'args': (
+                argd['PACKAGES'],
+            ),
+            'kwargs': {
+                'allversions': argd['--all'],
+                'fmt': argd['--format'],
+                'short': argd['--short']
+            }
+        }
+    else:
+        version = {
+            'func': multi_pkg_func,
+            'args': (
+                cmd_version,
+                argd['PACKAGES'],
+            ),
+            'kwargs': {
+                'allversions': argd['--all'],
+                'div': True,
+                'short': argd['--short']}
+        }
+
+    funcmap = {
+        '--containsfile': {
+            'func': cmd_contains_file,
+            'args': (argd['--containsfile'],),
+            'kwargs': {
+                'fmt': argd['--format'],
+                'shortnamesonly': argd['--names'],
+            }
         },
+        '--dependencies': dependencies,
         '--delete': {  # --purge
-            'func': multi_pkg_func,
+            'func': cmd_remove,
             'args': (
-                cmd_remove,
-                argd['PACKAGES']
+                parse_packages_arg(argd['PACKAGES']),
             ),
             'kwargs': {'purge': bool(argd['--purge'])}
         },
@@ -919,10 +2086,9 @@ def cmdmap_build(argd):
             }
         },
         '--install': {
-            'func': multi_pkg_func,
+            'func': cmd_install,
             'args': (
-                cmd_install,
-                argd['PACKAGES'],
+                parse_packages_arg(argd['PACKAGES']),
             )
         },
         '--locate': {  # --LOCATE
@@ -931,7 +2097,10 @@ def cmdmap_build(argd):
                 parse_packages_arg(argd['PACKAGES']),
             ),
             'kwargs': {
+                'bulk': argd['--bulk'],
+                'fmt': argd['--format'],
                 'only_existing': argd['--LOCATE'],
+                'only_missing': argd['--missing'],
                 'short': argd['--short']
             }
         },
@@ -942,6 +2111,8 @@ def cmdmap_build(argd):
                 argd['PACKAGES']
             ),
             'kwargs': {
+                'depth': argd['--depth'],
+                'fmt': argd['--format'],
                 'installstate': InstallStateEnum.from_argd(argd),
                 'short': argd['--short']
             }
@@ -955,17 +2126,15 @@ def cmdmap_build(argd):
             'kwargs': {'short': argd['--short']}
         },
         '--update': {'func': cmd_update},
-        '--VERSION': {
-            'func': multi_pkg_func,
-            'args': (
-                cmd_version,
-                argd['PACKAGES'],
-            ),
+        '--upgradable': {
+            'func': cmd_upgradable,
             'kwargs': {
-                'allversions': argd['--all'],
-                'div': True,
-                'short': argd['--short']}
+                'fmt': argd['--format'],
+                'installstate': InstallStateEnum.from_argd(argd),
+                'short': argd['--short']
+            }
         },
+        '--VERSION': version,
     }
     # Shared functions with different arguments:
     funcmap['--purge'] = funcmap['--delete']
@@ -973,6 +2142,238 @@ def cmdmap_build(argd):
     return funcmap
 
 
+def colr_disable():
+    """ Disable colors. Without colr, they are already disabled. """
+    if colr is not None:
+        colr.disable()
+
+
+def colr_disabled():
+    """ Returns True if colors are disabled. """
+    return (colr is None) or colr.disabled()
+
+
+def colr_enable():
+    """ Enable colors, importing colr if needed. """
+    colr_load().enable()
+
+
+def colr_load():
+    """ Import colr if it hasn't been imported yet, and use Colr for
+        colorizing text from now on. Colors are left disabled, like they
+        were before colr was imported (see colr_enable()).
+        Returns the `colr` module.
+    """
+    global colr, C
+    if colr is None:
+        try:
+            import colr
+        except ImportError as excolr:
+            import_err('Colr', excolr)
+        colr.disable()
+        C = colr.Colr
+    return colr
+
+
+def commit_packages(pkgnames, failures, opaction='install', opstatus=None):
+    """ Commit all marked changes in `cache_main` at once.
+        See print_commit_report() for reporting the results.
+        Arguments:
+            pkgnames  : Names of the packages that were marked.
+            failures  : Dict of {pkgname: reason} for packages that failed
+                        before being marked. Packages that fail during the
+                        commit are added to it.
+            opaction  : Action name for messages ('install', 'remove', etc.)
+            opstatus  : Status message for the install progress.
+                        Default: 'Installing'
+    """
+    if pkgnames:
+        progress = SimpleInstallProgress(
+            msg=opstatus,
+            pkgname=', '.join(pkgnames),
+        )
+        try:
+            cache_main.commit(
+                fetch_progress=SimpleFetchProgress(),
+                install_progress=progress,
+            )
+        except apt.cache.LockFailedException as exlock:
+            print_err(
+                '\n'.join((
+                    '\nCan\'t {} packages!',
+                    'Make sure you have proper permissions. (are you root?)',
+                    '\nError Message:\n{}'
+                )).format(opaction, exlock))
+            failures.update((name, 'lock failed') for name in pkgnames)
+        except apt.cache.FetchFailedException as exfetch:
+            print_err(
+                '\n'.join((
+                    '\nCan\'t {} packages, the downloads failed!',
+                    'Check your network connection, or update the cache.',
+                    '\nError Message:\n{}'
+                )).format(opaction, exfetch))
+            failures.update((name, str(exfetch)) for name in pkgnames)
+        except SystemError as exsys:
+            # dpkg is already being used by something else.
+            print_err(
+                '\n'.join((
+                    '\nCan\'t {} packages!',
+                    'Make sure all other package managers are closed.',
+                    '\nError Message:\n{}'
+                )).format(opaction, exsys))
+            failures.update((name, str(exsys)) for name in pkgnames)
+        else:
+            for name in pkgnames:
+                errmsg = progress.package_error(name)
+                if errmsg is not None:
+                    failures[name] = errmsg
+        pkg_memo_clear()
+
+
+def daemon_connect():
+    """ Connect to a running apttool daemon.
+        Returns a connected socket, or None if no daemon is running.
+    """
+    import socket
+    if not os.path.exists(DAEMON_SOCKET):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(DAEMON_SOCKET)
+    except EnvironmentError:
+        sock.close()
+        return None
+    return sock
+
+
+def daemon_handle(conn):
+    """ Answer a single request from an apttool client (see daemon_request())
+        on a connected socket, using the same functions that normally print
+        to the console.
+    """
+    global TERM_WIDTH, print_status, print_status_err
+    import json
+    connfile = conn.makefile('rwb')
+    try:
+        request = json.loads(connfile.readline().decode('utf-8'))
+    except ValueError as ex:
+        print_status_err('Bad request from daemon client: {}'.format(ex))
+        return False
+    saved = (
+        sys.stdin,
+        sys.stdout,
+        sys.stderr,
+        TERM_WIDTH,
+        print_status,
+        print_status_err,
+        colr_disabled(),
+    )
+    daemoncwd = os.getcwd()
+    ret = 1
+    try:
+        sys.stdin = StringIO(request.get('stdin', None) or '')
+        sys.stdout = DaemonStream(connfile, 'stdout')
+        sys.stderr = DaemonStream(connfile, 'stderr')
+        TERM_WIDTH = request.get('width', TERM_WIDTH)
+        if request.get('color', False):
+            colr_enable()
+        else:
+            colr_disable()
+        argd = parse_args(request['argv'])
+        cwd = request.get('cwd', None) or daemoncwd
+        try:
+            # File names are relative to the client's working directory.
+            os.chdir(cwd)
+        except EnvironmentError as excwd:
+            print_err('\nCan\'t use the client\'s directory: {}\n{}'.format(
+                cwd,
+                excwd,
+            ))
+        else:
+            ret = main(argd)
+    except (BadSearchQuery, CacheNotLoaded) as ex:
+        print_err('\n{}'.format(ex))
+    except SystemExit as ex:
+        ret = ex.code if isinstance(ex.code, int) else 1
+    except EnvironmentError:
+        # The client went away.
+        return False
+    except Exception as ex:
+        print_err('\nUnexpected error in daemon: {}'.format(ex))
+    finally:
+        (
+            sys.stdin,
+            sys.stdout,
+            sys.stderr,
+            TERM_WIDTH,
+            print_status,
+            print_status_err,
+            wasdisabled,
+        ) = saved
+        if wasdisabled:
+            colr_disable()
+        else:
+            colr_enable()
+        with suppress(EnvironmentError):
+            os.chdir(daemoncwd)
+    with suppress(EnvironmentError):
+        connfile.write(json.dumps({'ret': ret}).encode('utf-8'))
+        connfile.write(b'\n')
+        connfile.flush()
+    return True
+
+
+def daemon_request(argd, argv):
+    """ Run a command through a running apttool daemon, if the command is
+        something the daemon can answer.
+        Output is written to stdout/stderr as it is received.
+        Returns an exit status code, or None if the command should run
+        normally (not a daemon command, or no daemon running).
+        Arguments:
+            argd  : Docopt arg dict, to decide if the daemon can be used.
+            argv  : Raw command-line arguments to send to the daemon.
+    """
+    import json
+    if not (argd['PATTERNS'] or any(argd[opt] for opt in DAEMON_OPTS)):
+        return None
+    use_stdin = '-' in (s.strip() for s in argd['PACKAGES'])
+    if use_stdin and argd['--bulk']:
+        # Bulk names are streamed from stdin, instead of being sent
+        # all at once.
+        return None
+    try:
+        # Relative file names in PACKAGES are opened from here.
+        cwd = os.getcwd()
+    except EnvironmentError:
+        # The working directory was removed.
+        return None
+    sock = daemon_connect()
+    if sock is None:
+        return None
+    stdin = sys.stdin.read() if use_stdin else None
+    request = {
+        'argv': argv,
+        'color': not colr_disabled(),
+        'cwd': cwd,
+        'stdin': stdin,
+        'width': TERM_WIDTH,
+    }
+    ret = 1
+    with sock, sock.makefile('rwb') as connfile:
+        connfile.write(json.dumps(request).encode('utf-8'))
+        connfile.write(b'\n')
+        connfile.flush()
+        for line in connfile:
+            msg = json.loads(line.decode('utf-8'))
+            if 'ret' in msg:
+                ret = msg['ret']
+                break
+            stream = sys.stderr if msg['stream'] == 'stderr' else sys.stdout
+            stream.write(msg['data'])
+            stream.flush()
+    return ret
+
+
 def dependency_info(dep, default=None):
     """ Get the actual Package, version, and relation for a Dependency.
         Returns a tuple of (Package/`default`, dep.version, dep.relation).
@@ -987,10 +2388,96 @@ def dependency_info(dep, default=None):
     return DependencyInfo(deppkg, depver, deprel)
 
 
+def depgraph_load():
+    """ Load the DependencyGraph for `cache_main`, setting global
+        `depgraph_main`. It is loaded from disk if it is still valid,
+        otherwise it is built from the cache and saved.
+        Returns `depgraph_main`.
+    """
+    global depgraph_main
+    if depgraph_main is None:
+        graph = DependencyGraph.load()
+        if graph is None:
+            graph = DependencyGraph.from_cache(cache_main)
+            graph.save()
+        depgraph_main = graph
+    return depgraph_main
+
+
+def dpkg_installed_versions(statusfile=DPKG_STATUS):
+    """ Read installed package versions from dpkg's status file, without
+        loading the apt cache.
+        Returns a dict of {name: version}, where arch-qualified names
+        (libc6:amd64) are included too.
+        Packages count as installed when apt would say so (anything but
+        not-installed and config-files).
+    """
+    versions = {}
+    try:
+        with open(statusfile, 'r', encoding='utf-8', errors='replace') as f:
+            stanzas = f.read().split('\n\n')
+    except EnvironmentError as ex:
+        print_err('\nUnable to read dpkg status: {}\n{}'.format(
+            statusfile,
+            ex,
+        ))
+        return versions
+    for stanza in stanzas:
+        fields = {}
+        for line in stanza.splitlines():
+            if line[:1].isspace():
+                # Continuation lines (descriptions, conffiles, etc.).
+                continue
+            key, _, val = line.partition(':')
+            if key in ('Package', 'Status', 'Version', 'Architecture'):
+                fields[key] = val.strip()
+        pkgname = fields.get('Package', None)
+        if not pkgname:
+            continue
+        state = fields.get('Status', '').rpartition(' ')[-1]
+        if state in ('', 'not-installed', 'config-files'):
+            continue
+        pkgver = fields.get('Version', '')
+        versions[pkgname] = pkgver
+        if fields.get('Architecture', None):
+            versions[':'.join((pkgname, fields['Architecture']))] = pkgver
+    return versions
+
+
+def file_stamp(filenames):
+    """ Return a tuple of (filename, mtime_ns, size) for each file name,
+        used to tell when a persistent index is out of date.
+        Missing files are stamped with None values.
+    """
+    stamps = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except EnvironmentError:
+            stamps.append((filename, None, None))
+        else:
+            stamps.append((filename, st.st_mtime_ns, st.st_size))
+    return tuple(stamps)
+
+
+def formatblock_load():
+    """ Import FormatBlock if it hasn't been imported yet.
+        Returns the FormatBlock class.
+    """
+    global FormatBlock
+    if FormatBlock is None:
+        try:
+            from fmtblock import FormatBlock
+        except ImportError as exfmtblk:
+            import_err('FormatBlock', exfmtblk, module='formatblock')
+    return FormatBlock
+
+
 def get_latest_ver(pkg):
     """ Return the latest version for a package. """
-    ver = get_latest_verobj(pkg)
-    return getattr(ver, 'version', 'unknown').strip()
+    if isinstance(pkg, PackageRecord):
+        return pkg.version
+    return pkg_memo('version', pkg, lookup_latest_ver)
 
 
 def get_latest_verobj(pkg):
@@ -1007,24 +2494,18 @@ def get_pkg_description(pkg):
     """ Retrieves package description using old and new apt API,
         Returns empty string on failure, or no description.
     """
+    if isinstance(pkg, PackageRecord):
+        return pkg.description
+    return pkg_memo('description', pkg, lookup_pkg_description)
 
-    if hasattr(pkg, 'description'):
-        return pkg.description or ''
-    if hasattr(pkg, 'installed'):
-        installedpkg = pkg.installed
-        if installedpkg:
-            # Use installed version description
-            return installedpkg.description or ''
-
-        # Get first description found in all versions.
-        desc = ''
-        for ver in pkg.versions:
-            if ver.description:
-                desc = ver.description
-                break
-        return desc
 
-    return ''
+def get_pkg_summary(pkg):
+    """ Retrieves a package's short description (summary).
+        Returns empty string on failure, or no summary.
+    """
+    if isinstance(pkg, PackageRecord):
+        return pkg.summary
+    return pkg_memo('summary', pkg, lookup_pkg_summary)
 
 
 def get_suggests(pkg):
@@ -1063,6 +2544,126 @@ def get_terminal_size():
     return int(cr[1]), int(cr[0])
 
 
+def history_filenames(logname=DPKG_LOG):
+    """ Return a list of existing dpkg log file names, newest first.
+        This is the log itself, followed by any rotated logs
+        (dpkg.log.1, dpkg.log.2.gz, ...).
+    """
+    dirname, basename = os.path.split(logname)
+    rotated = []
+    try:
+        dirfiles = os.listdir(dirname or '.')
+    except EnvironmentError:
+        dirfiles = []
+    for filename in dirfiles:
+        prefix, dot, suffix = filename.partition('.'.join((basename, '')))
+        if prefix or not dot:
+            continue
+        num, _, ext = suffix.partition('.')
+        if num.isdigit() and (ext in ('', 'gz')):
+            rotated.append((int(num), os.path.join(dirname, filename)))
+
+    filenames = [logname] if os.path.exists(logname) else []
+    filenames.extend(filename for _, filename in sorted(rotated))
+    return filenames
+
+
+def index_filename(name):
+    """ Return the full path to a persistent index file by name. """
+    return os.path.join(INDEX_DIR, '{}.index'.format(name))
+
+
+def index_pack(data):
+    """ Replace the arrays in persistent index data with tagged tuples of
+        (INDEX_ARRAY_TAG, typecode, bytes), so it can be saved with marshal.
+        Arrays are only looked for in dict values (nested dicts too).
+    """
+    if isinstance(data, array):
+        return (INDEX_ARRAY_TAG, data.typecode, data.tobytes())
+    if isinstance(data, dict):
+        return {key: index_pack(val) for key, val in data.items()}
+    return data
+
+
+def index_read(name, stamp):
+    """ Load data from a persistent index.
+        Returns None if the index is missing, unreadable, or out of date.
+        Index files that are writable by anyone but the current user are
+        ignored.
+        Arguments:
+            name   : Name of the index (see index_filename()).
+            stamp  : Expected file_stamp() for the index's source files.
+                     If this is Nothing, out of date indexes are returned.
+    """
+    try:
+        with open(index_filename(name), 'rb') as f:
+            st = os.fstat(f.fileno())
+            if (st.st_uid != os.geteuid()) or (st.st_mode & 0o022):
+                # Like a user's cache, when running with sudo.
+                return None
+            saved = marshal.load(f)
+    except (EnvironmentError, EOFError, TypeError, ValueError):
+        return None
+    if not isinstance(saved, dict):
+        return None
+    if saved.get('version', None) != INDEX_VERSION:
+        return None
+    if (stamp is not Nothing) and (saved.get('stamp', None) != stamp):
+        return None
+    try:
+        return index_unpack(saved.get('data', None))
+    except (TypeError, ValueError):
+        # Bad array typecodes or sizes.
+        return None
+
+
+def index_unpack(data):
+    """ Turn the tagged tuples from index_pack() back into arrays. """
+    if isinstance(data, tuple) and data and (data[0] == INDEX_ARRAY_TAG):
+        _, typecode, arraybytes = data
+        arr = array(typecode)
+        arr.frombytes(arraybytes)
+        return arr
+    if isinstance(data, dict):
+        return {key: index_unpack(val) for key, val in data.items()}
+    return data
+
+
+def index_write(name, data, stamp):
+    """ Save data to a persistent index, replacing the old one atomically.
+        Returns True on success, or False (after printing a warning).
+        Arguments:
+            name   : Name of the index (see index_filename()).
+            data   : Data to save. Must only contain builtin types that
+                     marshal supports, and arrays (see index_pack()).
+            stamp  : file_stamp() for the index's source files.
+    """
+    filename = index_filename(name)
+    tmpname = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        with open(tmpname, 'wb') as f:
+            # index_read() ignores files that others can write to.
+            os.fchmod(f.fileno(), 0o644)
+            marshal.dump(
+                {
+                    'version': INDEX_VERSION,
+                    'stamp': stamp,
+                    'data': index_pack(data),
+                },
+                f,
+            )
+        os.replace(tmpname, filename)
+    except EnvironmentError as ex:
+        with suppress(EnvironmentError):
+            os.remove(tmpname)
+        print_status_err(
+            '\nUnable to save {} index: {}\n{}'.format(name, filename, ex)
+        )
+        return False
+    return True
+
+
 def is_executable(filename):
     """ Return True if the file is executable.
         Returns False on errors.
@@ -1081,23 +2682,327 @@ def is_executable(filename):
     )
 
 
-def iter_history():
+def iter_file_lines_reversed(f, blocksize=65536):
+    """ Yield lines (bytes) from a binary file object, last line first.
+        Fixed-size blocks are read from the end of the file, so only the
+        lines that are actually used are read.
+    """
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    remainder = b''
+    while pos > 0:
+        readsize = min(blocksize, pos)
+        pos -= readsize
+        f.seek(pos)
+        lines = (f.read(readsize) + remainder).split(b'\n')
+        # The first line may be continued in the previous block.
+        remainder = lines[0]
+        for line in reversed(lines[1:]):
+            yield line
+    yield remainder
+
+
+def iter_history(logname=DPKG_LOG, repat=None):
     """ Read dpkg.log and parse it's contents to yield HistoryLine()s
         with package names, install states, etc.
+        Lines are read from the end of the log, latest first, continuing
+        into the rotated logs when the current one runs out.
+        Arguments:
+            logname  : The dpkg log to read.
+            repat    : A compiled regex pattern (see HistoryLine.matches()).
+                       When the pattern can't match the raw line, the line
+                       is skipped without parsing it.
+                       Callers should still check HistoryLine.matches().
     """
-    logname = '/var/log/dpkg.log'
-    if not os.path.exists(logname):
+    filenames = history_filenames(logname)
+    if not filenames:
         raise FileNotFoundError('File does not exist: {}'.format(logname))
-    try:
-        with open(logname, 'r') as f:
-            # Going to read these backwards, latest first.
-            for line in reversed(f.readlines()):
+    prefilter = HistoryLine.prefilter(repat)
+    for filename in filenames:
+        try:
+            for line in iter_history_file_lines(filename):
+                line = line.decode('utf-8', errors='replace')
+                if (prefilter is not None) and (prefilter(line) is None):
+                    continue
                 historyline = HistoryLine.from_dpkg_line(line)
                 if historyline is not None:
                     yield historyline
-    except EnvironmentError as exenv:
-        errfmt = 'Failed to read history: {}\n{}'
-        raise EnvironmentError(errfmt.format(logname, exenv))
+        except EnvironmentError as exenv:
+            errfmt = 'Failed to read history: {}\n{}'
+            raise EnvironmentError(errfmt.format(filename, exenv))
+
+
+def iter_history_file_lines(filename):
+    """ Yield raw lines (bytes) from a single dpkg log, last line first. """
+    if filename.endswith('.gz'):
+        import gzip
+        # Compressed logs can't be read backwards without decompressing
+        # everything before each block, so they are read all at once.
+        with gzip.open(filename, 'rb') as f:
+            lines = f.read().split(b'\n')
+        yield from reversed(lines)
+        return
+    with open(filename, 'rb') as f:
+        yield from iter_file_lines_reversed(f)
+
+
+def iter_history_transactions(
+        logname=DPKG_LOG, since=None, until=None, churn=None,
+        dailyupgrades=None, repat=None, package=None):
+    """ Read dpkg.log and it's rotated logs once, oldest first, and yield
+        closed HistoryTransaction()s.
+        A new transaction starts when more than HISTORY_TRANSACTION_GAP
+        seconds pass between entries. That is usually at a 'startup' line,
+        but apt runs dpkg more than once for a single operation, so dpkg
+        runs that follow each other closely are grouped together.
+        Arguments:
+            logname        : The dpkg log to read.
+            since          : Oldest time (datetime) to include.
+            until          : Newest time (datetime) to include.
+            churn          : Counter, updated with the number of changes
+                             for each package name.
+            dailyupgrades  : Counter, updated with the number of upgrades
+                             for each day ('YYYY-MM-DD').
+            repat          : Passed to HistoryTransaction.close().
+            package        : Passed to HistoryTransaction.close().
+    """
+    import gzip
+    filenames = history_filenames(logname)
+    if not filenames:
+        raise FileNotFoundError('File does not exist: {}'.format(logname))
+    sincestr = None if since is None else str(since)
+    untilstr = None if until is None else str(until)
+    gap = timedelta(seconds=HISTORY_TRANSACTION_GAP)
+    transaction = None
+    lasttimestr = None
+    when = None
+    for filename in reversed(filenames):
+        opener = gzip.open if filename.endswith('.gz') else open
+        try:
+            with opener(filename, 'rb') as f:
+                for line in f:
+                    parts = line.decode('utf-8', errors='replace').split()
+                    if len(parts) < 3:
+                        continue
+                    timestr = ' '.join(parts[:2])
+                    if (sincestr is not None) and (timestr < sincestr):
+                        continue
+                    if (untilstr is not None) and (timestr > untilstr):
+                        continue
+                    if timestr != lasttimestr:
+                        try:
+                            when = parse_history_time(timestr)
+                        except ValueError:
+                            continue
+                        lasttimestr = timestr
+                    if (transaction is None) or (
+                            when - transaction.end > gap):
+                        if transaction is not None:
+                            transaction.close(repat=repat, package=package)
+                            yield transaction
+                        transaction = HistoryTransaction(when)
+                    entrytype = parts[2]
+                    if entrytype == 'startup':
+                        # dpkg writes one startup line each time it runs.
+                        transaction.end = when
+                        transaction.runs += 1
+                        continue
+                    if entrytype not in HistoryTransaction.change_types:
+                        transaction.end = when
+                        continue
+                    if len(parts) < 4:
+                        continue
+                    transaction.add(entrytype, parts[3], when)
+                    name = parts[3].partition(':')[0]
+                    if churn is not None:
+                        churn[name] += 1
+                    if (dailyupgrades is not None) and (
+                            entrytype == 'upgrade'):
+                        dailyupgrades[parts[0]] += 1
+        except EnvironmentError as exenv:
+            errfmt = 'Failed to read history: {}\n{}'
+            raise EnvironmentError(errfmt.format(filename, exenv))
+    if transaction is not None:
+        transaction.close(repat=repat, package=package)
+        yield transaction
+
+
+def list_files_scan(repat, shortnamesonly=False, jobs=1):
+    """ Search dpkg's *.list files directly, without the FileIndex.
+        Yields (listname, [matching paths]) for each list with matching
+        files, in listname order (like FileIndex.search()).
+        Arguments:
+            repat           : Compiled regex pattern to search for.
+            shortnamesonly  : Only match file names, not full paths.
+            jobs            : Number of worker processes.
+    """
+    import multiprocessing
+    try:
+        filenames = sorted(
+            entry.path
+            for entry in os.scandir(DPKG_INFO_DIR)
+            if entry.name.endswith('.list')
+        )
+    except EnvironmentError as ex:
+        print_err('\nUnable to list dpkg files: {}\n{}'.format(
+            DPKG_INFO_DIR,
+            ex,
+        ))
+        return
+    # Several chunks per worker, so a slow chunk doesn't stall the others.
+    chunksize = max(1, -(-len(filenames) // (jobs * 4)))
+    chunks = [
+        (filenames[start:start + chunksize], repat, shortnamesonly)
+        for start in range(0, len(filenames), chunksize)
+    ]
+    if jobs == 1:
+        results = map(list_files_scan_chunk, chunks)
+        for chunkresults in results:
+            yield from chunkresults
+        return
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+        for chunkresults in pool.imap(list_files_scan_chunk, chunks):
+            yield from chunkresults
+
+
+def list_files_scan_chunk(args):
+    """ Search some dpkg *.list files for matching paths. This runs in a
+        worker process for list_files_scan().
+        Returns a list of (listname, [matching paths]).
+        Arguments:
+            args  : A tuple of (filenames, repat, shortnamesonly).
+    """
+    import mmap
+    filenames, repat, shortnamesonly = args
+    # Files without the plain text in them can be skipped without
+    # decoding them.
+    literal = None
+    if not repat.flags & (re.IGNORECASE | re.VERBOSE):
+        literalinfo = pattern_literal(repat.pattern)
+        if (literalinfo is not None) and ('\ufffd' not in literalinfo[0]):
+            literal = literalinfo[0].encode('utf-8')
+    results = []
+    for filename in filenames:
+        try:
+            with open(filename, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if (literal is not None) and (mm.find(literal) == -1):
+                        continue
+                    content = mm[:].decode('utf-8', errors='replace')
+        except (EnvironmentError, ValueError):
+            continue
+        if shortnamesonly:
+            matchingfiles = [
+                s for s in content.split('\n')
+                if s and repat.search(os.path.split(s)[-1])
+            ]
+        else:
+            matchingfiles = [
+                s for s in content.split('\n')
+                if s and repat.search(s)
+            ]
+        if matchingfiles:
+            listname = os.path.splitext(os.path.split(filename)[-1])[0]
+            results.append((listname, matchingfiles))
+    return results
+
+
+def list_repo(filename):
+    """ Return the repository/component part of a package list file name,
+        so Packages and Translation lists from the same place can be
+        matched up. Compression extensions, and anything after the
+        component (binary-amd64_Packages, i18n_Translation-en, etc.) are
+        removed:
+            deb.debian.org_debian_dists_bookworm_main
+    """
+    basename = os.path.split(filename)[-1]
+    for marker in ('_binary-', '_i18n_', '_source_'):
+        repo, found, _rest = basename.partition(marker)
+        if found:
+            return repo
+    for ext in ('.bz2', '.gz', '.lz4', '.lzma', '.xz', '.zst'):
+        if basename.endswith(ext):
+            return basename[:-len(ext)]
+    return basename
+
+
+def lookup_install_state(pkg):
+    """ Returns True/False whether this package is installed, using the
+        apt bindings (see pkg_install_state()).
+        Uses old and new apt API methods.
+    """
+    if hasattr(pkg, 'isInstalled'):
+        return pkg.isInstalled()
+    if hasattr(pkg, 'installed'):
+        return (pkg.installed is not None)
+    if isinstance(pkg, str):
+        # Convenience, package name was passed instead of a package.
+        pkg = cache_main.get(pkg, None)
+        if pkg is not None:
+            return pkg_install_state(pkg)
+    # Last try, could be a dependency object.
+    pkg = cache_main.get(getattr(pkg, 'name', None), None)
+    if pkg is not None:
+        return pkg_install_state(pkg)
+    # API fell through?
+    # (it has happened before, hince the need for the 2 ifs above)
+    print_err(
+        'Please file a bug, API failed install state check: {!r}'.format(
+            pkg
+        )
+    )
+    return False
+
+
+def lookup_latest_ver(pkg):
+    """ Return the latest version for a package, using the apt bindings
+        (see get_latest_ver()).
+    """
+    ver = get_latest_verobj(pkg)
+    return getattr(ver, 'version', 'unknown').strip()
+
+
+def lookup_pkg_description(pkg):
+    """ Retrieves package description using old and new apt API,
+        (see get_pkg_description()).
+        Returns empty string on failure, or no description.
+    """
+    if hasattr(pkg, 'description'):
+        return pkg.description or ''
+    if hasattr(pkg, 'installed'):
+        installedpkg = pkg.installed
+        if installedpkg:
+            # Use installed version description
+            return installedpkg.description or ''
+
+        # Get first description found in all versions.
+        desc = ''
+        for ver in pkg.versions:
+            if ver.description:
+                desc = ver.description
+                break
+        return desc
+
+    return ''
+
+
+def lookup_pkg_summary(pkg):
+    """ Retrieves a package's short description (summary), using the apt
+        bindings (see get_pkg_summary()).
+        This only needs the short description from the package record, so
+        it is cheaper than lookup_pkg_description().
+        Returns empty string on failure, or no summary.
+    """
+    installedpkg = getattr(pkg, 'installed', None)
+    if installedpkg:
+        return installedpkg.summary or ''
+    # Get first summary found in all versions.
+    for ver in getattr(pkg, 'versions', ()):
+        if ver.summary:
+            return ver.summary
+    return ''
 
 
 def multi_pkg_func(func, pkgnames, *args, **kwargs):
@@ -1116,6 +3021,45 @@ def multi_pkg_func(func, pkgnames, *args, **kwargs):
     )
 
 
+def parse_args(argv=None):
+    """ Parse command-line arguments with docopt, and return the arg dict.
+        The help/usage messages are colorized when colors are enabled.
+        Arguments:
+            argv  : Arguments to parse. Default: sys.argv[1:]
+    """
+    version = '{} v. {}'.format(NAME, __version__)
+    if colr_disabled():
+        return docopt_plain(USAGESTR, argv=argv, version=version)
+    return colr.docopt(USAGESTR, argv=argv, version=version, script=SCRIPT)
+
+
+def parse_history_time(timestr):
+    """ Parse a dpkg.log time string ('YYYY-MM-DD HH:MM:SS') into a
+        datetime. This is much faster than datetime.strptime(), because the
+        format never changes.
+        Raises ValueError for badly formatted time strings.
+    """
+    if (
+            (len(timestr) != 19) or
+            (timestr[4] != '-') or
+            (timestr[7] != '-') or
+            (timestr[10] != ' ') or
+            (timestr[13] != ':') or
+            (timestr[16] != ':')):
+        raise ValueError(
+            'time data {!r} does not match format \'%Y-%m-%d %H:%M:%S\''
+            .format(timestr)
+        )
+    return datetime(
+        int(timestr[0:4]),
+        int(timestr[5:7]),
+        int(timestr[8:10]),
+        int(timestr[11:13]),
+        int(timestr[14:16]),
+        int(timestr[17:19]),
+    )
+
+
 def parse_packages_arg(names):
     """ Parse the --PACKAGES arg, which accepts package names,
         file names, or '-' for stdin.
@@ -1130,8 +3074,10 @@ def parse_packages_arg(names):
             if sys.stdin.isatty() and sys.stdout.isatty():
                 print_status('\nReading package names from stdin...\n')
             did_stdin = True
-            for word in sys.stdin.read().split():
-                yield word.strip()
+            # Read as they come in, for long (or slow) lists of names.
+            for line in sys.stdin:
+                for word in line.split():
+                    yield word.strip()
         elif os.path.isfile(pname):
             try:
                 with open(pname, 'r') as f:
@@ -1147,11 +3093,76 @@ def parse_packages_arg(names):
             yield pname
 
 
+def parse_time_arg(timestr, end=False):
+    """ Parse a user's time argument (--since/--until) into a datetime.
+        Accepts 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM', or 'YYYY-MM-DD HH:MM:SS'
+        (a 'T' may be used instead of the space).
+        Raises ValueError for other formats.
+        Arguments:
+            timestr  : Time string to parse.
+            end      : Use the end of a date/minute instead of the start,
+                       so the whole day/minute is included.
+    """
+    timestr = timestr.strip().replace('T', ' ')
+    for fmt, lastsecond in (
+            ('%Y-%m-%d %H:%M:%S', 0),
+            ('%Y-%m-%d %H:%M', 59),
+            ('%Y-%m-%d', 86399)):
+        try:
+            parsed = datetime.strptime(timestr, fmt)
+        except ValueError:
+            continue
+        if end:
+            parsed += timedelta(seconds=lastsecond)
+        return parsed
+    raise ValueError('Expecting: YYYY-MM-DD[ HH:MM[:SS]]')
+
+
+def pattern_literal(pattern):
+    """ Return a (literal, anchored_start, anchored_end) tuple for a regex
+        pattern that is just plain text (with optional ^ and $ anchors),
+        or None if the pattern uses any other regex features.
+    """
+    anchored_start = pattern.startswith('^')
+    if anchored_start:
+        pattern = pattern[1:]
+    anchored_end = False
+    if pattern.endswith('$'):
+        # Make sure the $ is not escaped (an odd number of backslashes).
+        slashes = len(pattern[:-1]) - len(pattern[:-1].rstrip('\\'))
+        if not (slashes % 2):
+            anchored_end = True
+            pattern = pattern[:-1]
+    chars = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            if char.isalnum():
+                # Character classes like \d, \w, or \b.
+                return None
+            chars.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in '.^$*+?{}[]|()':
+            return None
+        else:
+            chars.append(char)
+    if escaped or not chars:
+        return None
+    literal = ''.join(chars)
+    if '\n' in literal:
+        return None
+    return literal, anchored_start, anchored_end
+
+
 def pkg_format(
         pkg, color_missing=False, indent=0,
         no_desc=False, no_marker=False, no_ver=False,
         use_relation=None, use_version=None):
     """ Formats a single search result, using colors.
+        Results are cached by package name, install state, version, format
+        options, terminal width, and color on/off (see pkg_format_build()).
 
         Arguments:
             pkg           : Package object to format.
@@ -1170,6 +3181,56 @@ def pkg_format(
             use_version   : Print this version number instead of grabbing the
                             latest/installed version.
     """
+    if isinstance(pkg, str):
+        pkgkey = (pkg, None, None)
+    else:
+        pkgkey = (
+            pkg.name,
+            pkg_install_state(pkg),
+            # Dependency versions/relations may not be hashable.
+            str(use_version) if use_version else get_latest_ver(pkg),
+        )
+    key = (
+        pkgkey,
+        color_missing,
+        indent,
+        no_desc,
+        no_marker,
+        no_ver,
+        str(use_relation or ''),
+        TERM_WIDTH,
+        colr_disabled(),
+    )
+    try:
+        formatted = pkg_format_cache[key]
+    except KeyError:
+        formatted = pkg_format_cache[key] = pkg_format_build(
+            pkg,
+            color_missing=color_missing,
+            indent=indent,
+            no_desc=no_desc,
+            no_marker=no_marker,
+            no_ver=no_ver,
+            use_relation=use_relation,
+            use_version=use_version,
+        )
+        if len(pkg_format_cache) > PKG_FORMAT_CACHE_SIZE:
+            pkg_format_cache.popitem(last=False)
+    else:
+        pkg_format_cache.move_to_end(key)
+    return formatted
+
+
+def pkg_format_build(
+        pkg, color_missing=False, indent=0,
+        no_desc=False, no_marker=False, no_ver=False,
+        use_relation=None, use_version=None):
+    """ Formats a single search result, without caching.
+        When colors are disabled, plain strings (PlainColr) are used
+        instead of Colr.
+        See pkg_format() for arguments.
+    """
+    color = PlainColr if colr_disabled() else C
     missing = False
     name_len = 35
     separator = ' : '
@@ -1178,21 +3239,24 @@ def pkg_format(
     if isinstance(pkg, str):
         # Just a name was passed in, because the cache didn't contain this
         # known package. ..Happens when printing dependencies (python3-flup?).
-        marker = '' if no_marker else C('[?]', fore='red', style='bright')
+        marker = '' if no_marker else color('[?]', fore='red', style='bright')
         pkgname = pkg
         missing = True
     elif pkg_install_state(pkg):
-        marker = '' if no_marker else C('[i]', fore='green', style='bright')
+        marker = (
+            '' if no_marker else color('[i]', fore='green', style='bright')
+        )
         pkgname = pkg.name
     else:
-        marker = '' if no_marker else C('[u]')
+        marker = '' if no_marker else color('[u]')
         pkgname = pkg.name
     pkgname = pkg_format_name(
         pkgname.ljust(name_len),
-        missing=missing and color_missing
+        missing=missing and color_missing,
+        color=color,
     )
     if not no_marker:
-        pkgname = C(' ').join(
+        pkgname = color(' ').join(
             marker,
             pkgname
         )
@@ -1203,20 +3267,20 @@ def pkg_format(
         verstr = '(missing)'
         verlen = len(verstr)
         relation = ''
-        verfmt = C(verstr, fore='red')
+        verfmt = color(verstr, fore='red')
     else:
         pkgdesc_full = get_pkg_description(pkg)
         verstr = use_version if use_version else get_latest_ver(pkg)
         relation = use_relation or ''
         if relation:
             verfmt = '{} {}'.format(
-                C(relation, fore='green'),
-                C(verstr, fore='blue')
+                color(relation, fore='green'),
+                color(verstr, fore='blue')
             )
         else:
-            verfmt = C(verstr, fore='blue')
+            verfmt = color(verstr, fore='blue')
 
-        verlen = len(strip_codes(verfmt))
+        verlen = len(verfmt if color is PlainColr else strip_codes(verfmt))
 
     # No description needed/available RETURN only the name.
     if no_desc:
@@ -1230,14 +3294,16 @@ def pkg_format(
         return pkgname
 
     # Padlen is how far extended descriptions should be padded.
-    padlen = indent + name_len + len(strip_codes(marker)) + len(separator)
+    if color is not PlainColr:
+        marker = strip_codes(marker)
+    padlen = indent + name_len + len(marker) + len(separator)
     # The +1 is for a space between the marker and the name.
     if not no_marker:
         padlen += 1
 
     descmax = TERM_WIDTH - padlen
     padding = ' ' * padlen
-    pkgdesc = FormatBlock(pkgdesc_full).format(
+    pkgdesc = formatblock_load()(pkgdesc_full).format(
         width=descmax,
         strip_first=True,
         prepend=padding,
@@ -1265,19 +3331,34 @@ def pkg_format(
     # Return the final line, indent if needed.
     return ''.join((
         ' ' * indent,
-        str(C(separator).join(pkgname, pkgdesc))
+        str(color(separator).join(pkgname, pkgdesc))
     ))
 
 
-def pkg_format_name(s, missing=False):
+def pkg_format_name(s, missing=False, color=None):
     """ Colorize a package name.
         Arguments:
             s        : A package name to format.
             missing  : Whether this is a missing package
                        (not found in the cache).
                        It will be colored different.
+            color    : Class to colorize with. Default: C
+    """
+    color = color or C
+    return str(
+        color(s, fore=('red' if missing else 'magenta'), style='bright')
+    )
+
+
+def pkg_from_repos(pkg, repos):
+    """ Return True if any version of a package comes from one of the
+        repositories in `repos` (see list_repo()).
     """
-    return str(C(s, fore=('red' if missing else 'magenta'), style='bright'))
+    for ver in pkg._pkg.version_list:
+        for pkgfile, _index in ver.file_list:
+            if list_repo(pkgfile.filename) in repos:
+                return True
+    return False
 
 
 def pkg_install_state(pkg, expected=None):
@@ -1293,28 +3374,10 @@ def pkg_install_state(pkg, expected=None):
     if expected == InstallStateEnum.every:
         return True
 
-    if hasattr(pkg, 'isInstalled'):
-        actualstate = pkg.isInstalled()
-    elif hasattr(pkg, 'installed'):
-        actualstate = (pkg.installed is not None)
+    if isinstance(pkg, PackageRecord):
+        actualstate = pkg.installed
     else:
-        if isinstance(pkg, str):
-            # Convenience, package name was passed instead of a package.
-            pkg = cache_main.get(pkg, None)
-            if pkg is not None:
-                return pkg_install_state(pkg, expected=expected)
-        # Last try, could be a dependency object.
-        pkg = cache_main.get(getattr(pkg, 'name', None), None)
-        if pkg is not None:
-            return pkg_install_state(pkg, expected=expected)
-        # API fell through?
-        # (it has happened before, hince the need for the 2 ifs above)
-        print_err(
-            'Please file a bug, API failed install state check: {!r}'.format(
-                pkg
-            )
-        )
-        actualstate = False
+        actualstate = pkg_memo('installed', pkg, lookup_install_state)
 
     if expected == InstallStateEnum.installed:
         return actualstate
@@ -1327,6 +3390,72 @@ def pkg_install_state(pkg, expected=None):
     return True
 
 
+def pkg_memo(memoname, pkg, func):
+    """ Return `func(pkg)`, memoized by Package.id for the current cache
+        load. Objects without an id (names, dependencies, etc.) are not
+        memoized.
+        Arguments:
+            memoname  : Key for `pkg_memos` ('installed', 'version', etc.)
+            pkg       : Package to get info for.
+            func      : Function that looks up the info.
+    """
+    pkgid = getattr(pkg, 'id', None)
+    if pkgid is None:
+        return func(pkg)
+    memo = pkg_memos[memoname]
+    try:
+        return memo[pkgid]
+    except KeyError:
+        val = memo[pkgid] = func(pkg)
+    return val
+
+
+def pkg_memo_clear():
+    """ Forget all memoized package info. This must be called whenever the
+        cache is (re)loaded or changed, because package ids are only unique
+        for a single cache load.
+    """
+    for memo in pkg_memos.values():
+        memo.clear()
+    pkg_format_cache.clear()
+
+
+def pkg_names_load():
+    """ Load a PackageNameSet for `cache_main`, setting global
+        `pkg_names_main`.
+        Returns `pkg_names_main`.
+    """
+    global pkg_names_main
+    if pkg_names_main is None:
+        pkg_names_main = PackageNameSet.from_cache(cache_main)
+    return pkg_names_main
+
+
+def print_commit_report(pkgnames, failures, opaction):
+    """ Print a summary of which packages were installed/removed, after
+        commit_packages().
+        Arguments:
+            pkgnames  : All package names that were requested.
+            failures  : Dict of {pkgname: reason} for failed packages.
+            opaction  : Action name ('install', 'remove', or 'purge').
+    """
+    if not pkgnames:
+        return
+    print_status('\nResults ({}):'.format(opaction))
+    for name in pkgnames:
+        reason = failures.get(name, None)
+        if reason is None:
+            print('    {} {}'.format(C('[ok]', 'green'), name))
+        else:
+            print('    {} {}: {}'.format(C('[failed]', 'red'), name, reason))
+    okcnt = len(pkgnames) - len(failures)
+    print_status('\n{} of {} {} succeeded.'.format(
+        okcnt,
+        len(pkgnames),
+        'package' if len(pkgnames) == 1 else 'packages',
+    ))
+
+
 def print_err(*args, **kwargs):
     """ Like print(), except `file` is set to sys.stderr by default. """
     kwargs['file'] = kwargs.get('file', sys.stderr)
@@ -1492,23 +3621,81 @@ def query_build(patterns, all_patterns=False):
     return ('(.+)?' if all_patterns else '|').join(parsed)
 
 
+def query_literals(patterns, all_patterns=False):
+    """ Find the plain text in query pattern arguments, for a QueryMatcher.
+        Returns a QueryLiterals tuple, or None if the patterns can't be
+        tested that way.
+        Arguments:
+            patterns     : List of regex/text patterns from the user.
+            all_patterns : Patterns are joined with (.+)? instead of |
+                           (see query_build()).
+    """
+    literals = []
+    for pat in patterns:
+        literalinfo = pattern_literal(pat)
+        if literalinfo is not None:
+            literals.append(literalinfo)
+        elif not all_patterns:
+            # Any pattern may match, and this one isn't plain text.
+            return None
+    if not literals:
+        return None
+    return QueryLiterals(tuple(literals), all_patterns)
+
+
+def rank_load():
+    """ Load the RankIndex for the current SearchIndex, setting global
+        `rank_main`. It is loaded from disk if it is still valid,
+        otherwise it is built and saved (along with the SearchIndex, if
+        that is out of date too).
+        Returns `rank_main`.
+    """
+    global rank_main
+    if (rank_main is None) or (rank_main.stamp != file_stamp(APT_STATE_FILES)):
+        records = SearchIndex.load()
+        if records is None:
+            cache = call_with_spinner(apt_load().Cache, progress=oprogress)
+            pkg_memo_clear()
+            records = SearchIndex.from_cache(cache)
+            records.save()
+        rankindex = RankIndex.load(records)
+        if rankindex is None:
+            rankindex = RankIndex.from_records(records)
+            rankindex.save()
+        rank_main = rankindex
+    return rank_main
+
+
+def rank_tokens(text):
+    """ Return a list of ranked search tokens from a name/description. """
+    if not text:
+        return []
+    return RANK_TOKEN_PAT.findall(text.lower())
+
+
+def rdepends_load():
+    """ Load the reverse dependency graph for `cache_main`, setting global
+        `rdepends_main`. It is loaded from disk if it is still valid,
+        otherwise it is built from the cache and saved.
+        Returns `rdepends_main`.
+    """
+    global rdepends_main
+    if rdepends_main is None:
+        graph = ReverseDependencyGraph.load()
+        if graph is None:
+            graph = ReverseDependencyGraph.from_cache(cache_main)
+            graph.save()
+        rdepends_main = graph
+    return rdepends_main
+
+
 def run_preload_cmd(argd):
     """ Handle command-line options that may benefit from preloading the
         cache.
     """
     status = noop if argd['--short'] else print_status
     # Initialize
-    if sys.stdout.isatty():
-        spinner = AnimatedProgress(
-            'Loading APT Cache...',
-            fmt=' {frame} {elapsed:<2.0f}s {text}',
-            frames=Frames.dots_orbit.as_gradient(name='blue', style='bright'),
-        )
-        with spinner:
-            cache_load()
-    else:
-        # No amimated spinner, stdout is not a tty.
-        cache_load()
+    call_with_spinner(cache_load)
 
     if not cache_main:
         print_err('Failed to load apt cache!')
@@ -1526,6 +3713,97 @@ def run_preload_cmd(argd):
             )
 
 
+def search_cache(aptfilter, msg):
+    """ Search a freshly loaded apt cache with an AptToolFilter,
+        then save a SearchIndex so the next search can skip loading it.
+        Returns the number of results.
+        Arguments:
+            aptfilter  : AptToolFilter to apply to every package.
+            msg        : Status message to print before searching.
+    """
+    cache = call_with_spinner(
+        apt_load().cache.FilteredCache,
+        progress=oprogress,
+    )
+    pkg_memo_clear()
+    print_status(msg)
+    cache.set_filter(aptfilter)
+    result_cnt = len(cache)
+    SearchIndex.from_cache(cache.cache).save()
+    return result_cnt
+
+
+def search_index_parallel(index, aptfilter, jobs):
+    """ Search a SearchIndex with an AptToolFilter, using a pool of worker
+        processes. Matches are handled by `aptfilter.on_match()` in this
+        process, in index order, as soon as each shard (and every shard
+        before it) is finished.
+        Returns the number of results.
+        Arguments:
+            index      : SearchIndex to search.
+            aptfilter  : AptToolFilter to test every PackageRecord with.
+            jobs       : Number of worker processes.
+    """
+    global search_snapshot
+    import multiprocessing
+    # Several shards per worker, so a slow shard doesn't stall the others.
+    shardsize = max(1, -(-len(index) // (jobs * 4)))
+    shards = [
+        (start, min(start + shardsize, len(index)))
+        for start in range(0, len(index), shardsize)
+    ]
+    result_cnt = 0
+    # Forked workers inherit the snapshot, instead of unpickling a copy.
+    search_snapshot = (index, aptfilter)
+    try:
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            for matches in pool.imap(search_shard, shards):
+                for i in matches:
+                    aptfilter.on_match(index[i])
+                    result_cnt += 1
+                aptfilter.poll()
+    finally:
+        search_snapshot = None
+    return result_cnt
+
+
+def search_shard(bounds):
+    """ Return a list of positions in `search_snapshot`'s SearchIndex that
+        match it's AptToolFilter, for a (start, stop) range.
+        This runs in a worker process (see search_index_parallel()).
+    """
+    index, aptfilter = search_snapshot
+    start, stop = bounds
+    return [i for i in range(start, stop) if aptfilter.matches(index[i])]
+
+
+def sorted_prefix_range(order, keyfunc, prefix):
+    """ Binary search a list that is sorted by `keyfunc`, and return a
+        range() of positions in `order` where the key starts with `prefix`.
+        Arguments:
+            order    : Sorted list of items.
+            keyfunc  : Function that returns the sort key for an item.
+            prefix   : Prefix to look for.
+    """
+    lo, hi = 0, len(order)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keyfunc(order[mid]) < prefix:
+            lo = mid + 1
+        else:
+            hi = mid
+    start = lo
+    hi = len(order)
+    prefixlen = len(prefix)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keyfunc(order[mid])[:prefixlen] <= prefix:
+            lo = mid + 1
+        else:
+            hi = mid
+    return range(start, lo)
+
+
 def strip_arch(pkgname, force=False):
     """ Strip the architecture from a package name (python:i386).
         If `force` is used, the arch is stripped unconditionally.
@@ -1544,13 +3822,89 @@ def strip_arch(pkgname, force=False):
     return arch
 
 
+def strip_codes(s):
+    """ Strip all color codes from a string, like colr.strip_codes().
+        Without colr, there are no color codes to strip.
+    """
+    if colr is not None:
+        return colr.strip_codes(s)
+    return str(s) if (s or (s == 0)) else ''
+
+
+def version_has_backport(ver):
+    """ Return True if a Version (apt or apt_pkg) is available from a
+        backports archive. Archives are only checked once per package file,
+        not once per version (see backport_files_load()).
+    """
+    backports = backport_files_load()
+    if not backports:
+        return False
+    filelist = getattr(ver, '_cand', ver).file_list
+    return any(pkgfile.id in backports for pkgfile, _ in filelist)
+
+
+def write_table(output, fields, rows, colors, header=True):
+    """ Write rows of package info as aligned columns (-V --table,
+        --upgradable). The first value in each row is a package name.
+        None is written as '-', and booleans are written as 'yes'/'no'.
+        Arguments:
+            output  : OutputBuffer to write to.
+            fields  : Field names, for the header row.
+            rows    : Tuples of values, one value for each field.
+            colors  : Fore colors for every column after the name.
+            header  : Whether to write a header row.
+    """
+    if not rows:
+        return
+    color = PlainColr if colr_disabled() else C
+    cellrows = [
+        [
+            '-' if val is None else
+            ('yes' if val else 'no') if isinstance(val, bool) else val
+            for val in row
+        ]
+        for row in rows
+    ]
+    widths = [
+        max(len(cells[i]) for cells in cellrows)
+        for i in range(len(fields))
+    ]
+    if header:
+        widths = [max(w, len(f)) for w, f in zip(widths, fields)]
+        output.write('{}\n'.format(
+            color(
+                '  '.join(
+                    f.title().ljust(w) for f, w in zip(fields, widths)
+                ).rstrip(),
+                style='bright',
+            )
+        ))
+    for cells in cellrows:
+        parts = [
+            ''.join((
+                pkg_format_name(cells[0], color=color),
+                ' ' * (widths[0] - len(cells[0])),
+            ))
+        ]
+        for cell, width, fore in zip(cells[1:], widths[1:], colors):
+            padding = ' ' * (width - len(cell))
+            if cell in ('-', 'no'):
+                parts.append(cell + padding)
+            else:
+                parts.append(str(color(cell, fore=fore)) + padding)
+        output.write('{}\n'.format('  '.join(parts).rstrip()))
+
+
 # CLASSES -----------------------------------------------
-class AptToolFilter(apt.cache.Filter):
-    """ A filter that uses apttool config to filter packages. """
+class AptToolFilter(object):
+    """ A filter that uses apttool config to filter packages.
+        It can be used like an apt.cache.Filter, for apt.cache.FilteredCache.
+    """
     def __init__(
             self, pattern, _name_pat=None, use_desc=True, install_state=None,
             reverse=False,
-            print_no_desc=False, print_no_ver=False):
+            print_no_desc=False, print_no_ver=False, output=None,
+            writer=None):
         self.pattern = pattern
         self.name_pat = _name_pat
         self.use_desc = use_desc
@@ -1560,8 +3914,45 @@ class AptToolFilter(apt.cache.Filter):
         # Display options
         self.print_no_desc = print_no_desc
         self.print_no_ver = print_no_ver
+        # OutputBuffer for formatted results.
+        self.output = output or OutputBuffer()
+        # RecordWriter for --format, used instead of pkg_format().
+        self.writer = writer
+        # Number of packages apply() has checked.
+        self.checked = 0
 
     def apply(self, pkg):
+        self.checked += 1
+        if not (self.checked % OUTPUT_POLL_COUNT):
+            # Results found before a long run of non-matching packages
+            # shouldn't wait for the next match.
+            self.poll()
+        if self.matches(pkg):
+            return self.on_match(pkg)
+        return False
+
+    def flush(self):
+        """ Write any buffered results (see OutputBuffer). """
+        if self.writer is None:
+            self.output.flush()
+        else:
+            self.writer.flush()
+
+    def match_name(self, pkg):
+        if self.name_pat is None:
+            return True
+        return self.name_pat.search(pkg.name) is not None
+
+    def match_str(self, targetstr, reverse=False):
+        rematch = self.pattern.search(targetstr)
+        if reverse:
+            return (rematch is None)
+        return (rematch is not None)
+
+    def matches(self, pkg):
+        """ Return True if the package matches this filter, without
+            calling `self.on_match()`.
+        """
         # Trim filtered packages.
         if not self.install_state.matches_pkg(pkg):
             return False
@@ -1571,35 +3962,41 @@ class AptToolFilter(apt.cache.Filter):
             return False
         # Try matching the name. (reverse handled also.)
         if self.match_str(pkg.name, self.reverse):
-            return self.on_match(pkg)
+            return True
         if not self.use_desc:
             return False
 
+        # The summary is cheaper to get than the long description, and it
+        # decides the match when the pattern is found in it. Reverse
+        # searches (-r) are rejected here.
+        # The long description is only loaded when it doesn't.
+        pkgsummary = get_pkg_summary(pkg)
+        if pkgsummary and (self.pattern.search(pkgsummary) is not None):
+            return not self.reverse
+
         pkgdesc = get_pkg_description(pkg)
 
         # Try matching description.
         if pkgdesc and self.match_str(pkgdesc, self.reverse):
-            return self.on_match(pkg)
+            return True
         # No match/no desc to search
         return False
 
-    def match_name(self, pkg):
-        if self.name_pat is None:
-            return True
-        return self.name_pat.search(pkg.name) is not None
-
-    def match_str(self, targetstr, reverse=False):
-        rematch = self.pattern.search(targetstr)
-        if reverse:
-            return (rematch is None)
-        return (rematch is not None)
-
     def on_match(self, pkg):
         """ This is called when the filter matches the package,
-            right now it just prints the package info.
+            right now it just writes the package info.
             It's called from `self.apply()`.
         """
-        print('\n{}'.format(
+        if self.writer is not None:
+            self.writer.write(
+                pkg.name,
+                pkg_install_state(pkg),
+                get_latest_ver(pkg),
+                get_pkg_summary(pkg),
+                get_pkg_description(pkg),
+            )
+            return True
+        self.output.write('\n{}\n'.format(
             pkg_format(
                 pkg,
                 no_desc=self.print_no_desc,
@@ -1608,6 +4005,15 @@ class AptToolFilter(apt.cache.Filter):
         ))
         return True
 
+    def poll(self):
+        """ Write buffered results if they have been held too long
+            (see OutputBuffer.poll()).
+        """
+        if self.writer is None:
+            self.output.poll()
+        else:
+            self.writer.output.poll()
+
 
 # Fatal Errors that will end this script when raised.
 class BadSearchQuery(ValueError):
@@ -1615,57 +4021,889 @@ class BadSearchQuery(ValueError):
         self.pattern = getattr(pattern, 'pattern', str(pattern))
         self.message = str(re_error)
 
-    def __str__(self):
-        return 'Bad search query \'{}\': {}'.format(
-            self.pattern,
-            self.message
-        )
+    def __str__(self):
+        return 'Bad search query \'{}\': {}'.format(
+            self.pattern,
+            self.message
+        )
+
+
+class CacheNotLoaded(Exception):
+    pass
+
+
+class InstallStateEnum(Enum):
+
+    """ For querying packages with a certain install state. """
+    uninstalled = -1
+    every = 0
+    installed = 1
+
+    def __colr__(self):
+        """ Colr representation. """
+        return C(str(self), 'blue', style='bright')
+
+    def __str__(self):
+        """ Enhanced representation for console. """
+        return {
+            InstallStateEnum.uninstalled.value: 'uninstalled',
+            InstallStateEnum.every.value: 'all',
+            InstallStateEnum.installed.value: 'installed'
+        }.get(self.value, 'unknown')
+
+    def filter_pkgs(self, pkglst):
+        """ Return a filter object with packages matching this install state.
+        """
+
+        return filter(
+            lambda pkg: pkg_install_state(pkg, expected=self),
+            pkglst
+        )
+
+    @classmethod
+    def from_argd(cls, argd):
+        """ Maps a filter arg to an actual InstallStateEnum. """
+        if argd['--INSTALLED']:
+            return cls.installed
+        if argd['--NOTINSTALLED']:
+            return cls.uninstalled
+        return cls.every
+
+    def matches_pkg(self, pkg):
+        """ Return True if the `pkg` matches this install state filter. """
+        return pkg_install_state(pkg, expected=self)
+
+
+# Output for daemon clients (see daemon_handle()).
+class DaemonStream(object):
+
+    """ A file-like object that sends everything written to it to a daemon
+        client (see daemon_request()), as JSON lines.
+    """
+
+    def __init__(self, connfile, stream):
+        self.connfile = connfile
+        self.stream = stream
+
+    def flush(self):
+        self.connfile.flush()
+
+    def isatty(self):
+        # Spinners and other tty-only output are never sent to clients.
+        return False
+
+    def write(self, s):
+        import json
+        if not s:
+            return 0
+        self.connfile.write(
+            json.dumps({'stream': self.stream, 'data': s}).encode('utf-8')
+        )
+        self.connfile.write(b'\n')
+        self.connfile.flush()
+        return len(s)
+
+
+# Persistent dependency graph for -P --recursive.
+class DependencyGraph(object):
+
+    """ Dependencies (Depends/Pre-Depends) for every package in the cache,
+        using integer package ids and array-backed adjacency lists, for
+        transitive dependency closures (-P --recursive).
+        Each dependency is resolved to a single package: an installed
+        alternative if there is one, otherwise the first alternative (or
+        provider of a virtual package) that exists. Installed packages use
+        the dependencies of their installed version, others use the
+        candidate version.
+    """
+    index_name = 'depends'
+
+    def __init__(
+            self, names, offsets, targets, installed, sizes, missing=None,
+            stamp=None):
+        # Package names, by id.
+        self.names = names
+        self.ids = {name: i for i, name in enumerate(names)}
+        # Dependency ids for a package: targets[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+        self.targets = targets
+        # 1 for installed packages, by id.
+        self.installed = installed
+        # Download size for packages that are not installed, by id.
+        self.sizes = sizes
+        # {id: [dependency, ...]} for dependencies that can't be resolved.
+        self.missing = missing or {}
+        self.stamp = stamp or file_stamp(APT_STATE_FILES)
+
+    def closure(self, rootids):
+        """ Find every package needed by the `rootids` packages.
+            Returns a tuple of ([(id, depth, parent_id), ...], cycles),
+            where the closure is in breadth-first order (each package at
+            it's smallest depth), and cycles is a list of id lists like
+            [a, b, a], one for every dependency that leads back to a
+            package that is still being followed.
+        """
+        offsets = self.offsets
+        targets = self.targets
+        seen = set(rootids)
+        closure = []
+        level = list(rootids)
+        depth = 0
+        while level:
+            depth += 1
+            nextlevel = []
+            for pkgid in level:
+                for depid in targets[offsets[pkgid]:offsets[pkgid + 1]]:
+                    if depid in seen:
+                        continue
+                    seen.add(depid)
+                    closure.append((depid, depth, pkgid))
+                    nextlevel.append(depid)
+            level = nextlevel
+        return closure, self.find_cycles(rootids)
+
+    def find_cycles(self, rootids):
+        """ Return a list of dependency cycles reachable from `rootids`,
+            using an iterative depth-first search.
+        """
+        offsets = self.offsets
+        targets = self.targets
+        # Packages that were completely followed.
+        done = set()
+        cycles = []
+        for rootid in rootids:
+            if rootid in done:
+                continue
+            # Current path, and it's positions by id.
+            path = [rootid]
+            onpath = {rootid: 0}
+            # Next dependency position to follow, for each path entry.
+            stack = [offsets[rootid]]
+            while stack:
+                pkgid = path[-1]
+                pos = stack[-1]
+                if pos == offsets[pkgid + 1]:
+                    # All dependencies followed.
+                    done.add(pkgid)
+                    onpath.pop(pkgid)
+                    path.pop()
+                    stack.pop()
+                    continue
+                stack[-1] = pos + 1
+                depid = targets[pos]
+                if depid in onpath:
+                    cycles.append(path[onpath[depid]:] + [depid])
+                elif depid not in done:
+                    onpath[depid] = len(path)
+                    path.append(depid)
+                    stack.append(offsets[depid])
+        return cycles
+
+    @classmethod
+    def from_cache(cls, cache):
+        """ Build a DependencyGraph from a loaded apt.Cache. """
+        stamp = file_stamp(APT_STATE_FILES)
+        pkgs = list(cache)
+        names = [pkg.name for pkg in pkgs]
+        ids = {name: i for i, name in enumerate(names)}
+
+        def resolve(deplst):
+            """ Return the package id for a list of alternatives. """
+            found = []
+            for dep in deplst:
+                depid = ids.get(dep.name, None)
+                if depid is None:
+                    depid = ids.get(dep.name.rpartition(':')[0], None)
+                if depid is not None:
+                    found.append(depid)
+            if not found:
+                # Virtual packages.
+                for dep in deplst:
+                    found.extend(
+                        ids[provider.name]
+                        for provider in cache.get_providing_packages(dep.name)
+                        if provider.name in ids
+                    )
+            for depid in found:
+                if installed[depid]:
+                    return depid
+            return found[0] if found else None
+
+        installed = array(
+            'B',
+            (1 if pkg_install_state(pkg) else 0 for pkg in pkgs),
+        )
+        offsets = array('L', [0])
+        targets = array('L')
+        sizes = array('Q')
+        missing = {}
+        for pkgid, pkg in enumerate(pkgs):
+            ver = pkg.installed or pkg.candidate
+            if installed[pkgid] or (ver is None):
+                sizes.append(0)
+            else:
+                sizes.append(ver.size or 0)
+            pkgtargets = set()
+            for deplst in (ver.dependencies if ver is not None else ()):
+                depid = resolve(deplst)
+                if depid is None:
+                    missing.setdefault(pkgid, []).append(
+                        ' | '.join(dep.name for dep in deplst)
+                    )
+                elif (depid != pkgid) and (depid not in pkgtargets):
+                    pkgtargets.add(depid)
+                    targets.append(depid)
+            offsets.append(len(targets))
+        return cls(
+            names,
+            offsets,
+            targets,
+            installed,
+            sizes,
+            missing=missing,
+            stamp=stamp,
+        )
+
+    @classmethod
+    def load(cls):
+        """ Load the saved DependencyGraph.
+            Returns None if it is missing or out of date.
+        """
+        stamp = file_stamp(APT_STATE_FILES)
+        data = index_read(cls.index_name, stamp)
+        if not data:
+            return None
+        return cls(
+            data['names'],
+            data['offsets'],
+            data['targets'],
+            data['installed'],
+            data['sizes'],
+            missing=data['missing'],
+            stamp=stamp,
+        )
+
+    def save(self):
+        """ Save this DependencyGraph. Returns True on success. """
+        return index_write(
+            self.index_name,
+            {
+                'names': self.names,
+                'offsets': self.offsets,
+                'targets': self.targets,
+                'installed': self.installed,
+                'sizes': self.sizes,
+                'missing': self.missing,
+            },
+            self.stamp,
+        )
+
+
+# Persistent installed-file index for --containsfile.
+class FileIndex(object):
+
+    """ A persistent index of installed files, built from dpkg's *.list files.
+        Only the list files that changed since the last run are read again.
+        Plain-text patterns (with optional ^ and $ anchors) are answered with
+        sorted lookups or a single scan, other patterns use regex on each
+        indexed path.
+    """
+    index_name = 'files'
+
+    def __init__(self, lists=None, prefix_order=None, suffix_order=None):
+        # {listname: (mtime_ns, size, (path, ...))}
+        self.lists = lists or {}
+        # Flattened paths/owners, in sorted listname order.
+        self.paths = []
+        self.owners = []
+        for listname in sorted(self.lists):
+            listpaths = self.lists[listname][2]
+            self.paths.extend(listpaths)
+            self.owners.extend(listname for _ in listpaths)
+        # Positions in self.paths, sorted by path and by reversed path.
+        self.prefix_order = prefix_order
+        self.suffix_order = suffix_order
+        if (
+                (self.prefix_order is None) or
+                (len(self.prefix_order) != len(self.paths))):
+            self.build_orders()
+        # Newline-joined paths for literal scans (built when needed).
+        self._blobs = {}
+
+    def _blob(self, shortnamesonly=False):
+        """ Return a (blob, offsets) tuple, where `blob` is every path (or
+            file name) joined by newlines, and `offsets` are the start
+            positions for each path in the blob.
+        """
+        blobinfo = self._blobs.get(shortnamesonly, None)
+        if blobinfo is not None:
+            return blobinfo
+        if shortnamesonly:
+            names = [os.path.split(s)[-1] for s in self.paths]
+        else:
+            names = self.paths
+        offsets = array('L')
+        pos = 1
+        for name in names:
+            offsets.append(pos)
+            pos += len(name) + 1
+        blobinfo = ('\n{}\n'.format('\n'.join(names)), offsets)
+        self._blobs[shortnamesonly] = blobinfo
+        return blobinfo
+
+    def build_orders(self):
+        """ Sort path positions for prefix and suffix lookups. """
+        paths = self.paths
+        self.prefix_order = array(
+            'L',
+            sorted(range(len(paths)), key=paths.__getitem__),
+        )
+        self.suffix_order = array(
+            'L',
+            sorted(range(len(paths)), key=lambda i: paths[i][::-1]),
+        )
+
+    @classmethod
+    def load(cls):
+        """ Load the saved FileIndex, update it, and save it if any list
+            files changed.
+        """
+        saved = index_read(cls.index_name, (DPKG_INFO_DIR,)) or {}
+        lists = saved.get('lists', None) or {}
+        if cls.update_lists(lists):
+            fileindex = cls(lists)
+            fileindex.save()
+        else:
+            fileindex = cls(
+                lists,
+                prefix_order=saved.get('prefix_order', None),
+                suffix_order=saved.get('suffix_order', None),
+            )
+        return fileindex
+
+    def match_literal(self, literal, anchored_start, anchored_end,
+                      shortnamesonly=False):
+        """ Return a sorted list of path positions matching a plain-text
+            pattern.
+        """
+        if shortnamesonly and ('/' in literal):
+            # File names never contain a /.
+            return []
+        paths = self.paths
+        if anchored_end and (not shortnamesonly or not anchored_start):
+            # Suffix lookup (file name suffixes are path suffixes).
+            order = self.suffix_order
+            found = (
+                order[i]
+                for i in sorted_prefix_range(
+                    order,
+                    lambda i: paths[i][::-1],
+                    literal[::-1],
+                )
+            )
+            if anchored_start:
+                found = (i for i in found if paths[i] == literal)
+            elif shortnamesonly:
+                # The whole literal has to be inside the file name.
+                found = (
+                    i for i in found
+                    if literal in os.path.split(paths[i])[-1]
+                )
+            return sorted(found)
+        if anchored_start and not shortnamesonly:
+            # Prefix lookup.
+            order = self.prefix_order
+            return sorted(
+                order[i]
+                for i in sorted_prefix_range(
+                    order,
+                    paths.__getitem__,
+                    literal,
+                )
+            )
+
+        # Substring scan over all paths at once.
+        blob, offsets = self._blob(shortnamesonly=shortnamesonly)
+        needle = '\n{}'.format(literal) if anchored_start else literal
+        needle = '{}\n'.format(needle) if anchored_end else needle
+        # Anchored needles start at the newline before the path.
+        skip = 1 if anchored_start else 0
+        found = []
+        pos = blob.find(needle)
+        while pos != -1:
+            # Position of the path this match was found in.
+            i = bisect_right(offsets, pos + skip) - 1
+            found.append(i)
+            if i + 1 >= len(offsets):
+                break
+            pos = blob.find(needle, offsets[i + 1] - skip)
+        return found
+
+    def save(self):
+        """ Save this FileIndex. Returns True on success. """
+        return index_write(
+            self.index_name,
+            {
+                'lists': self.lists,
+                'prefix_order': self.prefix_order,
+                'suffix_order': self.suffix_order,
+            },
+            (DPKG_INFO_DIR,),
+        )
+
+    def search(self, repat, shortnamesonly=False):
+        """ Yield (listname, [matching paths]) for each list with matching
+            files, in listname order.
+            Arguments:
+                repat           : Compiled regex pattern to search for.
+                shortnamesonly  : Only match file names, not full paths.
+        """
+        literalinfo = None
+        if not repat.flags & (re.IGNORECASE | re.VERBOSE):
+            literalinfo = pattern_literal(repat.pattern)
+        if literalinfo is None:
+            if shortnamesonly:
+                found = (
+                    i for i, s in enumerate(self.paths)
+                    if repat.search(os.path.split(s)[-1])
+                )
+            else:
+                found = (
+                    i for i, s in enumerate(self.paths)
+                    if repat.search(s)
+                )
+        else:
+            found = self.match_literal(
+                *literalinfo,
+                shortnamesonly=shortnamesonly
+            )
+
+        lastowner = None
+        matchingfiles = []
+        for i in found:
+            owner = self.owners[i]
+            if owner != lastowner:
+                if matchingfiles:
+                    yield lastowner, matchingfiles
+                lastowner = owner
+                matchingfiles = []
+            matchingfiles.append(self.paths[i])
+        if matchingfiles:
+            yield lastowner, matchingfiles
+
+    @staticmethod
+    def update_lists(lists):
+        """ Re-read any *.list files that changed, and remove missing ones.
+            `lists` is modified in place.
+            Returns True if anything changed.
+        """
+        changed = False
+        seen = set()
+        try:
+            entries = list(os.scandir(DPKG_INFO_DIR))
+        except EnvironmentError as ex:
+            print_err('\nUnable to list dpkg files: {}\n{}'.format(
+                DPKG_INFO_DIR,
+                ex,
+            ))
+            entries = []
+        for entry in entries:
+            listname, ext = os.path.splitext(entry.name)
+            if ext != '.list':
+                continue
+            try:
+                st = entry.stat()
+            except EnvironmentError:
+                continue
+            seen.add(listname)
+            existing = lists.get(listname, None)
+            if existing and existing[:2] == (st.st_mtime_ns, st.st_size):
+                continue
+            try:
+                with open(entry.path, 'rb') as f:
+                    listpaths = tuple(
+                        s for s in f.read().decode(
+                            'utf-8',
+                            errors='replace'
+                        ).split('\n')
+                        if s
+                    )
+            except EnvironmentError:
+                continue
+            lists[listname] = (st.st_mtime_ns, st.st_size, listpaths)
+            changed = True
+        for listname in set(lists).difference(seen):
+            lists.pop(listname)
+            changed = True
+        return changed
+
+
+# Persistent dpkg.log index for -H --since/--until/--package/--action.
+class HistoryIndex(object):
+
+    """ A persistent, append-only index of dpkg.log entries, for -H with
+        --since/--until/--package/--action.
+        Entries are kept in time order, in parallel arrays, with postings
+        (entry positions) for every package name and entry kind. Time
+        ranges are found with a binary search, and names/kinds with the
+        postings, instead of parsing every line.
+        Logs are only read from the last indexed byte offset. Rotated logs
+        are recognized by their first line, so no entry is read twice, and
+        entries are kept after their log is deleted.
+    """
+    index_name = 'history'
+    # Entry types with a package name (see HistoryLine.from_dpkg_line()).
+    pkg_types = (
+        'configure',
+        'install',
+        'purge',
+        'remove',
+        'status',
+        'trigproc',
+        'upgrade',
+    )
+
+    def __init__(self, data=None):
+        data = data or {}
+        # Seconds (see time_key()) for each entry, in time order.
+        self.times = data.get('times', None) or array('q')
+        # Per-entry ids for self.kinds, self.pkgnames, and self.args.
+        self.kindids = data.get('kindids', None) or array('H')
+        self.pkgids = data.get('pkgids', None) or array('L')
+        self.argids = data.get('argids', None) or array('L')
+        # Entry kinds ('configure', 'status installed', 'startup ...').
+        self.kinds = data.get('kinds', None) or []
+        # Raw package names (name:arch). Startup entries use ''.
+        self.pkgnames = data.get('pkgnames', None) or ['']
+        # The rest of the line after the package name (versions).
+        self.args = data.get('args', None) or ['']
+        # Postings: {kindid: array('L')} and {name: array('L')}.
+        self.by_kind = data.get('by_kind', None) or {}
+        self.by_name = data.get('by_name', None) or {}
+        # {filename: (mtime_ns, size, first line)} for every log read.
+        self.logs = data.get('logs', None) or {}
+        # {first line: offset} for every log read.
+        self.offsets = data.get('offsets', None) or {}
+
+        self.kind_ids = {s: i for i, s in enumerate(self.kinds)}
+        self.pkg_ids = {s: i for i, s in enumerate(self.pkgnames)}
+        self.arg_ids = {s: i for i, s in enumerate(self.args)}
+        self.unsorted = False
+
+    def __len__(self):
+        return len(self.times)
+
+    def add_line(self, line):
+        """ Add a single line from dpkg.log.
+            Returns True if it was added, or False if it was skipped.
+        """
+        parts = line.split(' ')
+        try:
+            entrytime = parse_history_time(' '.join(parts[:2]))
+            entrytype = parts[2]
+            if entrytype == 'status':
+                kind = ' '.join(parts[2:4])
+                pkgname = parts[4]
+                args = parts[5:]
+            elif entrytype in self.pkg_types:
+                kind = entrytype
+                pkgname = parts[3]
+                args = parts[4:]
+            elif entrytype == 'startup':
+                kind = ' '.join(parts[2:])
+                pkgname = ''
+                args = ()
+            else:
+                return False
+        except (IndexError, ValueError):
+            return False
+        if (pkgname and not args) or (len(args) > 2):
+            return False
 
+        pos = len(self.times)
+        timekey = self.time_key(entrytime)
+        if pos and (timekey < self.times[-1]):
+            self.unsorted = True
+        self.times.append(timekey)
+        kindid = self.intern(kind, self.kinds, self.kind_ids)
+        self.kindids.append(kindid)
+        self.pkgids.append(
+            self.intern(pkgname, self.pkgnames, self.pkg_ids)
+        )
+        self.argids.append(
+            self.intern(' '.join(args), self.args, self.arg_ids)
+        )
+        self.by_kind.setdefault(kindid, array('L')).append(pos)
+        if pkgname:
+            name = pkgname.partition(':')[0]
+            self.by_name.setdefault(name, array('L')).append(pos)
+        return True
 
-class CacheNotLoaded(Exception):
-    pass
+    def entry(self, pos, times=None):
+        """ Build a HistoryLine for an entry from the indexed fields,
+            without parsing the dpkg.log line again.
+            Returns None for entries without a package (startup lines).
+            Arguments:
+                pos    : Entry position.
+                times  : Dict of {time_key: (datetime, time string)}, to
+                         share the times of entries from the same second.
+        """
+        pkgnameraw = self.pkgnames[self.pkgids[pos]]
+        if not pkgnameraw:
+            return None
+        timekey = self.times[pos]
+        timeinfo = None if times is None else times.get(timekey, None)
+        if timeinfo is None:
+            days, seconds = divmod(timekey, 86400)
+            entrytime = datetime.fromordinal(days) + timedelta(seconds=seconds)
+            timeinfo = (entrytime, str(entrytime))
+            if times is not None:
+                times[timekey] = timeinfo
+        kind = self.kinds[self.kindids[pos]]
+        statustype, _, action = kind.partition(' ')
+        args = self.args[self.argids[pos]]
+        argparts = args.split(' ')
+        pkgfromver = None
+        if statustype in ('install', 'upgrade'):
+            if len(argparts) < 2:
+                return None
+            if argparts[0] != '<none>':
+                pkgfromver = argparts[0]
+            pkgver = argparts[1]
+        else:
+            pkgver = argparts[0]
+        pkgname, _, pkgarch = pkgnameraw.partition(':')
+        return HistoryLine(
+            line=' '.join((timeinfo[1], kind, pkgnameraw, args)),
+            name=pkgname,
+            packagename=pkgnameraw,
+            version=pkgver,
+            previous_version=pkgfromver,
+            arch=pkgarch or None,
+            statustype=statustype,
+            action=action or None,
+            time=timeinfo[0],
+        )
 
+    @staticmethod
+    def intern(s, strings, ids):
+        """ Return the id for a string in `strings`, adding it if needed.
+        """
+        strid = ids.get(s, None)
+        if strid is None:
+            strid = ids[s] = len(strings)
+            strings.append(s)
+        return strid
 
-class InstallStateEnum(Enum):
+    @classmethod
+    def load(cls, logname=DPKG_LOG):
+        """ Load the saved HistoryIndex, and index any new log lines.
+            It is saved again if anything changed.
+            Raises EnvironmentError if the logs can't be read.
+        """
+        historyindex = cls(index_read(cls.index_name, (logname,)))
+        if historyindex.update(logname=logname):
+            historyindex.save(logname=logname)
+        return historyindex
+
+    def positions(self, since=None, until=None, package=None, action=None):
+        """ Return a sorted list of entry positions matching all of the
+            given filters.
+            Arguments:
+                since    : Oldest time (datetime) to include.
+                until    : Newest time (datetime) to include.
+                package  : Package name, or name:arch.
+                action   : Action ('install', 'upgrade', ...), status
+                           ('installed', 'half-configured', ...), or entry
+                           type ('status', 'startup').
+        """
+        import heapq
+        lo = 0
+        hi = len(self.times)
+        if since is not None:
+            lo = bisect_left(self.times, self.time_key(since))
+        if until is not None:
+            hi = bisect_right(self.times, self.time_key(until))
+        if lo >= hi:
+            return []
+
+        postings = []
+        if package:
+            name, _, arch = package.partition(':')
+            found = self.posting_range(
+                self.by_name.get(name, ()),
+                lo,
+                hi,
+            )
+            if arch:
+                found = [
+                    i for i in found
+                    if self.pkgnames[self.pkgids[i]] == package
+                ]
+            postings.append(found)
+        if action:
+            kindids = [
+                kindid
+                for kindid, kind in enumerate(self.kinds)
+                if action in (kind, kind.partition(' ')[2])
+                or action == kind.partition(' ')[0]
+            ]
+            postings.append(list(heapq.merge(*(
+                self.posting_range(self.by_kind[kindid], lo, hi)
+                for kindid in kindids
+            ))))
+        if not postings:
+            return list(range(lo, hi))
+        postings.sort(key=len)
+        found = postings[0]
+        for posting in postings[1:]:
+            found = self.posting_intersect(found, posting)
+        return found
 
-    """ For querying packages with a certain install state. """
-    uninstalled = -1
-    every = 0
-    installed = 1
+    @staticmethod
+    def posting_intersect(small, large):
+        """ Return the positions found in both sorted postings. Positions
+            from the smaller posting are found in the larger one with a
+            binary search, starting after the last one found.
+        """
+        found = []
+        lo = 0
+        end = len(large)
+        for pos in small:
+            lo = bisect_left(large, pos, lo, end)
+            if lo == end:
+                break
+            if large[lo] == pos:
+                found.append(pos)
+        return found
 
-    def __colr__(self):
-        """ Colr representation. """
-        return C(str(self), 'blue', style='bright')
+    @staticmethod
+    def posting_range(posting, lo, hi):
+        """ Return the part of a sorted posting that is within [lo, hi). """
+        return posting[bisect_left(posting, lo):bisect_left(posting, hi)]
 
-    def __str__(self):
-        """ Enhanced representation for console. """
-        return {
-            InstallStateEnum.uninstalled.value: 'uninstalled',
-            InstallStateEnum.every.value: 'all',
-            InstallStateEnum.installed.value: 'installed'
-        }.get(self.value, 'unknown')
+    def query(self, since=None, until=None, package=None, action=None):
+        """ Yield HistoryLine()s for matching entries, latest first.
+            See positions() for arguments.
+        """
+        times = {}
+        for pos in reversed(self.positions(
+                since=since,
+                until=until,
+                package=package,
+                action=action)):
+            # Startup lines are not shown.
+            historyline = self.entry(pos, times=times)
+            if historyline is not None:
+                yield historyline
+
+    def save(self, logname=DPKG_LOG):
+        """ Save this HistoryIndex. Returns True on success. """
+        return index_write(
+            self.index_name,
+            {
+                'times': self.times,
+                'kindids': self.kindids,
+                'pkgids': self.pkgids,
+                'argids': self.argids,
+                'kinds': self.kinds,
+                'pkgnames': self.pkgnames,
+                'args': self.args,
+                'by_kind': self.by_kind,
+                'by_name': self.by_name,
+                'logs': self.logs,
+                'offsets': self.offsets,
+            },
+            (logname,),
+        )
 
-    def filter_pkgs(self, pkglst):
-        """ Return a filter object with packages matching this install state.
+    def sort(self):
+        """ Put entries back in time order, after an older log was indexed
+            after newer ones. Postings are rebuilt.
         """
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        self.times = array('q', (self.times[i] for i in order))
+        self.kindids = array('H', (self.kindids[i] for i in order))
+        self.pkgids = array('L', (self.pkgids[i] for i in order))
+        self.argids = array('L', (self.argids[i] for i in order))
+        self.by_kind = {}
+        self.by_name = {}
+        for pos, (kindid, pkgid) in enumerate(zip(self.kindids, self.pkgids)):
+            self.by_kind.setdefault(kindid, array('L')).append(pos)
+            if pkgid:
+                name = self.pkgnames[pkgid].partition(':')[0]
+                self.by_name.setdefault(name, array('L')).append(pos)
+        self.unsorted = False
 
-        return filter(
-            lambda pkg: pkg_install_state(pkg, expected=self),
-            pkglst
+    @staticmethod
+    def time_key(dt):
+        """ Convert a datetime into whole seconds, for sorting/searching. """
+        return (
+            (dt.toordinal() * 86400) +
+            (dt.hour * 3600) +
+            (dt.minute * 60) +
+            dt.second
         )
 
-    @classmethod
-    def from_argd(cls, argd):
-        """ Maps a filter arg to an actual InstallStateEnum. """
-        if argd['--INSTALLED']:
-            return cls.installed
-        if argd['--NOTINSTALLED']:
-            return cls.uninstalled
-        return cls.every
-
-    def matches_pkg(self, pkg):
-        """ Return True if the `pkg` matches this install state filter. """
-        return pkg_install_state(pkg, expected=self)
+    def update(self, logname=DPKG_LOG):
+        """ Index new lines from dpkg.log and it's rotated logs, oldest
+            first. Returns True if anything changed.
+            Raises FileNotFoundError if there are no logs, and nothing has
+            been indexed.
+        """
+        filenames = history_filenames(logname)
+        if not (filenames or self.times):
+            raise FileNotFoundError('File does not exist: {}'.format(logname))
+        changed = False
+        for filename in reversed(filenames):
+            try:
+                changed = self.update_file(filename) or changed
+            except (EnvironmentError, EOFError) as exread:
+                errfmt = 'Failed to read history: {}\n{}'
+                raise EnvironmentError(errfmt.format(filename, exread))
+        # Forget logs that were rotated away. Their entries are kept.
+        for filename in set(self.logs).difference(filenames):
+            self.logs.pop(filename)
+            changed = True
+        signatures = {info[2] for info in self.logs.values()}
+        for signature in set(self.offsets).difference(signatures):
+            self.offsets.pop(signature)
+        if self.unsorted:
+            self.sort()
+        return changed
+
+    def update_file(self, filename):
+        """ Index new lines from a single dpkg log, starting at the offset
+            where the last update stopped reading it.
+            Returns True if anything changed.
+        """
+        import gzip
+        st = os.stat(filename)
+        stamp = (st.st_mtime_ns, st.st_size)
+        known = self.logs.get(filename, None)
+        if known and (known[:2] == stamp):
+            return False
+        compressed = filename.endswith('.gz')
+        opener = gzip.open if compressed else open
+        with opener(filename, 'rb') as f:
+            signature = f.readline()
+            if not signature.endswith(b'\n'):
+                # Empty, or the first line isn't finished yet.
+                return False
+            offset = self.offsets.get(signature, 0)
+            if (not compressed) and (offset > st.st_size):
+                # Truncated and rewritten, this is a new log.
+                offset = 0
+            f.seek(offset)
+            data = f.read()
+        # Incomplete lines are read again on the next update.
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8', errors='replace').split('\n'):
+            if line:
+                self.add_line(line)
+        self.offsets[signature] = offset + end
+        self.logs[filename] = (st.st_mtime_ns, st.st_size, signature)
+        return True
 
 
 # History package info.
@@ -1681,19 +4919,25 @@ class HistoryLine(object):
         Handles package/state matching based on regex:
             self.matches('^install')
     """
+    __slots__ = (
+        'line',
+        'name',
+        'packagename',
+        'version',
+        'previous_version',
+        'arch',
+        'statustype',
+        'action',
+        'time',
+    )
 
     def __init__(self, **kwargs):
-        self.line = None
-        self.name = None
-        self.packagename = None
-        self.version = None
-        self.previous_version = None
-        self.arch = None
-        self.statustype = None
-        self.action = None
-        self.time = None
-
-        self.__dict__.update(kwargs)
+        for attr in self.__slots__:
+            setattr(self, attr, kwargs.pop(attr, None))
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: {}'.format(
+                ', '.join(sorted(kwargs))
+            ))
 
     def __repr__(self):
         """ Same as __str__()... """
@@ -1732,10 +4976,9 @@ class HistoryLine(object):
             return None
 
         parts = line.split(' ')
-        timestr = ' '.join((parts[0], parts[1]))
-        timefmt = '%Y-%m-%d %H:%M:%S'
+        timestr = ' '.join(parts[:2])
         try:
-            statustime = datetime.strptime(timestr, timefmt)
+            statustime = parse_history_time(timestr)
         except ValueError as extime:
             print_err(
                 '\nError parsing history time: {}\n{}'.format(timestr, extime)
@@ -1755,7 +4998,7 @@ class HistoryLine(object):
                     pkgname = pkgnameraw
                     pkgarch = None
                 pkgver = parts[5]
-            elif statustype in {'configure', 'trigproc'}:
+            elif statustype in {'configure', 'purge', 'remove', 'trigproc'}:
                 pkgnameraw = parts[3]
                 try:
                     pkgname, pkgarch = pkgnameraw.split(':')
@@ -1794,6 +5037,28 @@ class HistoryLine(object):
         )
         return pkginfo
 
+    @staticmethod
+    def prefilter(repat):
+        """ Return a function to quickly reject raw dpkg.log lines that can't
+            possibly match a regex pattern (see matches()), or None if the
+            pattern can't be used that way.
+
+            Every field that matches() tests is a part of the raw line, so an
+            unanchored pattern that doesn't match the line won't match any
+            of the fields either. Anchors and lookarounds behave differently
+            on parts of a line, so those patterns are not prefiltered.
+        """
+        if not repat:
+            return None
+        pattern = repat.pattern
+        if isinstance(pattern, bytes):
+            return None
+        if ('^' in pattern) or ('$' in pattern) or ('(?' in pattern):
+            return None
+        if ('\\A' in pattern) or ('\\Z' in pattern):
+            return None
+        return repat.search
+
     def matches(self, repat):
         """ See if this history line matches a regex pattern.
             This tests the raw line, status type, date/time.
@@ -1821,6 +5086,229 @@ class HistoryLine(object):
         return False
 
 
+class HistoryTransaction(object):
+
+    """ A group of dpkg.log entries that were part of the same apt/dpkg
+        operation (see iter_history_transactions()).
+        Only counts and a few example package names are kept after a
+        transaction is closed.
+    """
+    __slots__ = (
+        'start',
+        'end',
+        'runs',
+        'installed',
+        'upgraded',
+        'removed',
+        'examples',
+        'matched',
+    )
+    # Entry types for each kind of change.
+    change_types = {
+        'install': 'installed',
+        'upgrade': 'upgraded',
+        'remove': 'removed',
+        'purge': 'removed',
+    }
+    # Number of example package names to keep for each kind of change.
+    example_cnt = 5
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        # Number of dpkg runs ('startup archives/packages ...' lines).
+        self.runs = 0
+        # Package names (name:arch) while open, package counts after
+        # close().
+        self.installed = set()
+        self.upgraded = set()
+        self.removed = set()
+        # {'installed': [name, ...], ...}, set by close().
+        self.examples = {}
+        # Whether a package matched the filter (see close()).
+        self.matched = False
+
+    def __str__(self):
+        """ Format this transaction, with example package names. """
+        lines = [
+            '[{}] ({}) installed: {}, upgraded: {}, removed: {}'.format(
+                self.start,
+                self.duration,
+                self.installed,
+                self.upgraded,
+                self.removed,
+            )
+        ]
+        for change in ('installed', 'upgraded', 'removed'):
+            names = self.examples.get(change, None)
+            if not names:
+                continue
+            more = getattr(self, change) - len(names)
+            lines.append('    {}: {}{}'.format(
+                change,
+                ', '.join(names),
+                ', ... ({} more)'.format(more) if more else '',
+            ))
+        return '\n'.join(lines)
+
+    def add(self, entrytype, pkgname, when):
+        """ Add a single package change (name:arch) to this transaction.
+        """
+        self.end = when
+        change = self.change_types.get(entrytype, None)
+        if change is not None:
+            getattr(self, change).add(pkgname)
+
+    def close(self, repat=None, package=None):
+        """ Replace the package names with counts and example names.
+            `matched` is set when the transaction passes both filters.
+            Arguments:
+                repat    : Compiled regex, for any package name.
+                package  : Package name, or name:arch, that must have been
+                           changed in this transaction.
+        """
+        pkgmatched = not package
+        patmatched = repat is None
+        for change in ('installed', 'upgraded', 'removed'):
+            pkgnames = getattr(self, change)
+            # Packages are counted and shown without the architecture.
+            names = {pkgname.partition(':')[0] for pkgname in pkgnames}
+            if not pkgmatched:
+                pkgmatched = package in (
+                    pkgnames if (':' in package) else names
+                )
+            if not patmatched:
+                patmatched = any(repat.search(name) for name in names)
+            self.examples[change] = sorted(names)[:self.example_cnt]
+            setattr(self, change, len(names))
+        self.matched = pkgmatched and patmatched
+
+    @property
+    def duration(self):
+        """ Time between the first and last entries, as a timedelta. """
+        return self.end - self.start
+
+
+class LazyAptBase(object):
+
+    """ Base for classes that need python-apt classes as base classes.
+        The real class, with the `apt_bases` classes added, is built the
+        first time an instance is created, so apt isn't imported until it
+        is needed (see apt_load()).
+    """
+    # Dotted names of the base classes, relative to the `apt` module.
+    apt_bases = ()
+    # Real classes that were built, {cls: aptcls}.
+    apt_classes = {}
+
+    def __new__(cls, *args, **kwargs):
+        aptcls = LazyAptBase.apt_classes.get(cls, None)
+        if aptcls is None:
+            bases = [cls]
+            for basename in cls.apt_bases:
+                base = apt_load()
+                for attr in basename.split('.'):
+                    base = getattr(base, attr)
+                bases.append(base)
+            aptcls = type(cls.__name__, tuple(bases), {})
+            LazyAptBase.apt_classes[cls] = aptcls
+            # Instances of the real class are created directly.
+            LazyAptBase.apt_classes[aptcls] = aptcls
+        return object.__new__(aptcls)
+
+
+class OutputBuffer(object):
+    """ Batches output for results, and writes it when the buffer size or
+        flush interval is exceeded.
+        On a tty, the default is to write every result as soon as it is
+        found. When piped, results are written in large blocks instead.
+    """
+    def __init__(self, file=None, bufsize=None, interval=None):
+        """ Initialize an OutputBuffer.
+            Arguments:
+                file      : File to write to.
+                            Default: sys.stdout
+                bufsize   : Number of characters to buffer before writing.
+                            Use 0 to write on every write() call.
+                            Default: 0 for ttys, otherwise OUTPUT_BUFSIZE
+                interval  : Maximum number of seconds to hold buffered
+                            output, checked on every write() or poll()
+                            call.
+                            Default: OUTPUT_INTERVAL
+        """
+        self.file = file or sys.stdout
+        if bufsize is None:
+            bufsize = 0 if self.file.isatty() else OUTPUT_BUFSIZE
+        self.bufsize = bufsize
+        self.interval = OUTPUT_INTERVAL if interval is None else interval
+        self.buffer = []
+        self.buffered = 0
+        self.flushed = time()
+
+    def flush(self):
+        """ Write any buffered output. """
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        self.file.flush()
+        self.flushed = time()
+
+    def poll(self):
+        """ Write the buffer if it has been held for `interval` seconds.
+            write() only checks this when there is more output, so this
+            should be called while doing slow work between writes.
+        """
+        if self.buffer and ((time() - self.flushed) >= self.interval):
+            self.flush()
+
+    def write(self, s):
+        """ Buffer a string, and write the buffer if needed. """
+        self.buffer.append(s)
+        self.buffered += len(s)
+        if self.buffered >= self.bufsize:
+            self.flush()
+        elif (time() - self.flushed) >= self.interval:
+            self.flush()
+
+
+class PackageNameSet(object):
+
+    """ Names of every package in the cache, for fast membership tests
+        (-l --bulk).
+        Arch-qualified names (name:arch) are found like apt.Cache finds
+        them. Foreign architectures must match exactly, and the native
+        architecture or 'all' match native packages.
+    """
+
+    def __init__(self, names, nativearchs=None):
+        # Names, like apt.Cache.keys() ('name' for native packages,
+        # 'name:arch' for foreign packages).
+        self.names = set(names)
+        self.nativearchs = set(nativearchs or ('all',))
+
+    def __contains__(self, name):
+        if name in self.names:
+            return True
+        basename, sep, arch = name.rpartition(':')
+        return (
+            bool(sep) and
+            (arch in self.nativearchs) and
+            (basename in self.names)
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_cache(cls, cache):
+        """ Build a PackageNameSet from a loaded apt.Cache. """
+        return cls(
+            cache.keys(),
+            nativearchs=(apt_pkg.config.find('APT::Architecture'), 'all'),
+        )
+
+
 class PackageVersions(UserList):
 
     def __init__(self, pkg):
@@ -1835,11 +5323,7 @@ class PackageVersions(UserList):
         self.data = []
         for ver in pkg.versions:
             self.data.append(ver)
-            ver.has_backport = False
-            for origin in ver.origins:
-                if origin.archive.endswith('backports'):
-                    ver.has_backport = True
-                    break
+            ver.has_backport = version_has_backport(ver)
 
         self.installed = pkg.installed or None
 
@@ -1881,7 +5365,9 @@ class PackageVersions(UserList):
         """ Return a formatted description for the package version. """
         return '\nDescription:\n{}\n'.format(
             C(
-                FormatBlock(get_pkg_description(self.package)).format(
+                formatblock_load()(
+                    get_pkg_description(self.package)
+                ).format(
                     width=76,
                     newlines=True,
                     prepend='    '
@@ -1935,9 +5421,11 @@ class PackageVersions(UserList):
             # Installed, but warn about not being the latest version.
             fmt = C(' ').join(
                 C(self.installed.version, fore='green'),
-                (C('installed', fore='green')
-                    .reset(', latest version is: ')
-                    .yellow(self.latest))
+                C('').join(
+                    C('installed', fore='green'),
+                    ', latest version is: ',
+                    C(self.latest, fore='yellow'),
+                )
             )
             backportcheckver = self.installed
         else:
@@ -1954,9 +5442,820 @@ class PackageVersions(UserList):
         return str(fmt)
 
 
-class SimpleOpProgress(apt.progress.text.OpProgress):
+class PlainColr(str):
+
+    """ A stand-in for Colr, used until colors are enabled (see colr_load()).
+        It only supports the parts of Colr that apttool uses, and never adds
+        color codes.
+    """
+
+    def __new__(cls, text=None, fore=None, back=None, style=None):
+        if hasattr(text, '__colr__') and (fore, back, style) == (None,) * 3:
+            text = text.__colr__()
+        return str.__new__(cls, '' if text is None else text)
+
+    def join(self, *colrs):
+        """ Like Colr.join(), lists/tuples/generators are flattened. """
+        flat = []
+        for clr in colrs:
+            if isinstance(clr, (list, tuple, GeneratorType)):
+                flat.extend(str(c) for c in clr)
+            else:
+                flat.append(str(clr))
+        return self.__class__(str.join(self, flat))
+
+
+class Profiler(object):
+
+    """ Records timings and call counts for --profile/APTTOOL_TRACE.
+        Functions and methods are only wrapped when profiling is enabled
+        (see install()), so there is no cost otherwise.
+        Work done in worker processes (-j) is not included.
+    """
+    # Functions/methods to time, by phase. Time is only charged to the
+    # outermost phase that is running, so nested calls aren't counted twice.
+    phase_funcs = {
+        'cache_load': ('cache_load', 'call_with_spinner'),
+        'filter setup': (
+            'AptToolFilter.__init__',
+            'QueryMatcher.__init__',
+            'query_build',
+            'query_literals',
+        ),
+        # pkg_format_build() is only called when pkg_format() misses the
+        # cache, so the call counts show the hit rate.
+        'format': ('pkg_format', 'pkg_format_build', 'RecordWriter.write'),
+        'import apt': ('apt_load',),
+        'import colr': ('colr_load',),
+        'import fmtblock': ('formatblock_load',),
+        'index': (
+            'HistoryIndex.load',
+            'HistoryIndex.save',
+            'RankIndex.load',
+            'RankIndex.save',
+            'SearchIndex.load',
+            'SearchIndex.save',
+        ),
+        'match': ('AptToolFilter.matches',),
+        'output': ('OutputBuffer.flush', 'OutputBuffer.write'),
+    }
+    # Hot helpers that are only counted. Timing them would cost more than
+    # they do.
+    counted_funcs = (
+        'get_pkg_description',
+        'get_pkg_summary',
+        'pkg_install_state',
+    )
+
+    def __init__(self, start=None, pstatsfile=None):
+        self.start = start or perf_counter()
+        # File name for cProfile stats (see run()).
+        self.pstatsfile = pstatsfile
+        # {phase: [calls, seconds]}
+        self.phases = {}
+        # {function_name: calls}
+        self.calls = Counter()
+        # Outermost phase that is running, if any.
+        self.running = None
+
+    def add_phase(self, phase, seconds, calls=1):
+        """ Add time for a phase that was timed some other way. """
+        info = self.phases.setdefault(phase, [0, 0.0])
+        info[0] += calls
+        info[1] += seconds
+
+    def install(self):
+        """ Wrap the functions/methods in `phase_funcs` and
+            `counted_funcs`. Returns self.
+        """
+        for phase, names in self.phase_funcs.items():
+            for name in names:
+                self.wrap(name, self.timed, phase)
+        for name in self.counted_funcs:
+            self.wrap(name, self.counted)
+        return self
+
+    def counted(self, func, name):
+        """ Return a wrapper for `func` that counts calls. """
+        calls = self.calls
+
+        @wraps(func)
+        def counted_func(*args, **kwargs):
+            calls[name] += 1
+            return func(*args, **kwargs)
+        return counted_func
+
+    def report(self, argv=None):
+        """ Return a dict with all timings and call counts. """
+        return {
+            'argv': sys.argv[1:] if argv is None else argv,
+            'total': perf_counter() - self.start,
+            'phases': {
+                phase: {
+                    'calls': calls,
+                    'seconds': seconds,
+                }
+                for phase, (calls, seconds) in sorted(
+                    self.phases.items(),
+                    key=lambda item: item[1][1],
+                    reverse=True,
+                )
+            },
+            'calls': dict(self.calls.most_common()),
+        }
+
+    def run(self, func, *args, **kwargs):
+        """ Run a function, with cProfile if `pstatsfile` is set, and
+            return it's result. The stats are saved to `pstatsfile`
+            (see `python3 -m pstats`).
+        """
+        if not self.pstatsfile:
+            return func(*args, **kwargs)
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            profile.dump_stats(self.pstatsfile)
+
+    def timed(self, func, name, phase):
+        """ Return a wrapper for `func` that counts calls, and adds it's
+            time to a phase, unless another phase is already running.
+        """
+        calls = self.calls
+
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            calls[name] += 1
+            if self.running is not None:
+                # The outermost phase is charged for this call.
+                return func(*args, **kwargs)
+            self.running = phase
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.running = None
+                self.add_phase(phase, perf_counter() - start)
+        return timed_func
+
+    def wrap(self, name, wrapper, *args):
+        """ Replace a module function or class method (by name, like
+            'pkg_format' or 'SearchIndex.load') with a wrapped version.
+        """
+        clsname, _, attr = name.rpartition('.')
+        if not clsname:
+            globals()[attr] = wrapper(globals()[attr], name, *args)
+            return
+        cls = globals()[clsname]
+        func = cls.__dict__[attr]
+        if isinstance(func, (classmethod, staticmethod)):
+            func = type(func)(wrapper(func.__func__, name, *args))
+        else:
+            func = wrapper(func, name, *args)
+        setattr(cls, attr, func)
+
+    def write(self, filename=None):
+        """ Write the report as JSON, to a file or stderr. """
+        import json
+        data = json.dumps(self.report(), indent=4)
+        if filename:
+            with open(filename, 'w') as f:
+                f.write(data)
+                f.write('\n')
+        else:
+            print(data, file=sys.stderr)
+
+
+class QueryMatcher(object):
+    """ Matches a query_build() regex pattern, testing the plain text from
+        the query's patterns (QueryLiterals) with fast substring checks
+        first. The results are always the same as `repat.search()`.
+
+        When any pattern may match, and every pattern is plain text, the
+        substring checks decide the match without running the regex.
+        When all patterns must match (-a), the regex only runs when every
+        plain text pattern is found.
+    """
+    def __init__(self, repat, literals):
+        """ Initialize a QueryMatcher.
+            Arguments:
+                repat     : Compiled regex pattern, from query_build().
+                literals  : QueryLiterals for the same query.
+        """
+        self.repat = repat
+        self.pattern = repat.pattern
+        self.all_required = literals.all_required
+        self.ignorecase = bool(repat.flags & re.IGNORECASE)
+        self.literals = literals.literals
+        if self.ignorecase:
+            if not all(info[0].isascii() for info in self.literals):
+                # Case-folding rules for non-ascii text are left to `re`.
+                self.literals = ()
+            self.literals = tuple(
+                (lit.lower(), anchored_start, anchored_end)
+                for lit, anchored_start, anchored_end in self.literals
+            )
+
+    def search(self, targetstr):
+        """ Like `repat.search()`, but returns True instead of a match
+            object when the regex was not needed.
+            Returns None when the pattern is not found.
+        """
+        if not self.literals:
+            return self.repat.search(targetstr)
+        if self.ignorecase:
+            if not targetstr.isascii():
+                return self.repat.search(targetstr)
+            targetstr_cmp = targetstr.lower()
+        else:
+            targetstr_cmp = targetstr
+
+        if self.all_required:
+            for literalinfo in self.literals:
+                if literalinfo[0] not in targetstr_cmp:
+                    return None
+            return self.repat.search(targetstr)
+
+        for lit, anchored_start, anchored_end in self.literals:
+            if anchored_end:
+                # $ also matches before a newline at the end.
+                if targetstr_cmp.endswith('\n'):
+                    endstr = targetstr_cmp[:-1]
+                else:
+                    endstr = targetstr_cmp
+                if anchored_start:
+                    if endstr == lit:
+                        return True
+                elif endstr.endswith(lit):
+                    return True
+            elif anchored_start:
+                if targetstr_cmp.startswith(lit):
+                    return True
+            elif lit in targetstr_cmp:
+                return True
+        return None
+
+
+class RankIndex(object):
+
+    """ A persistent inverted index of the tokens in package names and
+        descriptions, for ranked searches (--rank). It is built from a
+        SearchIndex, and record ids are positions in that SearchIndex.
+
+        Postings for every token are stored in a few flat arrays, sliced
+        with `offsets` by the token's position in the sorted `tokens` list.
+        Name postings are kept separately, so name hits can be boosted.
+        Names that only contain a query term (ssl in libssl3) are found by
+        checking the name tokens (a much shorter list than all of the
+        tokens), and boosted less.
+    """
+    index_name = 'rank'
+    # Score multipliers for a name hit, and for a token that only starts
+    # with a query term.
+    name_boost = 3.0
+    prefix_factor = 0.5
+    # Score multiplier when a query term is the full package name.
+    exact_boost = 2.0
+
+    def __init__(
+            self, tokens, offsets, ids, counts, name_offsets, name_ids,
+            name_positions, records=None, stamp=None):
+        # Sorted list of all tokens.
+        self.tokens = tokens
+        # Description postings: ids[offsets[i]:offsets[i + 1]] are the
+        # record ids with tokens[i], and counts has the number of times
+        # the token appears in each description (up to 255).
+        self.offsets = offsets
+        self.ids = ids
+        self.counts = counts
+        # Name postings: name_ids[name_offsets[i]:name_offsets[i + 1]].
+        self.name_offsets = name_offsets
+        self.name_ids = name_ids
+        # Positions in `tokens` for tokens that have name postings.
+        self.name_positions = name_positions
+        # SearchIndex that record ids refer to.
+        self.records = records
+        # Package names, in record id order.
+        self.names = [pkgrec.name for pkgrec in (records or ())]
+        self.stamp = stamp or file_stamp(APT_STATE_FILES)
+
+    @classmethod
+    def from_records(cls, records):
+        """ Build a RankIndex from a SearchIndex. """
+        textpostings = {}
+        namepostings = {}
+        for recid, pkgrec in enumerate(records):
+            for token in set(rank_tokens(pkgrec.name)):
+                namepostings.setdefault(token, []).append(recid)
+            desctokens = Counter(rank_tokens(pkgrec.summary))
+            desctokens.update(rank_tokens(pkgrec.description))
+            for token, cnt in desctokens.items():
+                postings = textpostings.get(token, None)
+                if postings is None:
+                    postings = textpostings[token] = ([], [])
+                postings[0].append(recid)
+                postings[1].append(cnt if cnt < 0xFF else 0xFF)
+
+        tokens = sorted(set(textpostings).union(namepostings))
+        offsets = array('I', [0])
+        ids = array('I')
+        counts = array('B')
+        name_offsets = array('I', [0])
+        name_ids = array('I')
+        nopostings = ((), ())
+        for token in tokens:
+            recids, tokcounts = textpostings.get(token, nopostings)
+            ids.extend(recids)
+            counts.extend(tokcounts)
+            offsets.append(len(ids))
+            name_ids.extend(namepostings.get(token, ()))
+            name_offsets.append(len(name_ids))
+
+        return cls(
+            tokens,
+            offsets,
+            ids,
+            counts,
+            name_offsets,
+            name_ids,
+            array(
+                'I',
+                (i for i, token in enumerate(tokens) if token in namepostings),
+            ),
+            records=records,
+            stamp=records.stamp,
+        )
+
+    @classmethod
+    def load(cls, records):
+        """ Load the saved RankIndex for a SearchIndex.
+            Returns None if it is missing or out of date.
+        """
+        data = index_read(cls.index_name, records.stamp)
+        if not data:
+            return None
+        return cls(
+            data['tokens'],
+            data['offsets'],
+            data['ids'],
+            data['counts'],
+            data['name_offsets'],
+            data['name_ids'],
+            data['name_positions'],
+            records=records,
+            stamp=records.stamp,
+        )
+
+    def name_matches(self, term):
+        """ Return a list of record ids for packages named `term`. """
+        tokens = rank_tokens(term)
+        if not tokens:
+            return []
+        i = bisect_left(self.tokens, tokens[0])
+        if (i == len(self.tokens)) or (self.tokens[i] != tokens[0]):
+            return []
+        name = term.lower()
+        return [
+            recid
+            for recid in self.name_ids[
+                self.name_offsets[i]:self.name_offsets[i + 1]
+            ]
+            if self.names[recid] == name
+        ]
+
+    def postings(self, term):
+        """ Return a dict of {record_id: weight} for a single query token.
+            Description tokens that only start with the term, and names
+            that only contain it, weigh less than exact tokens.
+        """
+        descslices = []
+        exactnames = ()
+        for i in sorted_prefix_range(self.tokens, str, term):
+            if self.tokens[i] == term:
+                factor = 1.0
+                exactnames = self.name_ids[
+                    self.name_offsets[i]:self.name_offsets[i + 1]
+                ]
+            else:
+                factor = self.prefix_factor
+            start, end = self.offsets[i], self.offsets[i + 1]
+            if start < end:
+                descslices.append((end - start, factor, start, end))
+        partialnames = set()
+        for i in compress(
+                self.name_positions,
+                map(
+                    str.__contains__,
+                    map(self.tokens.__getitem__, self.name_positions),
+                    repeat(term),
+                )):
+            partialnames.update(
+                self.name_ids[self.name_offsets[i]:self.name_offsets[i + 1]]
+            )
+        # The longest postings are copied into the dict without a loop.
+        descslices.sort(reverse=True)
+        weights = {}
+        for _, factor, start, end in descslices:
+            # 1 + log(count), so repeated tokens weigh a little more.
+            tokweights = map(
+                math.log,
+                map(math.e.__mul__, self.counts[start:end]),
+            )
+            if factor != 1.0:
+                tokweights = map(factor.__mul__, tokweights)
+            if not weights:
+                weights = dict(zip(self.ids[start:end], tokweights))
+                continue
+            for recid, weight in zip(self.ids[start:end], tokweights):
+                weights[recid] = weights.get(recid, 0) + weight
+        for recid in exactnames:
+            weights[recid] = weights.get(recid, 0) + self.name_boost
+        partialnames.difference_update(exactnames)
+        partialweight = self.name_boost * self.prefix_factor
+        for recid in partialnames:
+            weights[recid] = weights.get(recid, 0) + partialweight
+        return weights
+
+    def save(self):
+        """ Save this RankIndex. Returns True on success. """
+        return index_write(
+            self.index_name,
+            {
+                'tokens': self.tokens,
+                'offsets': self.offsets,
+                'ids': self.ids,
+                'counts': self.counts,
+                'name_offsets': self.name_offsets,
+                'name_ids': self.name_ids,
+                'name_positions': self.name_positions,
+            },
+            self.stamp,
+        )
+
+    def search(self, terms, install_state=None, top=25):
+        """ Find the records that have every query term, in the name or the
+            description.
+            Returns a tuple of ([(score, PackageRecord), ...], total), with
+            the best matches first. `total` is the number of matches before
+            they were trimmed to `top`.
+            Arguments:
+                terms          : Query strings, they are tokenized like
+                                 the index.
+                install_state  : InstallStateEnum to filter records.
+                top            : Maximum number of results to return.
+        """
+        import heapq
+        install_state = install_state or InstallStateEnum.every
+        querytokens = []
+        for term in terms:
+            querytokens.extend(rank_tokens(term))
+        if not querytokens:
+            return [], 0
+        # Intersect the smallest postings first.
+        termweights = sorted(
+            (self.postings(token) for token in set(querytokens)),
+            key=len,
+        )
+        if not termweights[0]:
+            return [], 0
+        # Rare terms count for more.
+        idfs = [
+            math.log(1 + (len(self.names) / len(weights)))
+            for weights in termweights
+        ]
+        if len(termweights) == 1:
+            # Every score has the same idf, it is applied to the best ones.
+            scores = termweights[0]
+            scale = idfs[0]
+        else:
+            matches = set(termweights[0])
+            for weights in termweights[1:]:
+                matches.intersection_update(weights)
+            matches = list(matches)
+            # Sum of idf * weight for every term, without a loop per match.
+            scores = dict(zip(
+                matches,
+                map(sum, zip(*(
+                    map(idf.__mul__, map(weights.__getitem__, matches))
+                    for idf, weights in zip(idfs, termweights)
+                ))),
+            ))
+            scale = 1.0
+        for term in terms:
+            for recid in self.name_matches(term):
+                if recid in scores:
+                    scores[recid] *= self.exact_boost
+        if install_state is not InstallStateEnum.every:
+            scores = {
+                recid: score
+                for recid, score in scores.items()
+                if install_state.matches_pkg(self.records[recid])
+            }
+        topscores = heapq.nlargest(top, scores.values())
+        if not topscores:
+            return [], len(scores)
+        # Only the records that can make the top scores are sorted, by
+        # score and then by name.
+        cutoff = topscores[-1]
+        best = sorted(
+            compress(scores, map(cutoff.__le__, scores.values())),
+            key=lambda recid: (-scores[recid], self.names[recid]),
+        )
+        return (
+            [
+                (scores[recid] * scale, self.records[recid])
+                for recid in best[:top]
+            ],
+            len(scores),
+        )
+
+
+class RecordWriter(object):
+    """ Writes one machine-readable record per result (for --format), straight
+        from the package/history data, without colors or FormatBlock.
+        Records are written through an OutputBuffer.
 
-    """ Handles progress updates for Operations """
+        Formats:
+            jsonl  : One JSON object per line.
+            nul    : Tab-separated fields, and every record ends with a NUL
+                     character instead of a newline.
+            tsv    : Tab-separated fields, one record per line.
+
+        For nul/tsv, None is written as an empty field, booleans are written
+        as 'true'/'false', and backslashes/separators in values are escaped
+        (\\t, \\n, etc.).
+    """
+    formats = ('jsonl', 'nul', 'tsv')
+    escapes = {
+        'nul': str.maketrans({
+            '\\': '\\\\',
+            '\t': '\\t',
+            '\0': '\\0',
+        }),
+        'tsv': str.maketrans({
+            '\\': '\\\\',
+            '\t': '\\t',
+            '\n': '\\n',
+            '\r': '\\r',
+        }),
+    }
+
+    def __init__(self, fmt, fields, output=None):
+        """ Initialize a RecordWriter.
+            Arguments:
+                fmt     : Output format, one of RecordWriter.formats.
+                fields  : Field names, in the same order as the values
+                          passed to write().
+                output  : OutputBuffer to write to.
+                          Default: OutputBuffer() (for stdout)
+        """
+        if fmt not in self.formats:
+            raise ValueError('Invalid format: {}'.format(fmt))
+        self.fmt = fmt
+        self.fields = tuple(fields)
+        self.output = output or OutputBuffer()
+        if fmt == 'jsonl':
+            self.format_record = self.format_jsonl
+        else:
+            self.format_record = self.format_delimited
+            self.table = self.escapes[fmt]
+            self.terminator = '\0' if fmt == 'nul' else '\n'
+
+    def flush(self):
+        """ Write any buffered records. """
+        self.output.flush()
+
+    def format_delimited(self, values):
+        """ Format a record for the nul/tsv formats. """
+        fieldstrs = []
+        for val in values:
+            if val is None:
+                fieldstrs.append('')
+            elif val is True:
+                fieldstrs.append('true')
+            elif val is False:
+                fieldstrs.append('false')
+            else:
+                fieldstrs.append(str(val).translate(self.table))
+        fieldstrs[-1] += self.terminator
+        return '\t'.join(fieldstrs)
+
+    def format_jsonl(self, values):
+        """ Format a record for the jsonl format. """
+        import json
+        return ''.join((
+            json.dumps(dict(zip(self.fields, values)), ensure_ascii=False),
+            '\n',
+        ))
+
+    def write(self, *values):
+        """ Write a single record, with one value for each field. """
+        self.output.write(self.format_record(values))
+
+
+class ReverseDependencyGraph(object):
+
+    """ Maps package names to the names of packages that depend on them,
+        built in one pass over the cache. Dependents are kept in cache order,
+        once for every dependency that names the package (like a full scan
+        of every package's dependencies would find them).
+    """
+    index_name = 'rdepends'
+
+    def __init__(self, rdepends=None, depcounts=None, installed=None,
+                 stamp=None):
+        # {depname: [dependent_name, ...]}
+        self.rdepends = rdepends or {}
+        # {pkgname: number of dependency lists for all versions}
+        self.depcounts = depcounts or {}
+        # Names of installed packages, for totals without the cache.
+        self.installed = set(installed or ())
+        self.stamp = stamp or file_stamp(APT_STATE_FILES)
+        self._totals = {}
+
+    def dependents(self, name):
+        """ Return a list of dependent package names for a package name. """
+        return self.rdepends.get(name, [])
+
+    @classmethod
+    def from_cache(cls, cache):
+        """ Build a ReverseDependencyGraph from a loaded apt.Cache. """
+        stamp = file_stamp(APT_STATE_FILES)
+        rdepends = {}
+        depcounts = {}
+        installed = []
+        for pkg in cache:
+            pkgname = pkg.name
+            if pkg_install_state(pkg):
+                installed.append(pkgname)
+            depcount = 0
+            for pkgver in pkg.versions:
+                for deplst in pkgver.dependencies:
+                    depcount += 1
+                    for dep in deplst:
+                        rdepends.setdefault(dep.name, []).append(pkgname)
+            depcounts[pkgname] = depcount
+        return cls(
+            rdepends=rdepends,
+            depcounts=depcounts,
+            installed=installed,
+            stamp=stamp,
+        )
+
+    @classmethod
+    def load(cls):
+        """ Load the saved ReverseDependencyGraph.
+            Returns None if it is missing or out of date.
+        """
+        stamp = file_stamp(APT_STATE_FILES)
+        data = index_read(cls.index_name, stamp)
+        if not data:
+            return None
+        return cls(
+            rdepends=data['rdepends'],
+            depcounts=data['depcounts'],
+            installed=data['installed'],
+            stamp=stamp,
+        )
+
+    def save(self):
+        """ Save this ReverseDependencyGraph. Returns True on success. """
+        return index_write(
+            self.index_name,
+            {
+                'rdepends': self.rdepends,
+                'depcounts': self.depcounts,
+                'installed': sorted(self.installed),
+            },
+            self.stamp,
+        )
+
+    def total(self, installstate=None):
+        """ Return the number of dependency lists for all packages matching
+            an InstallStateEnum.
+        """
+        installstate = installstate or InstallStateEnum.every
+        total = self._totals.get(installstate, None)
+        if total is not None:
+            return total
+        if installstate == InstallStateEnum.every:
+            total = sum(self.depcounts.values())
+        elif installstate == InstallStateEnum.installed:
+            total = sum(
+                cnt for name, cnt in self.depcounts.items()
+                if name in self.installed
+            )
+        else:
+            total = sum(
+                cnt for name, cnt in self.depcounts.items()
+                if name not in self.installed
+            )
+        self._totals[installstate] = total
+        return total
+
+
+class SearchIndex(UserList):
+
+    """ A persistent index of PackageRecords, for searching without loading
+        the apt cache. It is only valid until the apt/dpkg state changes.
+    """
+    index_name = 'search'
+
+    def __init__(self, records=None, stamp=None):
+        self.data = list(records or [])
+        self.stamp = stamp or file_stamp(APT_STATE_FILES)
+
+    @classmethod
+    def from_cache(cls, cache):
+        """ Build a SearchIndex from a loaded apt.Cache, in cache order. """
+        # Stamp before reading, so changes made while building are noticed.
+        stamp = file_stamp(APT_STATE_FILES)
+        return cls(
+            (
+                PackageRecord(
+                    pkg.name,
+                    pkg_install_state(pkg),
+                    get_latest_ver(pkg),
+                    get_pkg_summary(pkg),
+                    get_pkg_description(pkg),
+                )
+                for pkg in cache
+            ),
+            stamp=stamp,
+        )
+
+    @classmethod
+    def from_cache_refresh(cls, cache, repos):
+        """ Build a SearchIndex from a loaded apt.Cache, reusing the
+            summaries/descriptions from the last saved SearchIndex (even if
+            it is out of date) for packages that don't come from any of
+            the changed `repos` (see list_repo()), and whose latest version
+            hasn't changed.
+            Returns a tuple of (SearchIndex, number_of_reused_records).
+        """
+        stamp = file_stamp(APT_STATE_FILES)
+        columns = index_read(cls.index_name, Nothing)
+        if columns:
+            saved = {
+                row[0]: PackageRecord(*row)
+                for row in zip(*columns)
+            }
+        else:
+            saved = {}
+        records = []
+        reused = 0
+        for pkg in cache:
+            latestver = get_latest_ver(pkg)
+            savedrec = saved.get(pkg.name, None)
+            if (
+                    (savedrec is None) or
+                    (savedrec.version != latestver) or
+                    pkg_from_repos(pkg, repos)):
+                summary = get_pkg_summary(pkg)
+                description = get_pkg_description(pkg)
+            else:
+                summary = savedrec.summary
+                description = savedrec.description
+                reused += 1
+            records.append(
+                PackageRecord(
+                    pkg.name,
+                    pkg_install_state(pkg),
+                    latestver,
+                    summary,
+                    description,
+                )
+            )
+        return cls(records, stamp=stamp), reused
+
+    @classmethod
+    def load(cls):
+        """ Load the saved SearchIndex.
+            Returns None if it is missing or out of date.
+        """
+        stamp = file_stamp(APT_STATE_FILES)
+        columns = index_read(cls.index_name, stamp)
+        if not columns:
+            return None
+        return cls(
+            (PackageRecord(*row) for row in zip(*columns)),
+            stamp=stamp,
+        )
+
+    def save(self):
+        """ Save this SearchIndex. Returns True on success. """
+        # Stored as plain columns, so it can be loaded without this class.
+        columns = tuple(list(col) for col in zip(*self.data))
+        return index_write(self.index_name, columns, self.stamp)
+
+
+class SimpleOpProgress(object):
+
+    """ Handles progress updates for Operations.
+        It can be used like an apt.progress.base.OpProgress, without
+        importing apt.
+    """
 
     def __init__(self, msg=None):
         self.msg = msg if msg else 'Doing operation'
@@ -1973,14 +6272,24 @@ class SimpleOpProgress(apt.progress.text.OpProgress):
         self.msg = s
 
 
-class SimpleFetchProgress(
-        apt.progress.text.AcquireProgress, apt.progress.text.OpProgress):
+class SimpleFetchProgress(LazyAptBase):
     """ Handles progress updates for Fetches """
+    apt_bases = ('progress.text.AcquireProgress', 'progress.text.OpProgress')
 
     def __init__(self, msg=None):
         self.msg = msg if msg else 'Fetching'
         apt.progress.text.OpProgress.__init__(self)
         apt.progress.text.AcquireProgress.__init__(self)
+        # Destination files for items that were downloaded (changed).
+        self.fetched = set()
+        # Number of items that were not modified on the server.
+        self.hits = 0
+
+    def changed_repos(self):
+        """ Return a set of repositories (see list_repo()) with package or
+            translation lists that were downloaded.
+        """
+        return {list_repo(filename) for filename in self.fetched}
 
     def _write(self, msg, newline=True, maximize=False):
         """ Write the message on the terminal, fill remaining space. """
@@ -2002,12 +6311,12 @@ class SimpleFetchProgress(
         apt.progress.base.AcquireProgress.fail(self, item)
         if item.owner.status == item.owner.STAT_DONE:
             self._write(' '.join((
-                str(C(_('Ign'), fore='yellow')),
+                str(C(apt_pkg.gettext('Ign'), fore='yellow')),
                 item.description)
             ))
         else:
             self._write(' '.join((
-                str(C(_('Err'), fore='red')),
+                str(C(apt_pkg.gettext('Err'), fore='red')),
                 item.description)
             ))
             if item.owner.error_text:
@@ -2021,10 +6330,11 @@ class SimpleFetchProgress(
         # It's complete already (e.g. Hit)
         if item.owner.complete:
             return
+        self.fetched.add(item.owner.destfile)
         item.owner.id = self._id
         self._id += 1
         line = '{}{} {}'.format(
-            C(_('Get:'), fore='lightblue'),
+            C(apt_pkg.gettext('Get:'), fore='lightblue'),
             C(item.owner.id, fore='blue', style='bright'),
             C(item.description, fore='green')
         )
@@ -2053,8 +6363,9 @@ class SimpleFetchProgress(
     def ims_hit(self, item):
         """Called when an item is update (e.g. not modified on the server)."""
         apt.progress.base.AcquireProgress.ims_hit(self, item)
+        self.hits += 1
         line = ' '.join((
-            str(C(_('Hit'), fore='green')),
+            str(C(apt_pkg.gettext('Hit'), fore='green')),
             item.description
         ))
         if item.owner.filesize:
@@ -2071,13 +6382,16 @@ class SimpleFetchProgress(
         self.msg = s
 
 
-class SimpleInstallProgress(apt.progress.base.InstallProgress):
+class SimpleInstallProgress(LazyAptBase):
 
     """ Handles progress updates for Installs """
+    apt_bases = ('progress.base.InstallProgress',)
 
     def __init__(self, msg=None, pkgname=None):
         self.msg = msg if msg else 'Installing'
         self.pkgname = pkgname if pkgname else None
+        # Errors reported by dpkg, {pkgname: errormsg}.
+        self.errors = {}
 
         apt.progress.base.InstallProgress.__init__(self)
         # Redirect dpkg's messages to stdout.
@@ -2085,11 +6399,25 @@ class SimpleInstallProgress(apt.progress.base.InstallProgress):
 
     def error(self, pkg, errormsg):
         """ Handles errors from dpkg. """
-
+        # dpkg reports a name (maybe with an arch) or a .deb file name.
+        pkgname = getattr(pkg, 'name', pkg)
+        pkgname = os.path.split(pkgname)[-1].split('_')[0]
+        pkgname = strip_arch(pkgname, force=True)
+        self.errors[pkgname] = errormsg
         print_err(
-            '\nError while installing: {}\n{}'.format(pkg.name, errormsg)
+            '\nError while {}: {}\n{}'.format(
+                self.msg.lower(),
+                pkgname,
+                errormsg,
+            )
         )
 
+    def package_error(self, pkgname):
+        """ Return the dpkg error message for a package name, or None if
+            there were no errors for it.
+        """
+        return self.errors.get(strip_arch(pkgname, force=True), None)
+
     def finish_update(self):
         """ Handles end of installation """
 
@@ -2099,29 +6427,42 @@ class SimpleInstallProgress(apt.progress.base.InstallProgress):
             )
 
 
-# custom progress reporters
+# Colr is used once colors are enabled (see colr_load()).
+C = PlainColr
+# custom progress reporter, for loading the cache.
 oprogress = SimpleOpProgress()
-fprogress = SimpleFetchProgress()
-
-# Apply monkey patch.
-apt.Cache.get = cache_get
 
 # START ---------------------------------------------------
 if __name__ == '__main__':
-    # Disable colors for non-ttys.
-    colr_auto_disable()
+    main_start = perf_counter()
+    # Colors (and colr itself) are only used when both stdout and stderr
+    # are ttys.
+    if sys.stdout.isatty() and sys.stderr.isatty():
+        colr_enable()
     # Get actual terminal size.
     TERM_WIDTH, TERM_HEIGHT = get_terminal_size()
     TERM_WIDTH -= 10
-    main_argd = docopt(
-        USAGESTR,
-        version='{} v. {}'.format(NAME, __version__),
-        script=SCRIPT,
-    )
+    main_argd = parse_args()
+    profiler = None
+    tracefile = os.environ.get('APTTOOL_TRACE', '').strip()
+    if main_argd['--profile'] or tracefile:
+        profiler = Profiler(
+            start=MODULE_START,
+            pstatsfile=os.environ.get('APTTOOL_PSTATS', None),
+        ).install()
+        profiler.add_phase('module', main_start - MODULE_START)
+        # Colors and argument parsing.
+        profiler.add_phase('startup', perf_counter() - main_start)
     # grab start time for timing.
     start_time = time()
     try:
-        ret = main(main_argd)
+        if profiler is None:
+            ret = daemon_request(main_argd, sys.argv[1:])
+            if ret is None:
+                ret = main(main_argd)
+        else:
+            # The daemon's work wouldn't be included in the report.
+            ret = profiler.run(main, main_argd)
     except KeyboardInterrupt:
         print_err('\nUser cancelled.\n')
         ret = 2
@@ -2138,5 +6479,7 @@ if __name__ == '__main__':
     duration = time() - start_time
     if duration > 0.01:
         print_runtime(duration)
+    if profiler is not None:
+        profiler.write(None if tracefile in ('', '-', '1') else tracefile)
 
     sys.exit(ret)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" test_apttool.py
+    Tests for apttool.py. These use fake packages where they can, so they
+    don't depend on what is installed.
+    Run with: python3 -m unittest test_apttool
+"""
+
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import unittest
+
+# apttool.py lives next to this script.
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0])
+# The usage string is built from the script name when apttool is imported.
+argv0, sys.argv[0] = sys.argv[0], 'apttool.py'
+import apttool  # noqa
+sys.argv[0] = argv0
+
+
+class FakeVersion(object):
+    """ A package version, with only what PackageVersions uses. """
+    def __init__(self, pkgname, version):
+        self.pkgname = pkgname
+        self.version = version
+
+    def __str__(self):
+        return '{}={}'.format(self.pkgname, self.version)
+
+
+class FakePackage(object):
+    """ A package, with only what PackageVersions uses. """
+    def __init__(self, name, versions, installed=None):
+        self.name = name
+        self.versions = [FakeVersion(name, v) for v in versions]
+        self.installed = None
+        for ver in self.versions:
+            if ver.version == installed:
+                self.installed = ver
+
+
+class FakeTextVersion(object):
+    """ A package version with a summary and description, that counts how
+        many times the description is loaded.
+    """
+    def __init__(self, summary, description):
+        self.summary = summary
+        self._description = description
+        self.description_loads = 0
+
+    @property
+    def description(self):
+        self.description_loads += 1
+        return self._description
+
+
+class FakeTextPackage(object):
+    """ An installed package, with only what AptToolFilter uses. """
+    def __init__(self, name, summary, description):
+        self.name = name
+        self.installed = FakeTextVersion(summary, description)
+        self.versions = [self.installed]
+
+
+class TestContainsFile(unittest.TestCase):
+    def setUp(self):
+        self.saved = (apttool.cache_main, apttool.FileIndex.load)
+
+    def tearDown(self):
+        apttool.cache_main, apttool.FileIndex.load = self.saved
+
+    def test_installed_version(self):
+        """ -c prints the installed version, like --noindex does. """
+        class FakeFileIndex(object):
+            def search(self, repat, shortnamesonly):
+                return [('foo:amd64', ['/usr/bin/foo'])]
+
+        apttool.FileIndex.load = FakeFileIndex
+        apttool.cache_main = {
+            'foo': FakePackage('foo', ('2.0', '1.0'), installed='1.0'),
+        }
+        with tempfile.TemporaryFile('w+') as f:
+            stdout, sys.stdout = sys.stdout, f
+            try:
+                ret = apttool.cmd_contains_file('bin/foo', fmt='tsv')
+            finally:
+                sys.stdout = stdout
+            f.seek(0)
+            self.assertEqual(ret, 0)
+            # Status messages are only hidden by main().
+            self.assertIn('\nfoo\t1.0\t/usr/bin/foo\n', f.read())
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.saved = (apttool.daemon_connect, apttool.main, os.getcwd())
+
+    def tearDown(self):
+        apttool.daemon_connect, apttool.main, cwd = self.saved
+        os.chdir(cwd)
+
+    def test_relative_names_file(self):
+        """ The daemon reads PACKAGES files from the client's directory. """
+        argv = ['-l', 'names.txt']
+        clientsock, daemonsock = socket.socketpair()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'names.txt'), 'w') as f:
+                f.write('foo\nbar baz\n')
+            os.chdir(tmpdir)
+            # The client gets it's exit status without waiting on a
+            # daemon, and the request is checked afterwards.
+            daemonsock.sendall(b'{"ret": 0}\n')
+            apttool.daemon_connect = lambda: clientsock
+            ret = apttool.daemon_request(apttool.parse_args(argv), argv)
+            self.assertEqual(ret, 0)
+            with daemonsock.makefile('rb') as f:
+                request = json.loads(f.readline().decode('utf-8'))
+            daemonsock.close()
+            self.assertEqual(request['cwd'], os.getcwd())
+
+            # Answer the request from another directory, like the daemon.
+            os.chdir(os.path.split(tmpdir)[0])
+
+            def main(argd):
+                print(' '.join(apttool.parse_packages_arg(argd['PACKAGES'])))
+                return 0
+
+            apttool.main = main
+            clientsock, daemonsock = socket.socketpair()
+            clientsock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            apttool.daemon_handle(daemonsock)
+            daemonsock.close()
+            with clientsock, clientsock.makefile('rb') as f:
+                msgs = [json.loads(line.decode('utf-8')) for line in f]
+        self.assertEqual(
+            msgs,
+            [
+                {'stream': 'stdout', 'data': 'foo bar baz'},
+                {'stream': 'stdout', 'data': '\n'},
+                {'ret': 0},
+            ],
+        )
+
+
+class TestFilter(unittest.TestCase):
+    def matches(self, pattern, pkg, reverse=False):
+        return apttool.AptToolFilter(
+            apttool.re.compile(pattern),
+            reverse=reverse,
+        ).matches(pkg)
+
+    def test_name(self):
+        """ Name matches don't load the description. """
+        pkg = FakeTextPackage('libssl3', 'SSL library', 'Secure sockets.')
+        self.assertTrue(self.matches('ssl', pkg))
+        # Reverse searches match when the name doesn't.
+        self.assertTrue(self.matches('Secure', pkg, reverse=True))
+        self.assertEqual(pkg.installed.description_loads, 0)
+
+    def test_summary(self):
+        """ Summary matches don't load the long description. """
+        pkg = FakeTextPackage('openssl', 'Secure Sockets Layer toolkit', '')
+        self.assertTrue(self.matches('Layer', pkg))
+        pkg = FakeTextPackage('layer', 'Layer toolkit', 'More about layers.')
+        self.assertFalse(self.matches('ayer', pkg, reverse=True))
+        self.assertEqual(pkg.installed.description_loads, 0)
+
+    def test_description(self):
+        """ The long description decides when the summary can't. """
+        pkg = FakeTextPackage('openssl', 'Toolkit', 'Secure Sockets Layer.')
+        self.assertTrue(self.matches('Layer', pkg))
+        self.assertFalse(self.matches('missing', pkg))
+        pkg = FakeTextPackage('layer', 'Toolkit', 'More about layers.')
+        self.assertFalse(self.matches('layer', pkg, reverse=True))
+        pkg = FakeTextPackage('layer', 'Toolkit', 'Something else.')
+        self.assertTrue(self.matches('layer', pkg, reverse=True))
+
+
+class TestOutputBuffer(unittest.TestCase):
+    def setUp(self):
+        self.time = apttool.time
+        self.now = 0.0
+        apttool.time = lambda: self.now
+
+    def tearDown(self):
+        apttool.time = self.time
+
+    def test_slow_search(self):
+        """ Results are written during a long run of non-matches. """
+        f = io.StringIO()
+        output = apttool.OutputBuffer(f, bufsize=65536)
+        aptfilter = apttool.AptToolFilter(
+            apttool.re.compile('^foo$'),
+            use_desc=False,
+            print_no_desc=True,
+            output=output,
+        )
+        pkg = apttool.PackageRecord('foo', True, '1.0', 'Foo', 'Foo.')
+        self.assertTrue(aptfilter.apply(pkg))
+        self.assertEqual(f.getvalue(), '')
+        self.now += output.interval
+        pkg = apttool.PackageRecord('bar', True, '1.0', 'Bar', 'Bar.')
+        for _ in range(apttool.OUTPUT_POLL_COUNT):
+            aptfilter.apply(pkg)
+        self.assertIn('foo', f.getvalue())
+
+
+class TestRankIndex(unittest.TestCase):
+    def setUp(self):
+        records = apttool.SearchIndex(
+            (
+                apttool.PackageRecord(name, True, '1.0', summary, desc)
+                for name, summary, desc in (
+                    ('ssl', 'SSL tools', 'Tools for ssl.'),
+                    ('libssl3', 'SSL library', 'Secure sockets library.'),
+                    ('openssl', 'Toolkit', 'Secure sockets.'),
+                    ('python3-foo', 'Foo module', 'A python library.'),
+                    ('bar', 'Bar tool', 'Something else.'),
+                )
+            ),
+            stamp=('test',),
+        )
+        self.rankindex = apttool.RankIndex.from_records(records)
+
+    def names(self, terms, top=25):
+        results, total = self.rankindex.search(terms, top=top)
+        return [pkgrec.name for _, pkgrec in results], total
+
+    def test_partial_names(self):
+        """ Names that only contain a term are found, and rank lower. """
+        self.assertEqual(
+            self.names(['ssl']),
+            (['ssl', 'libssl3', 'openssl'], 3),
+        )
+        self.assertEqual(self.names(['pyth']), (['python3-foo'], 1))
+
+    def test_every_term(self):
+        """ Every term must match, in the name or the description. """
+        self.assertEqual(self.names(['secure', 'library']), (['libssl3'], 1))
+        self.assertEqual(self.names(['ssl', 'missing']), ([], 0))
+
+    def test_top(self):
+        """ Results are trimmed to `top`, but counted before that. """
+        self.assertEqual(self.names(['ssl'], top=2), (['ssl', 'libssl3'], 3))
+        self.assertEqual(self.names(['ssl'], top=0), ([], 3))
+
+
+class TestVersions(unittest.TestCase):
+    def setUp(self):
+        # Backports are looked up in the apt cache.
+        self.version_has_backport = apttool.version_has_backport
+        apttool.version_has_backport = lambda ver: False
+
+    def tearDown(self):
+        apttool.version_has_backport = self.version_has_backport
+
+    def test_version_no_colors(self):
+        """ -V works without colors when an older version is installed. """
+        self.assertTrue(apttool.colr_disabled())
+        pkg = FakePackage('foo', ('2.0', '1.0'), installed='1.0')
+        verinfo = apttool.PackageVersions(pkg).formatted(header=False)
+        self.assertEqual(
+            verinfo,
+            'foo 1.0 installed, latest version is: foo=2.0',
+        )
+
+    def test_version_latest_no_colors(self):
+        """ -V works without colors when the latest version is installed.
+        """
+        pkg = FakePackage('foo', ('2.0', '1.0'), installed='2.0')
+        verinfo = apttool.PackageVersions(pkg).formatted(header=False)
+        self.assertEqual(verinfo, 'foo 2.0 (latest version is installed)')
+
+
+if __name__ == '__main__':
+    unittest.main()